@@ -8,11 +8,18 @@ import shutil
 import sys
 import atexit
 import errno
+import hashlib
+import multiprocessing.pool
 
 parser = argparse.ArgumentParser(description= """
 DESCRIPTION
 
 Run the SICER pipeline using a control and an input file.
+
+Batch mode: Give several treatment files to -t, or a sample sheet with
+--sampleSheet, to call islands for all of them in one job. Each control is
+preprocessed only once and the treatments are processed in parallel.
+Results go to --outdir, one file per treatment.
     
 SEE ALSO:
 
@@ -23,14 +30,51 @@ https://github.com/dariober/SICERpy
 
 parser.add_argument('--treatment', '-t',
                    required= False,
-                   default= '-',
-                   help='''Treatment (pull-down) file in bam format
+                   nargs= '+',
+                   default= [],
+                   help='''Treatment (pull-down) file in bam format. If more than one file is given,
+all of them are compared to the control in batch mode.
                    ''')
 
 
 parser.add_argument('--control', '-c',
-                   required= True,
-                   help='''Control (input) file in bam format
+                   required= False,
+                   help='''Control (input) file in bam format. Required unless --sampleSheet is used.
+                   ''')
+
+parser.add_argument('--sampleSheet', '-s',
+                   required= False,
+                   default= None,
+                   help='''Batch mode: Tab separated file with columns treatment, control and optionally
+output file name. Lines starting with # are skipped. Output files without directory
+are written to --outdir. Default output name is the treatment name with suffix .sicer.bed.
+                   ''')
+
+parser.add_argument('--outdir', '-o',
+                   required= False,
+                   default= '.',
+                   help='''Batch mode: Directory for the output files. Default is current directory.
+                   ''')
+
+parser.add_argument('--output', '-O',
+                   required= False,
+                   default= '-',
+                   help='''Output file for the table of islands. Default is stdout (-). Results are written
+as soon as the significance of the islands is computed. Ignored in batch and sweep mode.
+                   ''')
+
+parser.add_argument('--bgzip',
+                   action= 'store_true',
+                   help='''Compress the output with bgzip and index it with tabix. The suffix .gz is added to
+the output file(s) if not present. Requires --output unless in batch mode.
+                   ''')
+
+parser.add_argument('--nproc', '-p',
+                   required= False,
+                   default= min(4, multiprocessing.cpu_count()),
+                   type= int,
+                   help='''Number of processes. In batch mode, number of treatments to process in parallel; the processes
+left are used to split the per-chromosome work of each treatment. Default %(default)s.
                    ''')
 
 parser.add_argument('--effGenomeSize', '-gs',
@@ -69,16 +113,70 @@ parser.add_argument('--redThresh', '-rt',
                    help='''Redundancy threshold to keep reads mapping to the same position on the same strand. Default 0 (do not filter for redundancy). 
                    ''')
 
+parser.add_argument('--maxMemory',
+                   required= False,
+                   default= None,
+                   type= int,
+                   help='''Memory budget in MB for the removal of redundant reads. If set, reads are sorted in
+chunks of this size spilled to disk and merged, so that libraries of any size can be processed.
+Default: sort each chromosome with the system `sort`.
+                   ''')
+
+parser.add_argument('--copyHistogram',
+                   required= False,
+                   default= None,
+                   help='''Directory where to write, for each input bam, the histogram of read copies by
+chromosome and strand (<bam name>.copy_histogram.tsv). Collected while removing redundant reads.
+                   ''')
+
+parser.add_argument('--windowHistogram',
+                   required= False,
+                   default= None,
+                   help='''Directory where to write, for each treatment, the histogram of windows by read count
+(<treatment name>.windows_histogram.tsv), as utility/get_windows_histogram.py. Collected while partitioning
+the genome in windows. Not written in sweep mode.
+                   ''')
+
+parser.add_argument('--islandStatistics',
+                   required= False,
+                   default= None,
+                   help='''Directory where to write, for each treatment, the statistics of the candidate islands
+passing the E-value threshold: number, total length and score, genome coverage, quantiles
+(<treatment name>.island_statistics.tsv) and the histograms of lengths and scores
+(<treatment name>.island_length_histogram.tsv, <treatment name>.island_score_histogram.tsv), as
+utility/islands_statistics_pr.py. Computed while calling the islands. Not written in sweep mode.
+                   ''')
+
+parser.add_argument('--downsample',
+                   action= 'store_true',
+                   help='''After removing redundant reads, randomly subsample each treatment larger than its control
+to the same number of reads as the control, in a single pass (see src/subsample_bam.py).
+Memory grows with the size of the control: about 8 bytes per read for the reservoir of file offsets
+plus about 25 bytes per read for the coordinates of the reads kept.
+                   ''')
+
+parser.add_argument('--seed',
+                   required= False,
+                   default= 0,
+                   type= int,
+                   help='''With --downsample: seed of the random choice of the reads. Default %(default)s.
+                   ''')
+
 parser.add_argument('--windowSize', '-w',
                    required= False,
-                   default= 200,
+                   default= [200],
+                   nargs= '+',
 	               type= int,
                    help='''Size of the windows to scan the genome. WINDOW_SIZE is the smallest possible island. Default 200.
+If more than one window or gap size is given, run in sweep mode: islands are called for each
+combination of window and gap size reading the libraries only once. One result file per combination
+and a summary table are written to --outdir.
                    ''')
 
 parser.add_argument('--gapSize', '-g',
                    required= False,
-                   default= 3,
+                   default= [3],
+                   nargs= '+',
     	           type= int,
                    help='''Multiple of window size used to determine the gap size. Must be an integer. Default: 3.
                    ''')
@@ -90,6 +188,73 @@ parser.add_argument('--fragSize', '-fs',
                    help='''Size of the sequenced fragment. The center of the the fragment will be taken as half the fragment size. Default 150.
                    ''')
 
+parser.add_argument('--evalue', '-e',
+                   required= False,
+                   default= 1000,
+                   type= float,
+                   help='''E-value that determines the score threshold of the candidate islands. Default %(default)s.
+                   ''')
+
+parser.add_argument('--fdr',
+                   required= False,
+                   default= None,
+                   type= float,
+                   help='''Write only the islands with FDR up to this. Default: write all the candidate islands.
+Not allowed in sweep mode.
+                   ''')
+
+parser.add_argument('--candidates',
+                   action= 'store_true',
+                   help='''Also save all the candidate islands with their chip and control read counts, before any
+E-value threshold, to <output>.candidates.tsv (sicer.candidates.tsv in --outdir if output is stdout).
+Use this file with --rescore to apply a different E-value, FDR or scaling factor in seconds.
+Not allowed in sweep mode.
+                   ''')
+
+parser.add_argument('--rescore',
+                   required= False,
+                   default= None,
+                   metavar= 'CANDIDATES',
+                   help='''Do not run the pipeline: re-score the candidate islands saved with --candidates using
+--evalue, --fdr, --scalingFactor and write the table of islands as usual.
+                   ''')
+
+parser.add_argument('--scalingFactor',
+                   required= False,
+                   default= None,
+                   type= float,
+                   help='''With --rescore: factor to scale the control reads. Default is the ratio of the chip to
+control library size.
+                   ''')
+
+parser.add_argument('--denseWindows',
+                   action= 'store_true',
+                   help='''Store the window counts as a dense, memory-mapped binary file instead of a bed graph.
+Faster to read back for large genomes.
+                   ''')
+
+parser.add_argument('--cacheDir', '--cache-dir',
+                   required= False,
+                   default= None,
+                   help='''Directory where to cache the filtered and de-duplicated libraries. A library
+processed before with the same -f, -F, -q, -rt settings is taken from here instead of being processed again.
+Useful when the same control is used for several treatments. Default: no caching.
+                   ''')
+
+parser.add_argument('--workdir',
+                   required= False,
+                   default= None,
+                   help='''Keep intermediate files in this directory instead of a temporary one. Stage outputs
+(filtered libraries, summary graph, candidate islands, island summary) have stable names and are
+recorded in WORKDIR/manifest.json together with the inputs and parameters that produced them.
+                   ''')
+
+parser.add_argument('--resume',
+                   action= 'store_true',
+                   help='''Requires --workdir: Skip the stages already completed by a previous run in
+the same workdir, provided their inputs, parameters and outputs have not changed.
+                   ''')
+
 parser.add_argument('--keeptmp',
                    action= 'store_true',
                    help='''For debugging: Do not delete temp directory at the end of run.
@@ -102,138 +267,488 @@ args= parser.parse_args()
 
 # ------------------------------------------------------------------------------
 
+class PipelineError(Exception):
+    def __init__(self, returncode, stderr):
+        Exception.__init__(self, stderr)
+        self.returncode= returncode
+        self.stderr= stderr
+
+def runCmd(cmd, stdout= subprocess.PIPE):
+    """Execute cmd in a shell and return its stderr. Raise PipelineError if
+    cmd fails. The stdout of cmd is discarded unless stdout is None, in which
+    case it goes to the stdout of this script.
+    """
+    sys.stderr.write(cmd + '\n')
+    p= subprocess.Popen(cmd, shell= True, stdout= stdout, stderr= subprocess.PIPE)
+    stdout, stderr= p.communicate()
+    if p.returncode != 0:
+        raise PipelineError(p.returncode, stderr)
+    return stderr
+
+def artifactName(label, *keys):
+    """Stable name for the files produced from keys, e.g. the input files.
+    """
+    return label + '.' + hashlib.sha1('\t'.join(keys)).hexdigest()[:10]
+
+def runStage(stage, cmd, inputs, params, outputs, stdout= subprocess.PIPE):
+    """Execute cmd unless, with --resume, the stage is up to date in the
+    manifest. Record the stage as completed on success. Stages without
+    output files, i.e. writing to stdout, are always executed.
+    """
+    if args.resume and outputs and manifest.is_current(stage, inputs, params, outputs):
+        sys.stderr.write('Stage %s is up to date: skipped\n' %(stage))
+        return
+    manifest.discard(stage)
+    sys.stderr.write(runCmd(cmd, stdout) + '\n')
+    manifest.record(stage, inputs, params, outputs)
+
+def parallelMap(func, items, nproc):
+    """Apply func to each of items using nproc threads. Work is done by
+    child processes so threads are enough.
+    """
+    if nproc <= 1 or len(items) <= 1:
+        return [func(x) for x in items]
+    pool= multiprocessing.pool.ThreadPool(min(nproc, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+
+def stageProcs():
+    """Number of processes for the per-chromosome stages of one sample: the
+    --nproc processes are shared among the samples running at the same time.
+    """
+    return max(1, args.nproc // max(1, min(len(samples), args.nproc)))
+
+def readSampleSheet(sampleSheet, outdir):
+    """Return list of (treatment, control, output) from sampleSheet.
+    """
+    samples= []
+    fin= open(sampleSheet)
+    for line in fin:
+        if line.startswith('#') or line.strip() == '':
+            continue
+        line= line.rstrip('\n\r').split('\t')
+        if len(line) < 2:
+            sys.stderr.write('Invalid line in %s: expected at least treatment and control:\n%s\n' %(sampleSheet, '\t'.join(line)))
+            sys.exit(1)
+        if len(line) > 2 and line[2].strip() != '':
+            output= line[2].strip()
+            if os.path.dirname(output) == '':
+                output= os.path.join(outdir, output)
+        else:
+            output= defaultOutput(line[0], outdir)
+        samples.append((os.path.abspath(line[0].strip()), os.path.abspath(line[1].strip()), os.path.abspath(output)))
+    fin.close()
+    return samples
+
+def bgzipName(output):
+    if output.endswith('.gz'):
+        return output
+    return output + '.gz'
+
+def candidatesFile(output):
+    """File for the candidate islands of output
+    """
+    if output == '-':
+        return os.path.join(os.path.abspath(args.outdir), 'sicer.candidates.tsv')
+    for ext in ['.gz', '.bed']:
+        if output.endswith(ext):
+            output= output[:-len(ext)]
+    return output + '.candidates.tsv'
+
+def rescoreCandidates(candidates):
+    """Run rescore_islands.py on candidates and exit
+    """
+    cmd= """export PYTHONPATH=%(pythonpath)s
+%(python)s %(script)s -i %(candidates)s -e %(evalue)s -o %(output)s""" \
+                %{'pythonpath': pythonpath,
+                  'python': python,
+                  'script': os.path.join(srcDir, 'rescore_islands.py'),
+                  'candidates': os.path.abspath(candidates),
+                  'evalue': args.evalue,
+                  'output': args.output};
+    if args.fdr is not None:
+        cmd += ' -q %s' %(args.fdr)
+    if args.scalingFactor is not None:
+        cmd += ' -s %s' %(args.scalingFactor)
+    if args.bgzip:
+        cmd += ' -z'
+    try:
+        sys.stderr.write(runCmd(cmd, stdout= None) + '\n')
+    except PipelineError, e:
+        sys.stderr.write(e.stderr + '\n')
+        sys.exit(e.returncode)
+    sys.exit()
+
+def defaultOutput(treatment, outdir):
+    name= os.path.basename(treatment)
+    if name.endswith('.bam'):
+        name= name[:-len('.bam')]
+    return os.path.abspath(os.path.join(outdir, name + '.sicer.bed'))
+
+def copyHistogramFile(inBam):
+    name= os.path.basename(inBam)
+    if name.endswith('.bam'):
+        name= name[:-len('.bam')]
+    return os.path.join(args.copyHistogram, name + '.copy_histogram.tsv')
+
+def windowHistogramFile(treatment):
+    name= os.path.basename(treatment)
+    if name.endswith('.bam'):
+        name= name[:-len('.bam')]
+    return os.path.join(args.windowHistogram, name + '.windows_histogram.tsv')
+
+def islandStatisticsPrefix(treatment):
+    name= os.path.basename(treatment)
+    if name.endswith('.bam'):
+        name= name[:-len('.bam')]
+    return os.path.join(args.islandStatistics, name)
+
+def preprocessLibraries(bams, tmpdir):
+    """Filter and remove redundant reads from each of bams. Each bam is
+    processed only once and taken from the cache if possible.
+    Return dict {bam: (filtered bam, read library)}
+    """
+    cacheSettings= {'requiredFlag': args.requiredFlag,
+                    'filterFlag': args.filterFlag,
+                    'mapq': args.mapq,
+                    'redThresh': args.redThresh}
+
+    filtered= {} ## Key: input bam; Value: (filtered bam, read library)
+    todo= []
+    for inBam in bams:
+        if inBam in filtered:
+            continue
+        if args.cacheDir:
+            entry= library_cache.lookup(args.cacheDir, inBam, cacheSettings)
+            if entry and args.copyHistogram and not os.path.isfile(os.path.join(entry, library_cache.ENTRY_COPY_HISTOGRAM)):
+                sys.stderr.write('Cached library for %s has no histogram of copies: processing again\n' %(inBam))
+                entry= None
+            if entry:
+                sys.stderr.write('Using cached library for %s: %s\n\n' %(inBam, entry))
+                filtered[inBam]= (os.path.join(entry, library_cache.ENTRY_BAM), os.path.join(entry, library_cache.ENTRY_LIBRARY))
+                if args.copyHistogram:
+                    shutil.copy(os.path.join(entry, library_cache.ENTRY_COPY_HISTOGRAM), copyHistogramFile(inBam))
+                continue
+        outBam= os.path.join(tmpdir, artifactName(os.path.basename(inBam), inBam) + '.rm.bam')
+        outLib= outBam[:-len('.bam')] + '.npz'
+        filtered[inBam]= (outBam, outLib)
+        todo.append(inBam)
+
+    def removeRedundant(inBam):
+        outBam, outLib= filtered[inBam]
+        # Create a separate dir for each process so tmp files don't bother each other
+        tmpRedDir= os.path.join(tmpdir, 'tmp_' + os.path.basename(outBam) + '_dir')
+        if os.path.isdir(tmpRedDir):
+            shutil.rmtree(tmpRedDir)
+        os.makedirs(tmpRedDir)
+        cmd= """cd %(tmpRedDir)s
+export PYTHONPATH=%(pythonpath)s
+%(python)s %(script)s -t %(redThresh)s -b %(inBam)s -o %(outBam)s -n %(outLib)s -f %(requiredFlag)s -F %(filterFlag)s -q %(mapq)s""" \
+            %{'tmpRedDir': tmpRedDir,
+              'pythonpath': pythonpath, 
+              'python': python, 
+              'script': os.path.join(srcDir, 'remove_redundant_reads_bam.py'),
+              'redThresh': args.redThresh,
+              'inBam': inBam, 
+              'outBam': outBam,
+              'outLib': outLib,
+              'requiredFlag': args.requiredFlag,
+              'filterFlag': args.filterFlag,
+              'mapq': args.mapq};
+        if args.maxMemory:
+            cmd += ' -m %s' %(args.maxMemory)
+        outputs= [outBam, outLib]
+        extras= None
+        if args.copyHistogram:
+            cmd += ' -H %s' %(copyHistogramFile(inBam))
+            outputs.append(copyHistogramFile(inBam))
+            extras= {library_cache.ENTRY_COPY_HISTOGRAM: copyHistogramFile(inBam)}
+        runStage('preprocess:' + os.path.basename(outBam), cmd, [inBam], cacheSettings, outputs)
+        if args.cacheDir:
+            entry= library_cache.store(args.cacheDir, inBam, cacheSettings, outBam, outLib, read_library.library_size(outLib), extras= extras)
+            sys.stderr.write('Library %s cached in %s\n\n' %(inBam, entry))
+            filtered[inBam]= (os.path.join(entry, library_cache.ENTRY_BAM), os.path.join(entry, library_cache.ENTRY_LIBRARY))
+
+    parallelMap(removeRedundant, todo, max(args.nproc, 2))
+    return filtered
+
+def downsampleTreatment(filteredSampleBam, sampleLibrary, controlLibrary, workdir):
+    """Subsample the treatment to the size of the control library if larger.
+    Return the filtered bam and library to use for the treatment.
+    """
+    controlSize= read_library.library_size(controlLibrary)
+    if read_library.library_size(sampleLibrary) <= controlSize:
+        return (filteredSampleBam, sampleLibrary)
+    sys.stderr.write('\n*** Downsample treatment to %s reads\n' %(controlSize))
+    outBam= os.path.join(workdir, 'downsampled.bam')
+    outLibrary= os.path.join(workdir, 'downsampled' + read_library.LIBRARY_EXTENSION)
+    cmd= """export PYTHONPATH=%(pythonpath)s
+%(python)s %(script)s -b %(filteredSampleBam)s -n %(n)s -s %(seed)s -o %(outBam)s -l %(outLibrary)s""" \
+                %{'pythonpath': pythonpath, 
+                  'python': python, 
+                  'script': os.path.join(srcDir, 'subsample_bam.py'), 
+                  'filteredSampleBam': filteredSampleBam,
+                  'n': controlSize,
+                  'seed': args.seed,
+                  'outBam': outBam,
+                  'outLibrary': outLibrary};
+    runStage('downsample:' + os.path.basename(workdir), cmd, [filteredSampleBam, sampleLibrary, controlLibrary],
+        {'n': controlSize, 'seed': args.seed}, [outBam, outLibrary])
+    return (outBam, outLibrary)
+
+def callIslands(treatment, filteredSampleBam, sampleLibrary, controlLibrary, windowSize, gapSize, workdir, islandSig, backgroundCache= None):
+    """Run the pipeline from partitioning the genome to the significance of the
+    islands for one treatment. Intermediate files go to workdir, the island
+    summary to islandSig ('-' for stdout).
+    """
+    ## Partion the genome in windows
+    ## =============================
+    sys.stderr.write('\n*** Partion the genome in windows\n')
+    if args.denseWindows:
+        summaryGraph= os.path.join(workdir, 'summary.windows')
+        graphOpt= '-d'
+    else:
+        summaryGraph= os.path.join(workdir, 'summary.bedgraph')
+        graphOpt= '-o'
+    cmd= """cd %(workdir)s
+export PYTHONPATH=%(pythonpath)s
+%(python)s %(script)s -b %(filteredSampleBam)s -n %(sampleLibrary)s -p %(nproc)s -w %(windowSize)s -i %(fragSize)s %(graphOpt)s %(summaryGraph)s""" \
+                %{'workdir': workdir,
+                  'pythonpath': pythonpath, 
+                  'python': python, 
+                  'script': os.path.join(srcDir, 'run-make-graph-file-by-chrom_bam.py'), 
+                  'filteredSampleBam': filteredSampleBam,
+                  'sampleLibrary': sampleLibrary,
+                  'nproc': stageProcs(),
+                  'windowSize': windowSize,
+                  'fragSize': args.fragSize,
+                  'graphOpt': graphOpt,
+                  'summaryGraph': summaryGraph};
+    outputs= [summaryGraph]
+    if args.windowHistogram:
+        cmd += ' -H %s' %(windowHistogramFile(treatment))
+        outputs.append(windowHistogramFile(treatment))
+    runStage('graph:' + os.path.basename(workdir), cmd, [filteredSampleBam, sampleLibrary],
+        {'windowSize': windowSize, 'fragSize': args.fragSize}, outputs)
+
+    ## Find candidate islands exhibiting clustering
+    ## ============================================
+    sys.stderr.write('\n*** Find candidate islands exhibiting clustering\n')
+    island= os.path.join(workdir, 'scoreisland.bed')
+    cmd= """cd %(workdir)s
+export PYTHONPATH=%(pythonpath)s
+%(python)s %(script)s --bam %(bam)s -b %(summaryGraph)s -w %(windowSize)s -g %(gapSize)s -t %(effGenomeSize)s -e %(evalue)s -p %(nproc)s -f %(island)s""" \
+                %{'workdir': workdir,
+                  'pythonpath': pythonpath, 
+                  'python': python, 
+                  'script': os.path.join(srcDir, 'find_islands_in_pr.py'), 
+                  'bam': treatment,
+                  'summaryGraph': summaryGraph, 
+                  'windowSize': windowSize,
+                  'gapSize': gapSize * windowSize,
+                  'effGenomeSize': args.effGenomeSize,
+                  'evalue': args.evalue,
+                  'nproc': stageProcs(),
+                  'island': island};
+    if backgroundCache:
+        cmd += ' -c %s' %(backgroundCache)
+    outputs= [island]
+    if args.candidates:
+        rawCandidates= os.path.join(workdir, 'candidates.raw.tsv')
+        cmd += ' -a %s' %(rawCandidates)
+        outputs.append(rawCandidates)
+    if args.islandStatistics:
+        prefix= islandStatisticsPrefix(treatment)
+        cmd += ' -S %s' %(prefix)
+        outputs.extend([prefix + '.island_statistics.tsv', prefix + '.island_length_histogram.tsv', prefix + '.island_score_histogram.tsv'])
+    runStage('islands:' + os.path.basename(workdir), cmd, [treatment, summaryGraph],
+        {'windowSize': windowSize, 'gapSize': gapSize, 'effGenomeSize': args.effGenomeSize, 'evalue': args.evalue}, outputs)
+
+    ## Calculate significance of candidate islands using the control library
+    ## =====================================================================
+    sys.stderr.write('\n*** Calculate significance of candidate islands using the control library\n')
+    cmd= """cd %(workdir)s
+export PYTHONPATH=%(pythonpath)s
+%(python)s %(script)s -a %(sampleLibrary)s -b %(controlLibrary)s -d %(island)s -f %(fragSize)s -t %(effGenomeSize)s -o %(islandSig)s""" \
+                %{'workdir': workdir,
+                  'pythonpath': pythonpath, 
+                  'python': python, 
+                  'script': os.path.join(srcDir, 'associate_tags_with_chip_and_control_w_fc_q_bam.py'), 
+                  'sampleLibrary': sampleLibrary, 
+                  'controlLibrary': controlLibrary,
+                  'island': island,
+                  'fragSize': args.fragSize,
+                  'effGenomeSize': args.effGenomeSize,
+                  'islandSig': islandSig};
+    if islandSig == '-':
+        outputs= []
+    elif args.bgzip:
+        cmd += ' -z'
+        outputs= [bgzipName(islandSig), bgzipName(islandSig) + '.tbi']
+    else:
+        outputs= [islandSig]
+    if args.fdr is not None:
+        cmd += ' -q %s' %(args.fdr)
+    inputs= [sampleLibrary, controlLibrary, island]
+    if args.candidates:
+        cmd += ' -A %s -c %s' %(rawCandidates, candidatesFile(islandSig))
+        inputs.append(rawCandidates)
+        if outputs:
+            outputs.append(candidatesFile(islandSig))
+    runStage('significance:' + os.path.basename(workdir), cmd, inputs,
+        {'fragSize': args.fragSize, 'effGenomeSize': args.effGenomeSize, 'output': islandSig, 'bgzip': args.bgzip,
+         'fdr': args.fdr, 'candidates': args.candidates},
+        outputs, stdout= None if islandSig == '-' else subprocess.PIPE)
+
+def sweepWindowsAndGaps(sampleLibrary, controlLibrary, outdir):
+    """Call islands for each combination of window and gap sizes. Return the
+    summary table.
+    """
+    sys.stderr.write('\n*** Sweep window sizes %s and gap sizes %s\n' %(args.windowSize, args.gapSize))
+    cmd= """export PYTHONPATH=%(pythonpath)s
+%(python)s %(script)s -a %(sampleLibrary)s -b %(controlLibrary)s -w %(windowSizes)s -g %(gapSizes)s -f %(fragSize)s -t %(effGenomeSize)s -e %(evalue)s -o %(outdir)s""" \
+                %{'pythonpath': pythonpath, 
+                  'python': python, 
+                  'script': os.path.join(srcDir, 'sweep_windows_and_gaps.py'), 
+                  'sampleLibrary': sampleLibrary, 
+                  'controlLibrary': controlLibrary,
+                  'windowSizes': ','.join([str(x) for x in args.windowSize]),
+                  'gapSizes': ','.join([str(x) for x in args.gapSize]),
+                  'fragSize': args.fragSize,
+                  'effGenomeSize': args.effGenomeSize,
+                  'evalue': args.evalue,
+                  'outdir': outdir};
+    sys.stderr.write(runCmd(cmd) + '\n')
+    return os.path.join(outdir, 'sweep-summary.txt')
+
+# ------------------------------------------------------------------------------
+
 ## Get dir where working scripts are.
 srcDir= os.path.join(os.path.dirname(os.path.realpath(__file__)), 'src')
 python= sys.executable ## Path to python itself
 pythonpath= os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib')
-
-treatment= os.path.abspath(args.treatment)
-control= os.path.abspath(args.control)
+sys.path.insert(0, pythonpath)
+import library_cache
+import stage_manifest
+import read_library
+
+if args.rescore:
+    if args.bgzip and args.output == '-':
+        parser.error('--bgzip requires --output')
+    rescoreCandidates(args.rescore)
+
+if args.sampleSheet:
+    if args.treatment or args.control:
+        parser.error('--sampleSheet cannot be used together with --treatment or --control')
+    samples= readSampleSheet(args.sampleSheet, args.outdir)
+    batch= True
+else:
+    if not args.treatment or not args.control:
+        parser.error('--treatment and --control are required unless --sampleSheet is used')
+    control= os.path.abspath(args.control)
+    samples= [(os.path.abspath(x), control, defaultOutput(x, args.outdir)) for x in args.treatment]
+    batch= len(samples) > 1
+
+sweep= len(args.windowSize) > 1 or len(args.gapSize) > 1
+if sweep and batch:
+    parser.error('Multiple window or gap sizes can be used with one treatment only')
+if sweep and args.fdr is not None:
+    parser.error('--fdr cannot be used with multiple window or gap sizes')
+if sweep and args.candidates:
+    parser.error('--candidates cannot be used with multiple window or gap sizes')
+
+if args.cacheDir:
+    args.cacheDir= os.path.abspath(args.cacheDir)
+
+if args.copyHistogram:
+    args.copyHistogram= os.path.abspath(args.copyHistogram)
+    if not os.path.isdir(args.copyHistogram):
+        os.makedirs(args.copyHistogram)
+
+if args.windowHistogram:
+    args.windowHistogram= os.path.abspath(args.windowHistogram)
+    if not os.path.isdir(args.windowHistogram):
+        os.makedirs(args.windowHistogram)
+
+if args.islandStatistics:
+    args.islandStatistics= os.path.abspath(args.islandStatistics)
+    if not os.path.isdir(args.islandStatistics):
+        os.makedirs(args.islandStatistics)
+
+if sweep or (args.candidates and args.output == '-'):
+    args.outdir= os.path.abspath(args.outdir)
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+if batch:
+    outputs= [x[2] for x in samples]
+    if len(set(outputs)) != len(outputs):
+        sys.stderr.write('Output files are not unique. Check the names of the treatment files and the sample sheet\n')
+        sys.exit(1)
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+if args.bgzip and not batch and not sweep and args.output == '-':
+    parser.error('--bgzip requires --output')
+if args.output != '-':
+    args.output= os.path.abspath(args.output)
+
+if args.resume and not args.workdir:
+    parser.error('--resume requires --workdir')
 
 ## Set tmp dir
-tmpdir= tempfile.mkdtemp(prefix= 'tmp_sicer_', dir= os.getcwd())
-if not args.keeptmp:
-    atexit.register(shutil.rmtree, tmpdir)
+if args.workdir:
+    tmpdir= os.path.abspath(args.workdir)
+    if not os.path.isdir(tmpdir):
+        os.makedirs(tmpdir)
+else:
+    tmpdir= tempfile.mkdtemp(prefix= 'tmp_sicer_', dir= os.getcwd())
+    if not args.keeptmp:
+        atexit.register(shutil.rmtree, tmpdir)
+manifest= stage_manifest.StageManifest(os.path.join(tmpdir, 'manifest.json'))
 
 os.chdir(tmpdir)
 
-## Remove reduntant reads
-## ======================
-#if args.redThresh > 0:
-sys.stderr.write("\n*** Preprocess raw files to remove reduntant reads\n")
-
-filteredSampleBam= tempfile.NamedTemporaryFile(dir= tmpdir, prefix= os.path.basename(treatment)+'.', suffix= '.rm.bam').name 
-filteredControlBam= tempfile.NamedTemporaryFile(dir= tmpdir, prefix= os.path.basename(control)+'.', suffix= '.rm.bam').name
-
-procs= []
-for inBam, outBam in zip([treatment, control], [filteredSampleBam, filteredControlBam]):
-    # Create a separate dir for each process so tmp files don't bother each other
-    tmpRedDir= os.path.join(tmpdir, 'tmp_' + os.path.basename(outBam) + '_dir')
-    os.makedirs(tmpRedDir)
-    cmd= """cd %(tmpRedDir)s
-export PYTHONPATH=%(pythonpath)s
-%(python)s %(script)s -t %(redThresh)s -b %(inBam)s -o %(outBam)s -f %(requiredFlag)s -F %(filterFlag)s -q %(mapq)s""" \
-        %{'tmpRedDir': tmpRedDir,
-          'pythonpath': pythonpath, 
-          'python': python, 
-          'script': os.path.join(srcDir, 'remove_redundant_reads_bam.py'),
-          'redThresh': args.redThresh,
-          'inBam': inBam, 
-          'outBam': outBam,
-          'requiredFlag': args.requiredFlag,
-          'filterFlag': args.filterFlag,
-          'mapq': args.mapq};
-    sys.stderr.write(cmd + '\n\n')
-    p= subprocess.Popen(cmd, shell= True, stdout= subprocess.PIPE, stderr= subprocess.PIPE)
-    procs.append(p)
-
-for p in procs:
-    stdout, stderr= p.communicate()
-    if p.returncode != 0:
-        sys.stderr.write(stderr + '\n')
-        sys.exit(p.returncode)
-sys.stderr.write(stderr + '\n')
-#else:
-#    filteredSampleBam= treatment
-#    filteredControlBam= control
-
-## Partion the genome in windows
-## =============================
-sys.stderr.write('\n*** Partion the genome in windows\n')
-summaryGraph= os.path.join(tmpdir, 'summary.bedgraph')
-cmd= """cd %(tmpdir)s
-export PYTHONPATH=%(pythonpath)s
-%(python)s %(script)s -b %(filteredSampleBam)s -w %(windowSize)s -i %(fragSize)s -o %(summaryGraph)s""" \
-            %{'tmpdir': tmpdir,
-              'pythonpath': pythonpath, 
-              'python': python, 
-              'script': os.path.join(srcDir, 'run-make-graph-file-by-chrom_bam.py'), 
-              'filteredSampleBam': filteredSampleBam,
-              'windowSize': args.windowSize,
-              'fragSize': args.fragSize,
-              'summaryGraph': summaryGraph};
-sys.stderr.write(cmd + '\n')
-
-p= subprocess.Popen(cmd, shell= True, stdout= subprocess.PIPE, stderr= subprocess.PIPE)
-stdout, stderr= p.communicate()
-if p.returncode != 0:
-    sys.stderr.write(stderr + '\n')
-    sys.exit(p.returncode)
-sys.stderr.write(stderr + '\n')
-
-## Find candidate islands exhibiting clustering
-## ============================================
-sys.stderr.write('\n*** Find candidate islands exhibiting clustering\n')
-island= os.path.join(tmpdir, 'scoreisland.bed')
-cmd= """export PYTHONPATH=%(pythonpath)s
-%(python)s %(script)s --bam %(bam)s -b %(summaryGraph)s -w %(windowSize)s -g %(gapSize)s -t %(effGenomeSize)s -e %(evalue)s  -f %(island)s""" \
-            %{'pythonpath': pythonpath, 
-              'python': python, 
-              'script': os.path.join(srcDir, 'find_islands_in_pr.py'), 
-              'bam': treatment,
-              'summaryGraph': summaryGraph, 
-              'windowSize': args.windowSize,
-              'gapSize': args.gapSize * args.windowSize,
-              'effGenomeSize': args.effGenomeSize,
-              'evalue': 1000,
-              'island': island};
-sys.stderr.write(cmd + '\n')
-p= subprocess.Popen(cmd, shell= True, stdout= subprocess.PIPE, stderr= subprocess.PIPE)
-stdout, stderr= p.communicate()
-if p.returncode != 0:
-    sys.stderr.write(stderr + '\n')
-    sys.exit(p.returncode)
-sys.stderr.write(stderr + '\n')
-
-## Calculate significance of candidate islands using the control library
-## =====================================================================
-sys.stderr.write('\n*** Calculate significance of candidate islands using the control library\n')
-islandSig= os.path.join(tmpdir, 'island-summary.bed')
-cmd= """export PYTHONPATH=%(pythonpath)s
-%(python)s %(script)s -a %(filteredSampleBam)s -b %(filteredControlBam)s -d %(island)s -f %(fragSize)s -t %(effGenomeSize)s -o %(islandSig)s""" \
-            %{'pythonpath': pythonpath, 
-              'python': python, 
-              'script': os.path.join(srcDir, 'associate_tags_with_chip_and_control_w_fc_q_bam.py'), 
-              'filteredSampleBam': filteredSampleBam, 
-              'filteredControlBam': filteredControlBam,
-              'island': island,
-              'fragSize': args.fragSize,
-              'effGenomeSize': args.effGenomeSize,
-              'islandSig': islandSig};
-
-sys.stderr.write(cmd + '\n')
-p= subprocess.Popen(cmd, shell= True, stdout= subprocess.PIPE, stderr= subprocess.PIPE)
-stdout, stderr= p.communicate()
-if p.returncode != 0:
-    sys.stderr.write(stderr + '\n')
-    sys.exit(p.returncode)
-sys.stderr.write(stderr + '\n')
-
-## Finally print to stdout
-fin= open(islandSig)
-for line in fin:
-    sys.stdout.write(line)
-fin.close()
+try:
+    ## Remove reduntant reads
+    ## ======================
+    sys.stderr.write("\n*** Preprocess raw files to remove reduntant reads\n")
+    bams= []
+    for treatment, control, output in samples:
+        bams.extend([treatment, control])
+    filtered= preprocessLibraries(bams, tmpdir)
+
+    def runSample(sample):
+        treatment, control, output= sample
+        workdir= os.path.join(tmpdir, artifactName(os.path.basename(treatment), treatment, control))
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        filteredSampleBam, sampleLibrary= filtered[treatment]
+        filteredControlBam, controlLibrary= filtered[control]
+        if args.downsample:
+            filteredSampleBam, sampleLibrary= downsampleTreatment(filteredSampleBam, sampleLibrary, controlLibrary, workdir)
+        if sweep:
+            return sweepWindowsAndGaps(sampleLibrary, controlLibrary, args.outdir)
+        if not batch:
+            output= args.output
+        callIslands(treatment, filteredSampleBam, sampleLibrary, controlLibrary, args.windowSize[0], args.gapSize[0], workdir, output,
+            backgroundCache= os.path.join(tmpdir, 'background') if batch else None)
+        if batch:
+            sys.stderr.write('\n*** Islands for %s written to %s\n' %(treatment, bgzipName(output) if args.bgzip else output))
+        return output
+
+    results= parallelMap(runSample, samples, args.nproc)
+except PipelineError, e:
+    sys.stderr.write(e.stderr + '\n')
+    sys.exit(e.returncode)
+
+if sweep:
+    ## Finally print the summary table to stdout
+    fin= open(results[0])
+    for line in fin:
+        sys.stdout.write(line)
+    fin.close()
 
 sys.exit()
-
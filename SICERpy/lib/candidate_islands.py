@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Candidate islands: all the islands made by joining eligible windows, before
+the score threshold given by the E-value is applied, optionally with the
+chip and control read counts.
+
+Together with the parameters of the background model and the library sizes,
+stored in the header, this is all that is needed to apply a different
+E-value, FDR cutoff or scaling factor without going back to the bam files
+(see src/rescore_islands.py).
+
+File format: tab separated, first line is the header
+
+    #candidates<TAB>{json dict of parameters}
+
+followed by one line per island
+
+    chrom  start  end  score  [chip  control]
+
+Scores are written with repr() so they are read back exactly.
+"""
+
+import json
+
+HEADER_PREFIX= '#candidates\t'
+
+def write(filename, metadata, rows):
+    """Write the candidate islands. rows are tuples (chrom, start, end, score)
+    or (chrom, start, end, score, chip, control).
+    """
+    fout= open(filename, 'w', 1 << 20)
+    fout.write(HEADER_PREFIX + json.dumps(metadata, sort_keys= True) + '\n')
+    for row in rows:
+        fout.write('\t'.join([row[0], str(row[1]), str(row[2]), repr(row[3])] + [str(x) for x in row[4:]]) + '\n')
+    fout.close()
+    return filename
+
+def read(filename):
+    """Return (metadata, {chrom: [(start, end, score, chip, control)]}).
+    chip and control are None if not in the file. Islands keep the order of
+    the file.
+    """
+    metadata= {}
+    islands= {}
+    fin= open(filename)
+    for line in fin:
+        if line.startswith(HEADER_PREFIX):
+            metadata= json.loads(line[len(HEADER_PREFIX):])
+            continue
+        if line.startswith('#') or line.strip() == '':
+            continue
+        sline= line.rstrip('\n').split('\t')
+        chip, control= None, None
+        if len(sline) >= 6:
+            chip, control= int(sline[4]), int(sline[5])
+        islands.setdefault(sline[0], []).append((int(sline[1]), int(sline[2]), float(sline[3]), chip, control))
+    fin.close()
+    return (metadata, islands)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Balanced scheduling of per-chromosome work over several processes.
+
+Chromosome sizes are very skewed: one task per chromosome leaves most
+processes idle while the largest chromosome is being processed, and
+thousands of small contigs make thousands of tiny tasks. Here the genome is
+cut into tasks of about the same size:
+
+* Chromosomes longer than the chunk size are split in regions of
+  chunk_size bp. Chunk boundaries are multiples of window_size so that a
+  window never straddles two regions.
+* Chromosomes shorter than the chunk size are batched together in one task
+  up to the chunk size.
+* Tasks are ordered largest first and handed to the processes one at a
+  time, so a process that finishes early picks up the next task in the
+  queue and the small tasks fill the gaps at the end.
+
+A task is a list of regions (chrom, start, end), end exclusive. The results
+of the regions of one chromosome are given back in genomic order by
+results_by_chrom. Work that cannot be split within a chromosome can ask
+for whole chromosomes only with split= False. Islands crossing chunk
+boundaries are joined by island_chunks.py.
+"""
+
+import multiprocessing
+
+TASKS_PER_PROC= 4
+MIN_CHUNK_SIZE= 1000000
+
+def chunk_size(chrom_lengths, window_size, nproc, tasks_per_proc= TASKS_PER_PROC, min_chunk_size= MIN_CHUNK_SIZE):
+    """Size in bp of the chunks, a multiple of window_size, giving about
+    tasks_per_proc tasks per process.
+    """
+    genome_length= sum(chrom_lengths.values())
+    size= max(genome_length // max(nproc * tasks_per_proc, 1), min_chunk_size, window_size)
+    return ((size + window_size - 1) // window_size) * window_size
+
+def make_tasks(chroms, chrom_lengths, window_size, nproc, split= True, tasks_per_proc= TASKS_PER_PROC, min_chunk_size= MIN_CHUNK_SIZE):
+    """List of tasks, each a list of regions (chrom, start, end), ordered by
+    decreasing size. If split is False, chromosomes are never split.
+    """
+    size= chunk_size(dict([(x, chrom_lengths[x]) for x in chroms]), window_size, nproc, tasks_per_proc, min_chunk_size)
+    tasks= []
+    batch= []
+    batch_length= 0
+    for chrom in sorted(chroms, key= lambda x: -chrom_lengths[x]):
+        length= chrom_lengths[chrom]
+        if length >= size:
+            if split:
+                for start in xrange(0, length, size):
+                    tasks.append([(chrom, start, min(start + size, length))])
+            else:
+                tasks.append([(chrom, 0, length)])
+            continue
+        if batch_length + length > size:
+            tasks.append(batch)
+            batch= []
+            batch_length= 0
+        batch.append((chrom, 0, length))
+        batch_length += length
+    if len(batch) > 0:
+        tasks.append(batch)
+    tasks.sort(key= lambda x: -task_length(x))
+    return tasks
+
+def task_length(task):
+    return sum([end - start for chrom, start, end in task])
+
+def _run_task(args):
+    func, index, task= args
+    return (index, [func(region) for region in task])
+
+def run_tasks(func, tasks, nproc):
+    """Apply func(region) to every region of tasks using nproc processes.
+    func must be a module level function. Return the results as a list
+    parallel to tasks, each a list parallel to the regions of the task.
+    The pool is started here, so data set up as module globals before
+    calling this function are shared with the workers without being copied.
+    """
+    if nproc <= 1 or len(tasks) <= 1:
+        return [[func(region) for region in task] for task in tasks]
+    results= [None] * len(tasks)
+    pool= multiprocessing.Pool(min(nproc, len(tasks)))
+    try:
+        for index, result in pool.imap_unordered(_run_task, [(func, i, x) for i, x in enumerate(tasks)], chunksize= 1):
+            results[index]= result
+    finally:
+        pool.terminate()
+    return results
+
+def results_by_chrom(tasks, results):
+    """Dict {chrom: [(region, result), ...]} with the regions of each
+    chromosome in genomic order.
+    """
+    by_chrom= {}
+    for task, task_results in zip(tasks, results):
+        for region, result in zip(task, task_results):
+            by_chrom.setdefault(region[0], []).append((region, result))
+    for chrom in by_chrom:
+        by_chrom[chrom].sort(key= lambda x: x[0][1])
+    return by_chrom
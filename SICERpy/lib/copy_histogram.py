@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Histogram of read copies, collected while removing redundant reads.
+
+For each chromosome and strand, the histogram gives the number of distinct
+positions (start and end of the read) found in 1, 2, 3, ... copies, same as
+bed_preprocessing.find_read_copy_distribution but using the read end too, as
+the removal of redundant reads does.
+
+The histogram is written as json if the file name ends in .json, otherwise as
+a tab separated table with columns chrom, strand, copies, positions. Rows
+with chrom '*' and strand '*' give the genome wide histogram.
+"""
+
+import json
+import numpy
+
+class CopyHistogram:
+
+    def __init__(self):
+        self.counts= {} ## Key: (chrom, strand); Value: {copies: number of positions}
+
+    def add(self, chrom, reverse, copies, n= 1):
+        hist= self.counts.setdefault((chrom, '-' if reverse else '+'), {})
+        hist[copies]= hist.get(copies, 0) + n
+
+    def add_array(self, chrom, reverse, copies):
+        """Add an array with the copy number of each position.
+        """
+        values, n= numpy.unique(numpy.asarray(copies), return_counts= True)
+        for c, x in zip(values, n):
+            self.add(chrom, reverse, int(c), int(x))
+
+    def genome_wide(self):
+        total= {}
+        for key in self.counts:
+            for c, n in self.counts[key].items():
+                total[c]= total.get(c, 0) + n
+        return total
+
+    def write(self, filename, chroms= None):
+        """Write histogram to filename. chroms gives the order of the
+        chromosomes, sorted by name if None.
+        """
+        if chroms is None:
+            chroms= sorted(set([x[0] for x in self.counts]))
+        rows= []
+        for chrom in chroms:
+            for strand in ['+', '-']:
+                if (chrom, strand) in self.counts:
+                    rows.append((chrom, strand, self.counts[(chrom, strand)]))
+        rows.append(('*', '*', self.genome_wide()))
+        fout= open(filename, 'w')
+        if filename.endswith('.json'):
+            out= {'chroms': {}, 'total': {}}
+            for chrom, strand, hist in rows:
+                hist= dict([(str(c), n) for c, n in hist.items()])
+                if chrom == '*':
+                    out['total']= hist
+                else:
+                    out['chroms'].setdefault(chrom, {})[strand]= hist
+            json.dump(out, fout, indent= 2, sort_keys= True)
+            fout.write('\n')
+        else:
+            fout.write('\t'.join(['chrom', 'strand', 'copies', 'positions']) + '\n')
+            for chrom, strand, hist in rows:
+                for c in sorted(hist.keys()):
+                    fout.write('\t'.join([chrom, strand, str(c), str(hist[c])]) + '\n')
+        fout.close()
+        return filename
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Matrix of read counts of several libraries on a shared set of islands.
+
+The islands, which must not overlap, are sorted by chromosome and start. For
+each library, the reads whose tag position (see read_library.tag_positions)
+falls on an island are counted, giving a matrix with one row per library
+and one column per island.
+
+Libraries can be bam files, read libraries (.npz) or BED6 files of reads.
+Reads of bam files are filtered by flag and mapping quality as in
+read_library.read_bam and the library size is the number of reads passing
+the filters. Indexed bam files can be read only around the islands
+(read_library.fetch_library). The library size of every bam file, indexed
+or not, is then the number of records, mapped and unmapped, as in
+associate_tags_with_chip_and_control_w_fc_q_bam.py -x: the same only for
+bam files filtered beforehand, e.g. by remove_redundant_reads_bam.py.
+
+The matrix is saved as npz with arrays:
+
+    counts         samples x islands, int64
+    samples        names of the libraries
+    library_sizes  one per library
+    library_size_definition  FILTERED_READS or BAM_RECORDS, how the library
+                   sizes of bam files were counted
+    chroms, starts, ends   coordinates of the islands, ends inclusive
+
+and optionally as a tab separated table with one line per island: chrom,
+start, end and the count of each library.
+"""
+
+import os
+import numpy
+import pysam
+
+import read_library
+
+## Library sizes of bam files: reads passing the filters or all the records
+FILTERED_READS= 'filtered_reads'
+BAM_RECORDS= 'bam_records'
+
+class CountMatrix:
+
+    def __init__(self, samples, library_sizes, chroms, starts, ends, counts, library_size_definition= FILTERED_READS):
+        self.samples= list(samples)
+        self.library_sizes= numpy.asarray(library_sizes, dtype= numpy.int64)
+        self.chroms= numpy.asarray(chroms, dtype= str)
+        self.starts= numpy.asarray(starts, dtype= numpy.int64)
+        self.ends= numpy.asarray(ends, dtype= numpy.int64)
+        self.counts= numpy.asarray(counts, dtype= numpy.int64)
+        self.library_size_definition= library_size_definition
+
+    def save(self, filename):
+        fout= open(filename, 'wb')
+        numpy.savez_compressed(fout, samples= numpy.array(self.samples, dtype= str), library_sizes= self.library_sizes,
+            library_size_definition= numpy.array(self.library_size_definition, dtype= str),
+            chroms= self.chroms, starts= self.starts, ends= self.ends, counts= self.counts)
+        fout.close()
+        return filename
+
+    def write_table(self, filename):
+        fout= open(filename, 'w', 1 << 20)
+        fout.write('\t'.join(['#chrom', 'start', 'end'] + self.samples) + '\n')
+        counts= self.counts.T.astype(str)
+        for i in xrange(len(self.starts)):
+            fout.write(self.chroms[i] + '\t' + str(self.starts[i]) + '\t' + str(self.ends[i]) + '\t' + '\t'.join(counts[i]) + '\n')
+        fout.close()
+        return filename
+
+def load(filename):
+    npz= numpy.load(filename)
+    ## Matrices saved before the definition was recorded have filtered sizes
+    definition= str(npz['library_size_definition']) if 'library_size_definition' in npz.files else FILTERED_READS
+    matrix= CountMatrix([str(x) for x in npz['samples']], npz['library_sizes'], npz['chroms'], npz['starts'], npz['ends'], npz['counts'],
+        library_size_definition= definition)
+    npz.close()
+    return matrix
+
+def is_indexed_bam(readfile):
+    if not readfile.endswith('.bam'):
+        return False
+    inBam= pysam.AlignmentFile(readfile)
+    indexed= inBam.has_index()
+    inBam.close()
+    return indexed
+
+def count_reads(readfile, regions, fragment_size, requiredFlag= 0, filterFlag= 0, mapq= 0, fetch= False):
+    """Count the reads of readfile on the islands in regions, a dict {chrom:
+    (sorted starts, ends)}. Reads of bam files are filtered with requiredFlag,
+    filterFlag and mapq. The library size of bam files is the number of
+    reads passing the filters or, with fetch, the number of records, see
+    library_size_definition. With fetch, indexed bam files are read only
+    around the islands. Return (library size, {chrom: counts}).
+    """
+    if read_library.is_library_file(readfile):
+        library= read_library.load(readfile)
+    elif fetch and is_indexed_bam(readfile):
+        library= read_library.fetch_library(readfile, regions, fragment_size, requiredFlag= requiredFlag, filterFlag= filterFlag, mapq= mapq)
+        library.library_size= read_library.index_library_size(readfile)
+    elif readfile.endswith('.bam'):
+        ## read_bam sets the library size to the number of records
+        library= read_library.read_bam(readfile, requiredFlag, filterFlag, mapq)
+        if not fetch:
+            library.library_size= library.number_of_reads()
+    else:
+        library= read_library.read_bed_file(readfile)
+    counts= {}
+    for chrom in regions:
+        positions= read_library.tag_positions(library, chrom, fragment_size)
+        counts[chrom]= read_library.count_tags_on_islands(positions, regions[chrom][0], regions[chrom][1])
+    return (library.size(), counts)
+
+def sample_name(readfile):
+    name= os.path.basename(readfile)
+    for ext in ['.bam', read_library.LIBRARY_EXTENSION]:
+        if name.endswith(ext):
+            name= name[:-len(ext)]
+    return name
+
+def library_size_definition(fetch= False):
+    """How count_reads counts the library size of bam files, with or without
+    fetch.
+    """
+    return BAM_RECORDS if fetch else FILTERED_READS
+
+def make_matrix(readfiles, regions, results, samples= None, fetch= False):
+    """CountMatrix from the results of count_reads, called with fetch, for
+    each of readfiles. Islands are ordered by chromosome name and start.
+    """
+    chroms= sorted(regions.keys())
+    island_chroms= []
+    for chrom in chroms:
+        island_chroms.extend([chrom] * len(regions[chrom][0]))
+    starts= numpy.concatenate([numpy.asarray(regions[x][0], dtype= numpy.int64) for x in chroms]) if chroms else []
+    ends= numpy.concatenate([numpy.asarray(regions[x][1], dtype= numpy.int64) for x in chroms]) if chroms else []
+    counts= numpy.zeros((len(readfiles), len(starts)), dtype= numpy.int64)
+    for i, (size, chrom_counts) in enumerate(results):
+        if chroms:
+            counts[i]= numpy.concatenate([chrom_counts[x] for x in chroms])
+    if samples is None:
+        samples= [sample_name(x) for x in readfiles]
+    return CountMatrix(samples, [x[0] for x in results], island_chroms, starts, ends, counts,
+        library_size_definition= library_size_definition(fetch))
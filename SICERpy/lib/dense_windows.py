@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Dense, memory-mapped window counts.
+
+The summary graph written by make_graph_file is sparse text: only the windows
+with tags are listed. The same information can be stored as one uint32 count
+per window for every chromosome, all the chromosomes concatenated in a single
+binary file:
+
+    magic        8 bytes, 'SICERWC1'
+    header_size  8 bytes, little endian uint64
+    header       json: window_size, chroms, lengths (chromosome lengths),
+                 offsets (index of the first window of each chromosome in
+                 the count vector, plus the total number of windows)
+    padding      to a multiple of 8 bytes
+    counts       little endian uint32, one per window
+
+Chromosome chrom has chrom_length // window_size windows, i.e. windows going
+beyond the end of the chromosome are discarded as in
+make_graph_file.Generate_windows_and_count_tags. The counts are read with
+numpy.memmap so accessing one chromosome does not read the whole file.
+"""
+
+import json
+import struct
+import numpy
+
+import BED
+import read_library
+
+MAGIC= 'SICERWC1'
+COUNT_DTYPE= numpy.dtype('<u4')
+
+def is_dense_file(filename):
+    """True if filename starts with the magic string of dense window counts.
+    """
+    fin= open(filename, 'rb')
+    magic= fin.read(len(MAGIC))
+    fin.close()
+    return magic == MAGIC
+
+def number_of_windows(chrom_length, window_size):
+    return chrom_length // window_size
+
+def count_windows(positions, chrom_length, window_size):
+    """Dense vector of tag counts in the windows of chrom. positions as given
+    by read_library.graph_tag_positions.
+    """
+    n= number_of_windows(chrom_length, window_size)
+    bins= numpy.asarray(positions) // window_size
+    bins= bins[bins < n]
+    return numpy.bincount(bins, minlength= n).astype(COUNT_DTYPE)
+
+def count_windows_in_region(positions, chrom_length, window_size, start, end):
+    """Dense vector of tag counts in the windows of chrom from start to end,
+    both multiples of window_size or end equal to chrom_length. Concatenating
+    the counts of consecutive regions gives count_windows of the chromosome.
+    positions need not be sorted.
+    """
+    first= start // window_size
+    n= min(end // window_size, number_of_windows(chrom_length, window_size)) - first
+    bins= numpy.asarray(positions) // window_size - first
+    bins= bins[(bins >= 0) & (bins < n)]
+    return numpy.bincount(bins, minlength= max(n, 0)).astype(COUNT_DTYPE)
+
+def write(filename, window_size, chroms, chrom_lengths, get_counts):
+    """Write dense window counts to filename. get_counts(chrom) must return the
+    vector of counts of chrom, of length chrom_length // window_size.
+    Chromosomes are written one at a time.
+    """
+    offsets= [0]
+    for chrom in chroms:
+        offsets.append(offsets[-1] + number_of_windows(chrom_lengths[chrom], window_size))
+    header= json.dumps({'window_size': window_size,
+                        'chroms': list(chroms),
+                        'lengths': [chrom_lengths[x] for x in chroms],
+                        'offsets': offsets})
+    header += ' ' * (-(len(MAGIC) + 8 + len(header)) % 8)
+    fout= open(filename, 'wb')
+    fout.write(MAGIC)
+    fout.write(struct.pack('<Q', len(header)))
+    fout.write(header)
+    for i, chrom in enumerate(chroms):
+        counts= numpy.asarray(get_counts(chrom), dtype= COUNT_DTYPE)
+        if len(counts) != offsets[i+1] - offsets[i]:
+            raise ValueError('Expected %s windows for %s, got %s' %(offsets[i+1] - offsets[i], chrom, len(counts)))
+        counts.tofile(fout)
+    fout.close()
+    return filename
+
+def write_from_library(filename, library, fragment_size, window_size):
+    """Count the tags of a read_library.ReadLibrary in windows and write them
+    to filename.
+    """
+    def get_counts(chrom):
+        positions= read_library.graph_tag_positions(library, chrom, fragment_size)
+        return count_windows(positions, library.chrom_lengths[chrom], window_size)
+    return write(filename, window_size, library.chroms, library.chrom_lengths, get_counts)
+
+class DenseWindows:
+    """
+    Window counts read from a file written by write(). The counts of each
+    chromosome are views on the memory-mapped file.
+    """
+    def __init__(self, filename):
+        fin= open(filename, 'rb')
+        magic= fin.read(len(MAGIC))
+        if magic != MAGIC:
+            fin.close()
+            raise ValueError('%s is not a file of dense window counts' %(filename))
+        header_size= struct.unpack('<Q', fin.read(8))[0]
+        header= json.loads(fin.read(header_size))
+        fin.close()
+        self.filename= filename
+        self.window_size= header['window_size']
+        self.chroms= [str(x) for x in header['chroms']]
+        self.chrom_lengths= dict(zip(self.chroms, header['lengths']))
+        self.offsets= dict(zip(self.chroms, zip(header['offsets'][:-1], header['offsets'][1:])))
+        nwindows= header['offsets'][-1]
+        if nwindows > 0:
+            self.counts= numpy.memmap(filename, dtype= COUNT_DTYPE, mode= 'r',
+                offset= len(MAGIC) + 8 + header_size, shape= (nwindows,))
+        else:
+            self.counts= numpy.zeros(0, dtype= COUNT_DTYPE)
+
+    def get(self, chrom):
+        """Vector of counts of chrom, window i starts at i * window_size.
+        Empty if chrom is not in the file.
+        """
+        if chrom not in self.offsets:
+            return numpy.zeros(0, dtype= COUNT_DTYPE)
+        a, b= self.offsets[chrom]
+        return self.counts[a:b]
+
+    def nonzero(self, chrom):
+        """(window starts, counts) of the windows of chrom with tags, as in
+        the summary graph.
+        """
+        counts= self.get(chrom)
+        index= numpy.flatnonzero(counts)
+        return (index * self.window_size, counts[index])
+
+    def total(self):
+        """Total tag count, same as get_total_tag_counts_bed_graph on the
+        summary graph.
+        """
+        return float(self.counts.sum(dtype= numpy.uint64))
+
+    def to_bed_graph(self, chroms= None):
+        """Windows with tags as dict {chrom: [BED.BED_GRAPH]}, the same as
+        reading the summary graph with BED.BED(chroms, file, "BED_GRAPH").
+        """
+        bed_val= {}
+        for chrom in (chroms if chroms is not None else self.chroms):
+            window_starts, counts= self.nonzero(chrom)
+            if len(counts) > 0:
+                bed_val[chrom]= [BED.BED_GRAPH(chrom, int(s), int(s) + self.window_size - 1, float(c)) for s, c in zip(window_starts, counts)]
+        return bed_val
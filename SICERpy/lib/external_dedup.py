@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+"""
+Removal of redundant reads with bounded memory.
+
+A read is redundant if more than `cutoff` reads have the same chromosome,
+strand, start and end. This is what remove_redundant_reads_bam.py does with
+one bed file per chromosome and `sort`. Here instead the reads are taken
+from the bam file in chunks that fit in the memory budget; each chunk is
+sorted by (chromosome, strand, start, end) with numpy and, unless the whole
+library fits in one chunk, spilled to disk as a binary run (.npy). The runs
+are then merged block by block: at each step all the reads not greater than
+the smallest of the last keys of the current blocks are sorted together and
+the copies of each key are counted, carrying the count of the last key over
+to the next step. Memory is bounded by the chunk size during the first pass
+and by the block size, about the same, during the merge.
+
+Reads with the same key are retained in the order they appear in the bam
+file.
+
+If the bam file is sorted by coordinate (SO:coordinate in the header) no sort
+is needed: stream_dedup_bam() reads the file once and keeps only the copy
+counts of the reads starting at the current position.
+
+Both functions can collect the histogram of read copies (see
+copy_histogram.py) on the way.
+"""
+
+import os
+import sys
+import tempfile
+import numpy
+import pysam
+
+import read_library
+import prefetch_reader
+
+## Rough number of bytes used by one read while a chunk is collected: python
+## string for the read name and array entries. The budget is divided by this
+## to get the number of reads per chunk.
+BYTES_PER_READ= 120
+
+def encode_keys(tid, reverse, start):
+    """Pack chromosome index, strand and start in one sortable uint64. The
+    read end is kept as a second key.
+    """
+    return (numpy.asarray(tid, dtype= numpy.uint64) << numpy.uint64(33)) | \
+           (numpy.asarray(reverse, dtype= numpy.uint64) << numpy.uint64(32)) | \
+            numpy.asarray(start, dtype= numpy.uint64)
+
+def decode_keys(hi):
+    """Inverse of encode_keys: return (tid, reverse, start)
+    """
+    tid= (hi >> numpy.uint64(33)).astype(numpy.int64)
+    reverse= ((hi >> numpy.uint64(32)) & numpy.uint64(1)).astype(bool)
+    start= (hi & numpy.uint64(0xffffffff)).astype(numpy.int64)
+    return (tid, reverse, start)
+
+def run_dtype(name_width):
+    """Records of the sorted runs. n is the number of copies of the key in
+    the chunk, set on the first copy only.
+    """
+    return numpy.dtype([('hi', '<u8'), ('lo', '<u4'), ('n', '<u4'), ('name', 'S%s' %(max(1, name_width)))])
+
+def sort_records(records):
+    """Stable sort of records by (hi, lo)
+    """
+    return records[numpy.lexsort((records['lo'], records['hi']))]
+
+def key_starts(hi, lo):
+    """Index of the first record of each key in records sorted by (hi, lo)
+    """
+    n= len(hi)
+    new_key= numpy.ones(n, dtype= bool)
+    new_key[1:]= (hi[1:] != hi[:-1]) | (lo[1:] != lo[:-1])
+    return numpy.flatnonzero(new_key)
+
+def copy_rank(hi, lo, last_key= None, last_count= 0):
+    """For records sorted by (hi, lo) return the rank of each record among the
+    records with the same key, 0 for the first copy. If the first key is
+    last_key, its ranks start at last_count.
+    """
+    n= len(hi)
+    if n == 0:
+        return numpy.zeros(0, dtype= numpy.int64)
+    new_key= numpy.ones(n, dtype= bool)
+    new_key[1:]= (hi[1:] != hi[:-1]) | (lo[1:] != lo[:-1])
+    group_start= numpy.maximum.accumulate(numpy.where(new_key, numpy.arange(n), 0))
+    rank= numpy.arange(n) - group_start
+    if last_key is not None and (hi[0], lo[0]) == last_key:
+        rank[group_start == 0] += last_count
+    return rank
+
+def make_chunk(tid, reverse, start, end, names, cutoff):
+    """Sorted chunk of records with at most cutoff copies of each key.
+    """
+    width= max([len(x) for x in names]) if names else 1
+    records= numpy.empty(len(names), dtype= run_dtype(width))
+    records['hi']= encode_keys(tid, reverse, start)
+    records['lo']= end
+    records['name']= names
+    records= sort_records(records)
+    records['n']= 0
+    if len(records) > 0:
+        starts= key_starts(records['hi'], records['lo'])
+        records['n'][starts]= numpy.diff(numpy.append(starts, len(records)))
+    return records[copy_rank(records['hi'], records['lo']) < cutoff]
+
+class ChunkCollector:
+    """Collect batches of reads and turn them into sorted chunks.
+    """
+    def __init__(self):
+        self.batches= []
+        self.n= 0
+
+    def add(self, batch):
+        self.batches.append(batch)
+        self.n += len(batch)
+
+    def __len__(self):
+        return self.n
+
+    def chunk(self, cutoff):
+        if self.n == 0:
+            return make_chunk([], [], [], [], [], cutoff)
+        names= []
+        for batch in self.batches:
+            names.extend(batch.names)
+        return make_chunk(numpy.concatenate([x.tid for x in self.batches]), numpy.concatenate([x.reverse for x in self.batches]),
+            numpy.concatenate([x.start for x in self.batches]), numpy.concatenate([x.end for x in self.batches]), names, cutoff)
+
+def add_totals(totals, batch):
+    """Add the number of reads in batch by (tid, reverse) to totals
+    """
+    for t, r in set(zip(batch.tid.tolist(), batch.reverse.tolist())):
+        totals[(t, r)]= totals.get((t, r), 0) + int(numpy.sum((batch.tid == t) & (batch.reverse == r)))
+
+def sorted_runs(batches, cutoff, chunk_size, tmpdir):
+    """Split the reads, given in batches (see prefetch_reader.py), in sorted
+    chunks of about chunk_size reads. Chunks are written to tmpdir unless all
+    the reads fit in one chunk.
+    Return (list of runs, number of reads per (tid, reverse)) where runs are
+    arrays or memory-mapped arrays.
+    """
+    runs= []
+    totals= {}
+    def spill(chunk):
+        fname= os.path.join(tmpdir, 'run.%s.npy' %(len(runs)))
+        numpy.save(fname, chunk)
+        return numpy.load(fname, mmap_mode= 'r')
+    collector= ChunkCollector()
+    for batch in batches:
+        add_totals(totals, batch)
+        collector.add(batch)
+        if len(collector) >= chunk_size:
+            runs.append(spill(collector.chunk(cutoff)))
+            collector= ChunkCollector()
+    if len(runs) == 0:
+        ## Everything fits in memory
+        runs.append(collector.chunk(cutoff))
+    elif len(collector) > 0:
+        runs.append(spill(collector.chunk(cutoff)))
+    return (runs, totals)
+
+def merge_runs(runs, cutoff, block_size, on_copies= None):
+    """Merge the sorted runs and yield blocks of sorted records with at most
+    cutoff copies of each key. If given, on_copies(hi, copies) is called with
+    the keys and total number of copies as soon as all the copies of the keys
+    have been seen.
+    """
+    pos= [0] * len(runs)
+    blocks= [runs[i][0:0] for i in range(len(runs))]
+    width= max([r.dtype['name'].itemsize for r in runs])
+    dtype= run_dtype(width)
+    last_key= None
+    last_count= 0
+    last_copies= 0
+    while True:
+        for i in range(len(runs)):
+            if len(blocks[i]) == 0 and pos[i] < len(runs[i]):
+                blocks[i]= numpy.array(runs[i][pos[i]:pos[i] + block_size])
+                pos[i] += len(blocks[i])
+        active= [i for i in range(len(runs)) if len(blocks[i]) > 0]
+        if len(active) == 0:
+            if on_copies is not None and last_key is not None:
+                on_copies(numpy.array([last_key[0]], dtype= numpy.uint64), numpy.array([last_copies]))
+            break
+        limit= min([(blocks[i]['hi'][-1], blocks[i]['lo'][-1]) for i in active])
+        pieces= []
+        for i in active:
+            b= blocks[i]
+            a= numpy.searchsorted(b['hi'], limit[0], side= 'left')
+            z= numpy.searchsorted(b['hi'], limit[0], side= 'right')
+            n= a + numpy.searchsorted(b['lo'][a:z], limit[1], side= 'right')
+            pieces.append(b[:n].astype(dtype))
+            blocks[i]= b[n:]
+        merged= sort_records(numpy.concatenate(pieces))
+        rank= copy_rank(merged['hi'], merged['lo'], last_key, last_count)
+        if on_copies is not None:
+            starts= key_starts(merged['hi'], merged['lo'])
+            copies= numpy.add.reduceat(merged['n'].astype(numpy.int64), starts)
+            if last_key is not None and (merged['hi'][0], merged['lo'][0]) == last_key:
+                copies[0] += last_copies
+            elif last_key is not None:
+                on_copies(numpy.array([last_key[0]], dtype= numpy.uint64), numpy.array([last_copies]))
+            ## The last key may have more copies in the next blocks
+            on_copies(merged['hi'][starts[:-1]], copies[:-1])
+            last_copies= copies[-1]
+        last_key= (merged['hi'][-1], merged['lo'][-1])
+        last_count= rank[-1] + 1
+        yield merged[rank < cutoff]
+
+class RetainedReads:
+    """Write the retained reads to a bam file and, optionally, collect them
+    in a read library. The reads are given in blocks of arrays.
+    """
+    def __init__(self, inBam, out_bam, library_file= None):
+        self.chroms= list(inBam.references)
+        self.chrom_lengths= dict(zip(self.chroms, inBam.lengths))
+        self.outfile= pysam.AlignmentFile(out_bam, 'wb', template= inBam)
+        self.library_file= library_file
+        self.retained= {}
+        self.lib_reads= {}
+
+    def write(self, tid, reverse, start, end, names):
+        for i in xrange(len(names)):
+            aln= pysam.AlignedSegment()
+            aln.query_name= str(names[i])
+            aln.reference_id= int(tid[i])
+            aln.reference_start= int(start[i])
+            aln.cigarstring= str(int(end[i]) - int(start[i])) + 'M'
+            aln.is_reverse= bool(reverse[i])
+            self.outfile.write(aln)
+        for t in numpy.unique(tid):
+            x= tid == t
+            for r in [False, True]:
+                self.retained[(t, r)]= self.retained.get((t, r), 0) + int(numpy.sum(reverse[x] == r))
+            if self.library_file:
+                self.lib_reads.setdefault(t, []).append((start[x], end[x], reverse[x]))
+
+    def close(self):
+        self.outfile.close()
+        if self.library_file:
+            lib= read_library.ReadLibrary(self.chroms, self.chrom_lengths)
+            for t in self.lib_reads:
+                blocks= self.lib_reads[t]
+                lib.add(self.chroms[t], numpy.concatenate([x[0] for x in blocks]),
+                    numpy.concatenate([x[1] for x in blocks]), numpy.concatenate([x[2] for x in blocks]))
+            lib.save(self.library_file)
+
+    def stats(self, totals):
+        """Dict {(chrom, is_reverse): (total reads, retained reads)} given
+        the totals by (tid, is_reverse)
+        """
+        stats= {}
+        for t, r in totals:
+            stats[(self.chroms[t], r)]= (totals[(t, r)], self.retained.get((t, r), 0))
+        return stats
+
+def dedup_bam(bam, out_bam, cutoff, max_memory, tmpdir= None, requiredFlag= 0, filterFlag= 0, mapq= 0, library_file= None, histogram= None):
+    """Filter reads in bam and keep at most cutoff reads with the same
+    position and strand. max_memory is the memory budget in bytes.
+    Retained reads are written to out_bam and, optionally, to library_file
+    as read_library.ReadLibrary. The copies of each position are added to
+    histogram, a copy_histogram.CopyHistogram, if given.
+    Return dict {(chrom, is_reverse): (total reads, retained reads)}
+    """
+    chunk_size= max(1000, int(max_memory / BYTES_PER_READ))
+    rundir= tempfile.mkdtemp(prefix= 'tmp_dedup_', dir= tmpdir)
+    inBam= pysam.AlignmentFile(bam)
+    out= RetainedReads(inBam, out_bam, library_file)
+    reader= prefetch_reader.PrefetchReader(bam, requiredFlag, filterFlag, mapq, names= True,
+        batch_size= min(prefetch_reader.BATCH_SIZE, chunk_size))
+    try:
+        (runs, totals)= sorted_runs(reader, cutoff, chunk_size, rundir)
+        sys.stderr.write('%s reads sorted in %s run(s)\n' %(sum(totals.values()), len(runs)))
+        on_copies= None
+        if histogram is not None:
+            def on_copies(hi, copies):
+                tid, reverse, start= decode_keys(hi)
+                for t, r in set(zip(tid, reverse)):
+                    x= (tid == t) & (reverse == r)
+                    histogram.add_array(out.chroms[t], r, copies[x])
+        for block in merge_runs(runs, cutoff, max(1, chunk_size // len(runs)), on_copies):
+            tid, reverse, start= decode_keys(block['hi'])
+            out.write(tid, reverse, start, block['lo'].astype(numpy.int64), block['name'])
+        del runs
+    finally:
+        inBam.close()
+        for x in os.listdir(rundir):
+            os.remove(os.path.join(rundir, x))
+        os.rmdir(rundir)
+    out.close()
+    return out.stats(totals)
+
+def is_coordinate_sorted(inBam):
+    """True if the header of inBam declares SO:coordinate
+    """
+    header= inBam.header
+    if hasattr(header, 'to_dict'):
+        header= header.to_dict()
+    return header.get('HD', {}).get('SO') == 'coordinate'
+
+def stream_dedup_bam(bam, out_bam, cutoff, requiredFlag= 0, filterFlag= 0, mapq= 0, library_file= None, histogram= None):
+    """Same as dedup_bam() for a bam file sorted by coordinate, in a single
+    pass. Memory is proportional to the number of reads starting at the same
+    position. Raise ValueError if the reads turn out not to be sorted.
+    """
+    inBam= pysam.AlignmentFile(bam)
+    out= RetainedReads(inBam, out_bam, library_file)
+    totals= {}
+    current= (-1, -1)
+    copies= {} ## Key: (end, is_reverse) of the reads starting at current position; Value: count
+    try:
+        for batch in prefetch_reader.PrefetchReader(bam, requiredFlag, filterFlag, mapq, names= True):
+            add_totals(totals, batch)
+            keep= numpy.zeros(len(batch), dtype= bool)
+            for i, (tid, start, end, reverse) in enumerate(zip(batch.tid.tolist(), batch.start.tolist(), batch.end.tolist(), batch.reverse.tolist())):
+                position= (tid, start)
+                if position != current:
+                    if position < current:
+                        raise ValueError('%s is not sorted by coordinate: %s:%s after %s:%s' %(bam,
+                            out.chroms[tid], start, out.chroms[current[0]], current[1]))
+                    if histogram is not None:
+                        for (e, r), n in copies.items():
+                            histogram.add(out.chroms[current[0]], r, n)
+                    current= position
+                    copies= {}
+                copy= (end, reverse)
+                copies[copy]= copies.get(copy, 0) + 1
+                keep[i]= copies[copy] <= cutoff
+            retained= batch.subset(keep)
+            out.write(retained.tid, retained.reverse, retained.start, retained.end, retained.names)
+        if histogram is not None:
+            for (e, r), n in copies.items():
+                histogram.add(out.chroms[current[0]], r, n)
+    finally:
+        inBam.close()
+    out.close()
+    return out.stats(totals)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Island calling on chunks of a chromosome.
+
+Islands are made by joining eligible windows closer than gap +
+window_size_buffer (find_islands_in_pr.combine_proximal_islands). If a
+chromosome is cut into chunks, an island can cross a chunk boundary: the
+last island of a chunk and the first island of the next chunk must be joined
+if they are close enough. IslandChunk holds the islands of one chunk, or of
+consecutive chunks already merged, in a form that can be merged with the
+next chunk:
+
+* All the islands, with start, end and score.
+* The scores of the single windows of the first island. Island scores are
+  the sum of the window scores added one at a time from the left, so the
+  windows of the first island are needed to give, after merging, exactly
+  the same score as joining the whole chromosome at once.
+
+The last island can be extended on the right by just adding window scores to
+its score. Islands other than the first and the last are never changed by a
+merge. The score threshold is applied only after all the chunks of a
+chromosome have been merged (IslandChunk.islands).
+"""
+
+import numpy
+
+class IslandChunk:
+    """
+    Islands of the chunk of chrom from start to end (end exclusive). starts,
+    ends: arrays of island coordinates, ends inclusive as in BED_GRAPH;
+    scores: list of island scores; first_scores: list of the window scores of
+    the first island.
+    """
+    def __init__(self, chrom, start, end, starts, ends, scores, first_scores):
+        self.chrom= chrom
+        self.start= start
+        self.end= end
+        self.starts= numpy.asarray(starts, dtype= numpy.int64)
+        self.ends= numpy.asarray(ends, dtype= numpy.int64)
+        self.scores= list(scores)
+        self.first_scores= list(first_scores)
+
+    def merge(self, other, gap, window_size_buffer= 2):
+        """Return the IslandChunk of this chunk followed by other, which must
+        start where this chunk ends.
+        """
+        if other.start != self.end or other.chrom != self.chrom:
+            raise ValueError('Chunks %s:%s-%s and %s:%s-%s are not consecutive' %(self.chrom, self.start, self.end, other.chrom, other.start, other.end))
+        if len(self.scores) == 0:
+            return IslandChunk(self.chrom, self.start, other.end, other.starts, other.ends, other.scores, other.first_scores)
+        if len(other.scores) == 0:
+            return IslandChunk(self.chrom, self.start, other.end, self.starts, self.ends, self.scores, self.first_scores)
+        if other.starts[0] - self.ends[-1] > gap + window_size_buffer:
+            return IslandChunk(self.chrom, self.start, other.end,
+                numpy.concatenate((self.starts, other.starts)), numpy.concatenate((self.ends, other.ends)),
+                self.scores + other.scores, self.first_scores)
+        ## Join the last island of self with the first island of other
+        score= self.scores[-1]
+        for x in other.first_scores:
+            score += x
+        first_scores= self.first_scores
+        if len(self.scores) == 1:
+            first_scores= first_scores + other.first_scores
+        return IslandChunk(self.chrom, self.start, other.end,
+            numpy.concatenate((self.starts, other.starts[1:])),
+            numpy.concatenate((self.ends[:-1], other.ends)),
+            self.scores[:-1] + [score] + other.scores[1:], first_scores)
+
+    def islands(self, score_threshold):
+        """(island starts, island ends, island scores) of the islands with
+        score above score_threshold.
+        """
+        keep= [i for i, v in enumerate(self.scores) if v >= (score_threshold-.0000000001)]
+        return (self.starts[keep], self.ends[keep], [self.scores[i] for i in keep])
+
+def join_windows(chrom, start, end, window_starts, scores, window_size, gap, window_size_buffer= 2):
+    """IslandChunk of the chunk of chrom from start to end given the sorted
+    starts and the scores of its eligible windows.
+    """
+    window_starts= numpy.asarray(window_starts, dtype= numpy.int64)
+    if len(window_starts) == 0:
+        return IslandChunk(chrom, start, end, [], [], [], [])
+    dist= window_starts[1:] - (window_starts[:-1] + window_size - 1)
+    first= numpy.concatenate(([0], numpy.flatnonzero(dist > gap + window_size_buffer) + 1))
+    last= numpy.concatenate((first[1:], [len(window_starts)]))
+    ## Add the scores window by window as combine_proximal_islands does, so
+    ## the island scores are exactly the same
+    scores= list(scores)
+    island_scores= [sum(scores[a:b]) for a, b in zip(first.tolist(), last.tolist())]
+    return IslandChunk(chrom, start, end, window_starts[first], window_starts[last - 1] + window_size - 1,
+        island_scores, scores[first[0]:last[0]])
+
+def reduce_chunks(chunks, gap, window_size_buffer= 2):
+    """Merge the IslandChunks of one chromosome, given in genomic order.
+    """
+    merged= chunks[0]
+    for chunk in chunks[1:]:
+        merged= merged.merge(chunk, gap, window_size_buffer)
+    return merged
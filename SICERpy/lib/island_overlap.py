@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+In-memory overlap of island sets with sorted arrays.
+
+An IslandSet holds, for each chromosome, the islands sorted by start as
+arrays of starts and ends. As in region_overlap of find_overlapped_islands.py
+islands [s1, e1] and [s2, e2] overlap if s2 < e1 and e2 > s1, i.e. islands
+only touching at an end do not overlap.
+
+For island [s, e] of one set, the number of islands of another set
+overlapping it is
+
+    (number of islands with start < e) - (number of islands with end <= s)
+
+since an island ending at or before s also starts before e, unless both
+islands are the same single position; those are added back. Both terms are
+given by numpy.searchsorted on the sorted starts and the sorted ends of the other set,
+so comparing two sets is one vectorized pass per chromosome and a set loaded
+once can be compared with any number of others.
+"""
+
+import gzip
+import numpy
+
+class IslandSet:
+    """
+    islands: dict {chrom: (starts, ends)}. lines: optional dict {chrom: list
+    of the input lines}, parallel to starts and ends.
+    """
+    def __init__(self, islands, lines= None):
+        self.starts= {}
+        self.ends= {}
+        self.sorted_ends= {}
+        self.lines= {} if lines is not None else None
+        for chrom in islands:
+            starts= numpy.asarray(islands[chrom][0], dtype= numpy.int64)
+            ends= numpy.asarray(islands[chrom][1], dtype= numpy.int64)
+            order= numpy.argsort(starts, kind= 'mergesort')
+            self.starts[chrom]= starts[order]
+            self.ends[chrom]= ends[order]
+            self.sorted_ends[chrom]= numpy.sort(ends)
+            if lines is not None:
+                self.lines[chrom]= [lines[chrom][i] for i in order]
+
+    def chroms(self):
+        return sorted(self.starts.keys())
+
+    def __len__(self):
+        return sum([len(x) for x in self.starts.values()])
+
+    def union(self):
+        """IslandSet of the union of the islands, as union_islands of
+        find_overlapped_islands.py: islands overlapping or touching at an end
+        are merged.
+        """
+        islands= {}
+        for chrom in self.starts:
+            starts= self.starts[chrom]
+            if len(starts) == 0:
+                continue
+            ends= numpy.maximum.accumulate(self.ends[chrom])
+            first= numpy.concatenate(([True], starts[1:] > ends[:-1]))
+            last= numpy.concatenate((first[1:], [True]))
+            islands[chrom]= (starts[first], ends[last])
+        return IslandSet(islands)
+
+    def overlap_counts(self, other):
+        """Dict {chrom: number of islands of other overlapping each island of
+        this set}.
+        """
+        counts= {}
+        for chrom in self.starts:
+            counts[chrom]= other.count_overlapping(chrom, self.starts[chrom], self.ends[chrom])
+        return counts
+
+    def count_overlapping(self, chrom, starts, ends):
+        """Number of islands of this set overlapping each island [starts[i],
+        ends[i]] of chrom, in any order.
+        """
+        starts= numpy.asarray(starts, dtype= numpy.int64)
+        ends= numpy.asarray(ends, dtype= numpy.int64)
+        if chrom not in self.starts:
+            return numpy.zeros(len(starts), dtype= numpy.int64)
+        counts= numpy.searchsorted(self.starts[chrom], ends, side= 'left') - \
+                numpy.searchsorted(self.sorted_ends[chrom], starts, side= 'right')
+        points= self.starts[chrom][self.starts[chrom] == self.ends[chrom]]
+        single= numpy.flatnonzero(starts == ends)
+        if len(points) > 0 and len(single) > 0:
+            counts[single] += numpy.searchsorted(points, starts[single], side= 'right') - \
+                              numpy.searchsorted(points, starts[single], side= 'left')
+        return counts
+
+    def overlaps(self, other):
+        """Dict {chrom: True for the islands of this set overlapping at least
+        one island of other}.
+        """
+        counts= self.overlap_counts(other)
+        return dict([(chrom, counts[chrom] > 0) for chrom in counts])
+
+    def number_overlapping(self, other):
+        """Number of islands of this set overlapping at least one island of
+        other.
+        """
+        return int(sum([x.sum() for x in self.overlaps(other).values()]))
+
+def open_islands(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename)
+    return open(filename)
+
+def read(filename, keep_lines= False):
+    """IslandSet from a bed file of islands, e.g. the output of SICER.py,
+    possibly gzip'd. Only the first three columns are used. Lines starting with
+    '#' or 'track' are skipped.
+    """
+    starts= {}
+    ends= {}
+    lines= {} if keep_lines else None
+    fin= open_islands(filename)
+    for line in fin:
+        if line.startswith('#') or line.startswith('track') or line.strip() == '':
+            continue
+        sline= line.split()
+        chrom= sline[0]
+        if chrom not in starts:
+            starts[chrom]= []
+            ends[chrom]= []
+            if keep_lines:
+                lines[chrom]= []
+        starts[chrom].append(int(sline[1]))
+        ends[chrom].append(int(sline[2]))
+        if keep_lines:
+            lines[chrom].append(line)
+    fin.close()
+    return IslandSet(dict([(x, (starts[x], ends[x])) for x in starts]), lines)
+
+def overlap_matrix(island_sets):
+    """Matrix with the number of islands of set i overlapping at least one
+    island of set j.
+    """
+    n= len(island_sets)
+    matrix= numpy.zeros((n, n), dtype= numpy.int64)
+    for i in xrange(n):
+        for j in xrange(n):
+            matrix[i, j]= island_sets[i].number_overlapping(island_sets[j])
+    return matrix
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Summary statistics of a set of islands, computed in one vectorized pass from
+arrays of island starts, ends (inclusive) and scores:
+
+* length histogram: number of islands by length, end - start + 1
+* score histogram: number of islands by score, bin i is [i * bin_size,
+  (i + 1) * bin_size). Scores must be >= 0, as the island scores are
+* total length and score, fraction of the genome covered by the islands
+* quantiles of lengths and scores
+
+The histograms are written in the formats of islands_statistics_pr.py, the
+summary as a tab separated table of statistic and value.
+"""
+
+import numpy
+
+SCORE_BIN_SIZE= 0.1
+QUANTILES= [0, 0.05, 0.25, 0.5, 0.75, 0.95, 1]
+
+class IslandStatistics:
+
+    def __init__(self, starts, ends, scores, genome_length, bin_size= SCORE_BIN_SIZE, quantiles= QUANTILES):
+        lengths= numpy.asarray(ends, dtype= numpy.int64) - numpy.asarray(starts, dtype= numpy.int64) + 1
+        scores= numpy.asarray(scores, dtype= float)
+        assert numpy.all(lengths >= 0)
+        self.genome_length= genome_length
+        self.bin_size= bin_size
+        self.quantiles= list(quantiles)
+        self.number_of_islands= len(lengths)
+        self.total_length= int(lengths.sum())
+        self.total_score= float(scores.sum())
+        self.coverage= self.total_length * 1.0 / genome_length if genome_length > 0 else float('nan')
+        self.length_histogram= numpy.bincount(lengths, minlength= 1)
+        self.score_histogram= numpy.bincount((scores / bin_size).astype(numpy.int64), minlength= 1)
+        if self.number_of_islands > 0:
+            self.length_quantiles= numpy.percentile(lengths, [100 * x for x in self.quantiles]).tolist()
+            self.score_quantiles= numpy.percentile(scores, [100 * x for x in self.quantiles]).tolist()
+        else:
+            self.length_quantiles= [float('nan')] * len(self.quantiles)
+            self.score_quantiles= [float('nan')] * len(self.quantiles)
+
+    def summary(self):
+        """List of (statistic, value)
+        """
+        rows= [('islands', self.number_of_islands),
+               ('total_length', self.total_length),
+               ('total_score', self.total_score),
+               ('genome_length', self.genome_length),
+               ('coverage', self.coverage)]
+        rows.extend([('length_quantile_' + str(q), x) for q, x in zip(self.quantiles, self.length_quantiles)])
+        rows.extend([('score_quantile_' + str(q), x) for q, x in zip(self.quantiles, self.score_quantiles)])
+        return rows
+
+    def write(self, filename):
+        fout= open(filename, 'w')
+        fout.write('#statistic\tvalue\n')
+        for name, value in self.summary():
+            fout.write(name + '\t' + str(value) + '\n')
+        fout.close()
+        return filename
+
+    def write_length_histogram(self, filename):
+        """As islands_statistics_pr.find_islands_length_histogram
+        """
+        fout= open(filename, 'w')
+        fout.write("# The totoal length of the islands is: " + str(self.total_length) + "\n")
+        for i in numpy.flatnonzero(self.length_histogram).tolist():
+            fout.write(str(i) + "\t " + str(float(self.length_histogram[i])) + "\n")
+        fout.close()
+        return filename
+
+    def write_score_histogram(self, filename):
+        """As islands_statistics_pr.find_islands_score_histogram
+        """
+        fout= open(filename, 'w')
+        for i in numpy.flatnonzero(self.score_histogram).tolist():
+            fout.write(str(self.bin_size * i) + "\t " + str(float(self.score_histogram[i])) + "\n")
+        fout.close()
+        return filename
+
+    def write_files(self, prefix):
+        """Write summary and histograms to prefix.island_statistics.tsv,
+        prefix.island_length_histogram.tsv, prefix.island_score_histogram.tsv.
+        Return the file names.
+        """
+        return [self.write(prefix + '.island_statistics.tsv'),
+                self.write_length_histogram(prefix + '.island_length_histogram.tsv'),
+                self.write_score_histogram(prefix + '.island_score_histogram.tsv')]
+
+def from_islands(islands_by_chrom, genome_length, bin_size= SCORE_BIN_SIZE, quantiles= QUANTILES):
+    """IslandStatistics of islands given as dict {chrom: (starts, ends, scores)}
+    """
+    chroms= sorted(islands_by_chrom.keys())
+    if len(chroms) == 0:
+        return IslandStatistics([], [], [], genome_length, bin_size, quantiles)
+    starts= numpy.concatenate([numpy.asarray(islands_by_chrom[x][0], dtype= numpy.int64) for x in chroms])
+    ends= numpy.concatenate([numpy.asarray(islands_by_chrom[x][1], dtype= numpy.int64) for x in chroms])
+    scores= numpy.concatenate([numpy.asarray(islands_by_chrom[x][2], dtype= float) for x in chroms])
+    return IslandStatistics(starts, ends, scores, genome_length, bin_size, quantiles)
+
+def read_islands(filename, score_column= 3):
+    """(starts, ends, scores) arrays of the islands in a bed file, e.g. the
+    scoreisland file of find_islands_in_pr.py. Lines starting with 'track'
+    or '#' are skipped.
+    """
+    starts= []
+    ends= []
+    scores= []
+    fin= open(filename)
+    for line in fin:
+        if line.startswith('track') or line.startswith('#') or line.strip() == '':
+            continue
+        sline= line.split()
+        starts.append(sline[1])
+        ends.append(sline[2])
+        scores.append(sline[score_column])
+    fin.close()
+    return (numpy.array(starts, dtype= numpy.int64), numpy.array(ends, dtype= numpy.int64), numpy.array(scores, dtype= float))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Select the reads whose tag falls on an island, e.g. to extract the reads in
+peaks or compute the fraction of reads in peaks.
+
+Reads are read in batches. For each batch the tag positions are computed as
+arrays, shifted by half the fragment size as in
+associate_tags_with_regions.tag_position:
+
+    + strand: start + shift
+    - strand: end - 1 - shift, with end the BED end, i.e. pysam
+              reference_end - shift for bam files
+
+and the tags on islands are found with numpy.searchsorted: a tag at position
+p is on an island if
+
+    (number of islands with start <= p) - (number of islands with end < p) == 1
+
+Islands are an island_overlap.IslandSet; they must not overlap and their ends
+are inclusive. Kept reads are written with pysam for bam files and in bulk,
+as they are in the input, for BED files.
+"""
+
+import numpy
+import pysam
+
+BATCH_SIZE= 100000
+
+def on_islands(positions, island_starts, island_sorted_ends):
+    """Boolean array, True for the positions on an island.
+    """
+    return numpy.searchsorted(island_starts, positions, side= 'right') - \
+           numpy.searchsorted(island_sorted_ends, positions, side= 'left') == 1
+
+def keep_on_islands(chroms, positions, islands, allowed_chroms= None):
+    """Boolean array, True for the tags (chroms[i], positions[i]) on an island.
+    chroms is an array of chromosome names. Tags on chromosomes not in
+    allowed_chroms, if given, are not kept.
+    """
+    keep= numpy.zeros(len(positions), dtype= bool)
+    for chrom in numpy.unique(chroms):
+        if chrom not in islands.starts or (allowed_chroms is not None and chrom not in allowed_chroms):
+            continue
+        x= numpy.flatnonzero(chroms == chrom)
+        keep[x]= on_islands(positions[x], islands.starts[chrom], islands.sorted_ends[chrom])
+    return keep
+
+def filter_bam(bam, out_bam, islands, fragment_size, allowed_chroms= None, requiredFlag= 0, filterFlag= 0, mapq= 0, batch_size= BATCH_SIZE):
+    """Write the reads of bam with the tag on an island to out_bam. Reads
+    failing the filters or unmapped are not written. Return (number of reads
+    passing the filters and placed on a chromosome, number of reads written),
+    so that the ratio is the fraction of the reads on islands.
+    """
+    shift= int(round(fragment_size/2))
+    inBam= pysam.AlignmentFile(bam)
+    references= numpy.array(inBam.references, dtype= str)
+    outBam= pysam.AlignmentFile(out_bam, 'wb', template= inBam)
+    nreads= 0
+    nkept= 0
+    batch= []
+    for aln in inBam:
+        if aln.mapping_quality < mapq:
+            continue
+        if (aln.flag & requiredFlag) != requiredFlag:
+            continue
+        if (aln.flag & filterFlag) != 0:
+            continue
+        if aln.reference_id < 0 or aln.reference_end is None:
+            continue
+        nreads += 1
+        batch.append(aln)
+        if len(batch) >= batch_size:
+            nkept += _write_bam_batch(batch, outBam, references, islands, shift, allowed_chroms)
+            batch= []
+    nkept += _write_bam_batch(batch, outBam, references, islands, shift, allowed_chroms)
+    outBam.close()
+    inBam.close()
+    return (nreads, nkept)
+
+def _write_bam_batch(batch, outBam, references, islands, shift, allowed_chroms):
+    if len(batch) == 0:
+        return 0
+    tid= numpy.array([x.reference_id for x in batch], dtype= numpy.int64)
+    start= numpy.array([x.reference_start for x in batch], dtype= numpy.int64)
+    end= numpy.array([x.reference_end for x in batch], dtype= numpy.int64)
+    reverse= numpy.array([x.is_reverse for x in batch], dtype= bool)
+    positions= numpy.where(reverse, end - shift, start + shift)
+    keep= numpy.flatnonzero(keep_on_islands(references[tid], positions, islands, allowed_chroms))
+    for i in keep.tolist():
+        outBam.write(batch[i])
+    return len(keep)
+
+def filter_bed(bed, out_file, islands, fragment_size, allowed_chroms= None, batch_size= BATCH_SIZE):
+    """Write the lines of the BED6 file with the tag on an island to
+    out_file. Lines starting with '#' or 'track' are skipped, as are lines
+    with strand other than + or -. Return (number of reads with strand + or
+    -, number of reads written).
+    """
+    shift= int(round(fragment_size/2))
+    fin= open(bed)
+    fout= open(out_file, 'w', 1 << 20)
+    nreads= 0
+    nkept= 0
+    lines= []
+    for line in fin:
+        if line.startswith('#') or line.startswith('track') or line.strip() == '':
+            continue
+        lines.append(line)
+        if len(lines) >= batch_size:
+            (n, k)= _write_bed_batch(lines, fout, islands, shift, allowed_chroms)
+            nreads += n
+            nkept += k
+            lines= []
+    (n, k)= _write_bed_batch(lines, fout, islands, shift, allowed_chroms)
+    nreads += n
+    nkept += k
+    fout.close()
+    fin.close()
+    return (nreads, nkept)
+
+def _write_bed_batch(lines, fout, islands, shift, allowed_chroms):
+    if len(lines) == 0:
+        return (0, 0)
+    fields= [x.split() for x in lines]
+    chroms= numpy.array([x[0] for x in fields], dtype= str)
+    start= numpy.array([x[1] for x in fields], dtype= numpy.int64)
+    end= numpy.array([x[2] for x in fields], dtype= numpy.int64)
+    strand= numpy.array([x[5][0] if len(x) > 5 else '.' for x in fields], dtype= str)
+    positions= numpy.where(strand == '+', start + shift, numpy.where(strand == '-', end - 1 - shift, -1))
+    stranded= (strand == '+') | (strand == '-')
+    keep= keep_on_islands(chroms, positions, islands, allowed_chroms) & stranded
+    kept= [lines[i] for i in numpy.flatnonzero(keep).tolist()]
+    fout.writelines([x if x.endswith('\n') else x + '\n' for x in kept])
+    return (int(stranded.sum()), len(kept))
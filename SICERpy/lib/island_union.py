@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Union and consensus of any number of island files in a single sweep.
+
+The islands of all the files are read as streams sorted by chromosome and
+start and merged with heapq.merge, so only one island per file is in memory
+at any time. The sweep joins overlapping islands (start <= end of the
+current region, ends inclusive) into regions, like
+find_union_islands.union_islands_to_file did for two files, and keeps track
+of the samples (files) contributing to each region:
+
+* union: all the regions
+* consensus: the regions with islands from at least min_samples files
+
+Streams are sorted by chromosome name (as strings, like `sort -k1,1 -k2,2n`
+and the output of SICER.py) then start. Each file is read only once: the
+order is checked while merging and UnsortedError is raised at the first
+island out of order. The sweep can then be run again with that file read
+and sorted in memory.
+"""
+
+import heapq
+
+import island_overlap
+
+class UnsortedError(ValueError):
+    """Raised by the sweep when the islands of a file are not sorted.
+    sample: index of the file in the list given to sweep.
+    """
+    def __init__(self, filename, sample):
+        ValueError.__init__(self, "%s is not sorted by chromosome and start" %(filename))
+        self.filename= filename
+        self.sample= sample
+
+def islands_in_file(filename, chroms= None):
+    """Yield (chrom, start, end) from a bed file of islands in file order,
+    only for the chromosomes in chroms if given.
+    """
+    fin= island_overlap.open_islands(filename)
+    try:
+        for line in fin:
+            if line.startswith('#') or line.startswith('track') or line.strip() == '':
+                continue
+            sline= line.split()
+            if chroms is not None and sline[0] not in chroms:
+                continue
+            yield (sline[0], int(sline[1]), int(sline[2]))
+    finally:
+        fin.close()
+
+def sorted_islands(filename, sample, chroms= None, in_memory= False):
+    """Stream of (chrom, start, end, sample) sorted by chromosome and start.
+    The file is streamed as it is and UnsortedError raised if it turns out
+    not to be sorted, unless in_memory is True, in which case it is read and
+    sorted in memory.
+    """
+    if in_memory:
+        for chrom, start, end in sorted(islands_in_file(filename, chroms)):
+            yield (chrom, start, end, sample)
+        return
+    previous= None
+    for chrom, start, end in islands_in_file(filename, chroms):
+        if previous is not None and (chrom, start) < previous:
+            raise UnsortedError(filename, sample)
+        previous= (chrom, start)
+        yield (chrom, start, end, sample)
+
+def sweep(filenames, min_samples= 1, chroms= None, in_memory= ()):
+    """Yield the regions (chrom, start, end, number of samples) made by
+    joining the overlapping islands of all the files and containing islands
+    from at least min_samples files. Only the chromosomes in chroms are used,
+    if given. The files with index in in_memory are sorted in memory, see
+    sorted_islands.
+    """
+    current= None
+    samples= set()
+    streams= [sorted_islands(x, i, chroms, i in in_memory) for i, x in enumerate(filenames)]
+    for chrom, start, end, sample in heapq.merge(*streams):
+        if current is not None and chrom == current[0] and start <= current[2]:
+            current[2]= max(current[2], end)
+            samples.add(sample)
+            continue
+        if current is not None and len(samples) >= min_samples:
+            yield (current[0], current[1], current[2], len(samples))
+        current= [chrom, start, end]
+        samples= set([sample])
+    if current is not None and len(samples) >= min_samples:
+        yield (current[0], current[1], current[2], len(samples))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Persistent cache of preprocessed libraries.
+
+The redundancy filtering of a BAM file depends only on the file itself and on
+the filtering settings (required flag, filter flag, mapq, redundancy
+threshold). The result of this step is stored in a cache directory so that
+a library used more than once, typically the control, is processed only once.
+
+Each entry is a sub-directory of the cache named after the key and contains:
+
+    library.rm.bam   The filtered and de-duplicated reads
+    library.npz      Same reads as read_library.ReadLibrary, incl. library size
+    manifest.json    Source file and settings that produced the entry
+
+and optionally:
+
+    copy_histogram.tsv  Histogram of read copies, see copy_histogram.py
+
+Entries are first written to a temporary directory and then renamed, so
+concurrent runs sharing the same cache do not see partial entries.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+CACHE_VERSION= 1
+
+ENTRY_BAM= 'library.rm.bam'
+ENTRY_LIBRARY= 'library.npz'
+ENTRY_MANIFEST= 'manifest.json'
+ENTRY_COPY_HISTOGRAM= 'copy_histogram.tsv'
+
+def file_signature(filename, nbytes= 65536):
+    """Describe filename by its real path, size, modification time and the
+    checksum of the first nbytes. Cheap to compute even on large files.
+    """
+    st= os.stat(filename)
+    md5= hashlib.md5()
+    fin= open(filename, 'rb')
+    md5.update(fin.read(nbytes))
+    fin.close()
+    return {'path': os.path.realpath(filename),
+            'size': st.st_size,
+            'mtime': int(st.st_mtime),
+            'md5_head': md5.hexdigest()}
+
+def cache_key(bam, settings):
+    """Key for bam processed with settings, a dict like
+    {'requiredFlag': 0, 'filterFlag': 4, 'mapq': 5, 'redThresh': 0}
+    """
+    desc= {'version': CACHE_VERSION,
+           'source': file_signature(bam),
+           'settings': settings}
+    return hashlib.sha1(json.dumps(desc, sort_keys= True)).hexdigest()
+
+def entry_dir(cache_dir, key):
+    return os.path.join(cache_dir, key)
+
+def lookup(cache_dir, bam, settings):
+    """Return the directory of the cache entry for bam and settings or None
+    if not cached.
+    """
+    d= entry_dir(cache_dir, cache_key(bam, settings))
+    for x in [ENTRY_BAM, ENTRY_LIBRARY, ENTRY_MANIFEST]:
+        if not os.path.isfile(os.path.join(d, x)):
+            return None
+    return d
+
+def store(cache_dir, bam, settings, filteredBam, libraryFile, library_size= None, extras= None):
+    """Move filteredBam and libraryFile to the cache entry for bam and
+    settings. extras is an optional dict {entry file name: file} of files
+    copied to the entry. Return the entry directory.
+    If another process has created the entry in the meantime, that entry is
+    kept and the files given here are discarded.
+    """
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    key= cache_key(bam, settings)
+    manifest= {'version': CACHE_VERSION,
+               'source': file_signature(bam),
+               'settings': settings,
+               'library_size': library_size,
+               'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+    tmp= tempfile.mkdtemp(prefix= '.tmp_' + key + '_', dir= cache_dir)
+    shutil.move(filteredBam, os.path.join(tmp, ENTRY_BAM))
+    shutil.move(libraryFile, os.path.join(tmp, ENTRY_LIBRARY))
+    if extras:
+        for name in extras:
+            shutil.copy(extras[name], os.path.join(tmp, name))
+    fout= open(os.path.join(tmp, ENTRY_MANIFEST), 'w')
+    json.dump(manifest, fout, indent= 2, sort_keys= True)
+    fout.close()
+    d= entry_dir(cache_dir, key)
+    try:
+        os.rename(tmp, d)
+    except OSError:
+        ## Entry created by a concurrent run or by an earlier run without
+        ## some of the extras: add those it is missing.
+        if extras:
+            add_extras(d, dict([(name, os.path.join(tmp, name)) for name in extras]))
+        shutil.rmtree(tmp)
+    return d
+
+def add_extras(entry, extras):
+    """Copy to the existing entry the files in extras, {entry file name:
+    file}, it does not have yet. Files are copied to a temp file and renamed
+    so that other runs never see a partial file.
+    """
+    for name in extras:
+        dest= os.path.join(entry, name)
+        if os.path.isfile(dest):
+            continue
+        fd, tmp= tempfile.mkstemp(dir= entry, prefix= '.tmp_' + name + '_')
+        os.close(fd)
+        shutil.copy(extras[name], tmp)
+        os.rename(tmp, dest)
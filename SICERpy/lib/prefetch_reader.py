@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+Read a bam file in a background thread.
+
+Stages reading a whole bam file alternate between decoding records and
+working on them. PrefetchReader decodes the bam file in a background thread
+and hands the reads over in batches of numpy arrays through a bounded queue,
+so decoding goes on while the caller works on the previous batches:
+
+    reader= PrefetchReader(bam, requiredFlag, filterFlag, mapq)
+    for batch in reader:
+        ... batch.tid, batch.start, batch.end, batch.reverse, batch.names
+
+* Backpressure: the queue holds at most queue_size batches. When it is full
+  the reader waits, so memory is bounded by about
+  (queue_size + 2) * batch_size reads whatever the speed of the caller.
+* Errors in the background thread, e.g. a truncated bam file, are raised by
+  the iteration in the caller with the original traceback.
+* Stopping early: close() (or leaving a with block) stops the background
+  thread, which would otherwise wait forever on a full queue.
+
+BGZF decompression is done by htslib without holding the python lock, and
+with threads > 0 also by that many extra htslib threads.
+
+Reads are filtered as SeparateByChrom.separateByChromBamToBed does and
+reads without reference are skipped. The total number of records in the
+file, filtered or not, is in nrecords once the iteration is over.
+"""
+
+import array
+import sys
+import threading
+import Queue
+import numpy
+import pysam
+
+BATCH_SIZE= 50000
+QUEUE_SIZE= 4
+
+class ReadBatch:
+    """Reads as parallel arrays: reference id, start, end (pysam
+    reference_end), strand and, if requested, read names (a list).
+    """
+    def __init__(self, tid, start, end, reverse, names= None):
+        self.tid= numpy.asarray(tid, dtype= numpy.int64)
+        self.start= numpy.asarray(start, dtype= numpy.int64)
+        self.end= numpy.asarray(end, dtype= numpy.int64)
+        self.reverse= numpy.asarray(reverse, dtype= bool)
+        self.names= names
+
+    def __len__(self):
+        return len(self.tid)
+
+    def subset(self, index):
+        """Batch with the reads selected by index, a boolean mask or an
+        array of positions.
+        """
+        names= None
+        if self.names is not None:
+            names= [self.names[i] for i in numpy.arange(len(self))[index]]
+        return ReadBatch(self.tid[index], self.start[index], self.end[index], self.reverse[index], names)
+
+_END= 'end'
+_ERROR= 'error'
+
+class PrefetchReader:
+
+    def __init__(self, bam, requiredFlag= 0, filterFlag= 0, mapq= 0, names= False, batch_size= BATCH_SIZE, queue_size= QUEUE_SIZE, threads= 0):
+        self.bam= bam
+        self.requiredFlag= requiredFlag
+        self.filterFlag= filterFlag
+        self.mapq= mapq
+        self.names= names
+        self.batch_size= batch_size
+        self.threads= threads
+        self.nrecords= None
+        self.queue= Queue.Queue(maxsize= queue_size)
+        self.stopped= threading.Event()
+        self.thread= None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _put(self, item):
+        """Put item in the queue, waiting while it is full unless the reader
+        is closed. Return False if closed.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout= 0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _read(self):
+        try:
+            inBam= pysam.AlignmentFile(self.bam, threads= self.threads) if self.threads > 0 else pysam.AlignmentFile(self.bam)
+            try:
+                nrecords= 0
+                while True:
+                    tid= array.array('l')
+                    start= array.array('l')
+                    end= array.array('l')
+                    reverse= array.array('b')
+                    names= [] if self.names else None
+                    for aln in inBam:
+                        nrecords += 1
+                        if aln.mapping_quality < self.mapq:
+                            continue
+                        if (aln.flag & self.requiredFlag) != self.requiredFlag:
+                            continue
+                        if (aln.flag & self.filterFlag) != 0:
+                            continue
+                        if aln.reference_id < 0:
+                            continue
+                        tid.append(aln.reference_id)
+                        start.append(aln.reference_start)
+                        end.append(aln.reference_end)
+                        reverse.append(aln.is_reverse)
+                        if names is not None:
+                            names.append(aln.query_name)
+                        if len(tid) >= self.batch_size:
+                            break
+                    else:
+                        ## File is over
+                        if len(tid) > 0:
+                            self._put(ReadBatch(tid, start, end, reverse, names))
+                        break
+                    if not self._put(ReadBatch(tid, start, end, reverse, names)):
+                        return
+            finally:
+                inBam.close()
+            self.nrecords= nrecords
+            self._put((_END, None))
+        except Exception:
+            self._put((_ERROR, sys.exc_info()))
+
+    def __iter__(self):
+        if self.thread is not None:
+            raise ValueError('%s is already being read' %(self.bam))
+        self.thread= threading.Thread(target= self._read)
+        self.thread.daemon= True
+        self.thread.start()
+        try:
+            while True:
+                item= self.queue.get()
+                if isinstance(item, tuple):
+                    if item[0] == _ERROR:
+                        raise item[1][0], item[1][1], item[1][2]
+                    break
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the background thread and wait for it.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+"""
+In-memory read libraries: per-chromosome arrays of read coordinates.
+
+A read library holds, for each chromosome, three parallel arrays:
+
+    starts:  0-based leftmost position of the read (pysam reference_start)
+    ends:    0-based exclusive end of the read (pysam reference_end)
+    reverse: True for reads on the - strand
+
+together with the chromosome lengths and the library size. Libraries can be
+built from a BAM file or from the per-chromosome BED files written by
+SeparateByChrom, and saved to / loaded from a single .npz file so that
+downstream stages do not need to decode the BAM again.
+
+NB: The BED files produced by SeparateByChrom.separateByChromBamToBed have
+end= reference_end + 1. The functions here take care of the conversion so
+that tag positions are the same as those given by
+associate_tags_with_regions.tag_position and make_graph_file.get_bed_coords.
+"""
+
+import array
+import numpy
+import pysam
+
+import prefetch_reader
+
+LIBRARY_EXTENSION= '.npz'
+
+class ReadLibrary:
+    """
+    Reads of a library grouped by chromosome.
+    chrom_lengths: dict {chrom: length}
+    chroms: list of chromosome names in the order of the BAM header
+    library_size: total number of reads in the library. It might be larger
+        than the number of reads stored if some reads could not be assigned
+        to a chromosome.
+    """
+    def __init__(self, chroms, chrom_lengths, library_size= None):
+        self.chroms= list(chroms)
+        self.chrom_lengths= dict(chrom_lengths)
+        self.reads= {}
+        self.library_size= library_size
+
+    def add(self, chrom, starts, ends, reverse):
+        self.reads[chrom]= (numpy.asarray(starts, dtype= numpy.int64),
+                            numpy.asarray(ends, dtype= numpy.int64),
+                            numpy.asarray(reverse, dtype= bool))
+
+    def get(self, chrom):
+        """Return the tuple (starts, ends, reverse) for chrom. Empty arrays if
+        chrom has no reads.
+        """
+        if chrom in self.reads:
+            return self.reads[chrom]
+        empty= numpy.zeros(0, dtype= numpy.int64)
+        return (empty, empty, numpy.zeros(0, dtype= bool))
+
+    def number_of_reads(self):
+        n= 0
+        for chrom in self.reads:
+            n += len(self.reads[chrom][0])
+        return n
+
+    def size(self):
+        if self.library_size is None:
+            return self.number_of_reads()
+        return self.library_size
+
+    def save(self, filename):
+        """Write library to filename in npz format. Chromosomes are
+        concatenated and indexed by offsets.
+        """
+        offsets= [0]
+        starts= []
+        ends= []
+        reverse= []
+        for chrom in self.chroms:
+            s, e, r= self.get(chrom)
+            starts.append(s)
+            ends.append(e)
+            reverse.append(r)
+            offsets.append(offsets[-1] + len(s))
+        fout= open(filename, 'wb')
+        numpy.savez(fout,
+            chroms= numpy.array(self.chroms, dtype= str),
+            lengths= numpy.array([self.chrom_lengths[x] for x in self.chroms], dtype= numpy.int64),
+            offsets= numpy.array(offsets, dtype= numpy.int64),
+            starts= numpy.concatenate(starts).astype(numpy.int32) if starts else numpy.zeros(0, dtype= numpy.int32),
+            ends= numpy.concatenate(ends).astype(numpy.int32) if ends else numpy.zeros(0, dtype= numpy.int32),
+            reverse= numpy.concatenate(reverse) if reverse else numpy.zeros(0, dtype= bool),
+            library_size= numpy.array(self.size(), dtype= numpy.int64))
+        fout.close()
+        return filename
+
+def is_library_file(filename):
+    return filename.endswith(LIBRARY_EXTENSION)
+
+def load(filename):
+    """Read a library previously written by ReadLibrary.save()
+    """
+    npz= numpy.load(filename)
+    chroms= [str(x) for x in npz['chroms']]
+    lengths= npz['lengths']
+    offsets= npz['offsets']
+    starts= npz['starts']
+    ends= npz['ends']
+    reverse= npz['reverse']
+    lib= ReadLibrary(chroms, dict(zip(chroms, [int(x) for x in lengths])), int(npz['library_size']))
+    for i, chrom in enumerate(chroms):
+        a, b= offsets[i], offsets[i+1]
+        if b > a:
+            lib.add(chrom, starts[a:b], ends[a:b], reverse[a:b])
+    npz.close()
+    return lib
+
+def library_size(filename):
+    """Size of the library saved in filename, without loading the reads.
+    """
+    npz= numpy.load(filename)
+    size= int(npz['library_size'])
+    npz.close()
+    return size
+
+def header_chroms(bam):
+    """List of chromosome names in the order of the bam header
+    """
+    inBam= pysam.AlignmentFile(bam)
+    chroms= list(inBam.references)
+    inBam.close()
+    return chroms
+
+def read_bam(bam, requiredFlag= 0, filterFlag= 0, mapq= 0):
+    """Read bam file into a ReadLibrary. Reads are filtered in the same way as
+    SeparateByChrom.separateByChromBamToBed. The library size is the number of
+    records in the bam file, as in get_total_tag_counts.get_total_tag_counts_bam.
+    The file is decoded in a background thread, see prefetch_reader.py.
+    """
+    inBam= pysam.AlignmentFile(bam)
+    chroms= list(inBam.references)
+    lib= ReadLibrary(chroms, dict(zip(chroms, inBam.lengths)))
+    inBam.close()
+    blocks= {} ## Key: tid; Value: list of (starts, ends, reverse)
+    reader= prefetch_reader.PrefetchReader(bam, requiredFlag, filterFlag, mapq)
+    for batch in reader:
+        for tid in numpy.unique(batch.tid):
+            x= batch.tid == tid
+            blocks.setdefault(tid, []).append((batch.start[x], batch.end[x], batch.reverse[x]))
+    for tid in blocks:
+        lib.add(chroms[tid], numpy.concatenate([x[0] for x in blocks[tid]]),
+            numpy.concatenate([x[1] for x in blocks[tid]]), numpy.concatenate([x[2] for x in blocks[tid]]))
+    lib.library_size= reader.nrecords
+    return lib
+
+FETCH_MERGE_DISTANCE= 10000
+
+def index_library_size(bam):
+    """Number of records in an indexed bam file, mapped and unmapped, from the
+    index. Same as the library size given by read_bam without reading the
+    file.
+    """
+    inBam= pysam.AlignmentFile(bam)
+    try:
+        size= inBam.mapped + inBam.unmapped
+    finally:
+        inBam.close()
+    return size
+
+def fetch_intervals(island_starts, island_ends, fragment_size, merge_distance= FETCH_MERGE_DISTANCE):
+    """Intervals (start, end), end exclusive, to fetch from the bam file to
+    get all the reads whose tag position, see tag_positions, falls on the
+    islands. Islands are padded by the fragment shift and intervals closer
+    than merge_distance are merged. Islands must be sorted.
+    """
+    shift= int(round(fragment_size/2))
+    intervals= []
+    for start, end in zip(island_starts, island_ends):
+        ## Tag of a - read is at reference_end - shift, that of a + read at
+        ## reference_start + shift. One more base so that fetch returns - reads
+        ## ending exactly at the island start with shift 0.
+        a, b= max(int(start) - shift - 1, 0), int(end) + shift + 1
+        if len(intervals) > 0 and a - intervals[-1][1] <= merge_distance:
+            intervals[-1][1]= max(intervals[-1][1], b)
+        else:
+            intervals.append([a, b])
+    return [tuple(x) for x in intervals]
+
+def fetch_library(bam, islands, fragment_size, merge_distance= FETCH_MERGE_DISTANCE, requiredFlag= 0, filterFlag= 0, mapq= 0):
+    """ReadLibrary with only the reads of the indexed bam file whose tag
+    position falls on the islands, given as dict {chrom: (sorted island
+    starts, island ends)}. Reads are fetched using the index, so only the
+    regions around the islands are decoded, and filtered as in read_bam. The
+    library size is taken from the index, see index_library_size; like that
+    of read_bam it is the number of records, filtered or not.
+    """
+    shift= int(round(fragment_size/2))
+    inBam= pysam.AlignmentFile(bam)
+    if not inBam.has_index():
+        inBam.close()
+        raise ValueError('%s has no index' %(bam))
+    chroms= list(inBam.references)
+    lib= ReadLibrary(chroms, dict(zip(chroms, inBam.lengths)), inBam.mapped + inBam.unmapped)
+    for chrom in chroms:
+        if chrom not in islands:
+            continue
+        starts= array.array('l')
+        ends= array.array('l')
+        reverse= array.array('b')
+        for a, b in fetch_intervals(islands[chrom][0], islands[chrom][1], fragment_size, merge_distance):
+            for aln in inBam.fetch(chrom, a, b):
+                if aln.mapping_quality < mapq:
+                    continue
+                if (aln.flag & requiredFlag) != requiredFlag:
+                    continue
+                if (aln.flag & filterFlag) != 0:
+                    continue
+                if aln.reference_end is None:
+                    continue
+                ## Keep reads with the tag in this interval only, so reads
+                ## overlapping two intervals are not counted twice.
+                if aln.is_reverse:
+                    position= aln.reference_end - shift
+                else:
+                    position= aln.reference_start + shift
+                if position < a or position >= b:
+                    continue
+                starts.append(aln.reference_start)
+                ends.append(aln.reference_end)
+                reverse.append(aln.is_reverse)
+        if len(starts) > 0:
+            lib.add(chrom, starts, ends, reverse)
+    inBam.close()
+    return lib
+
+def read_bed_files(chroms, extension, chrom_lengths):
+    """Read the per-chromosome BED6 files <chrom><extension> written by
+    SeparateByChrom into a ReadLibrary. Missing files are skipped.
+    """
+    lib= ReadLibrary(chroms, chrom_lengths)
+    for chrom in chroms:
+        starts= array.array('l')
+        ends= array.array('l')
+        reverse= array.array('b')
+        try:
+            fin= open(chrom + extension)
+        except IOError:
+            continue
+        for line in fin:
+            sline= line.split('\t')
+            if len(sline) < 6:
+                continue
+            starts.append(int(sline[1]))
+            ends.append(int(sline[2]) - 1) ## BED end is reference_end + 1
+            reverse.append(sline[5].strip() == '-')
+        fin.close()
+        if len(starts) > 0:
+            lib.add(chrom, starts, ends, reverse)
+    return lib
+
+def read_bed_file(filename, chrom_lengths= None):
+    """Read a BED6 file of reads, all chromosomes in one file, into a
+    ReadLibrary. The library size is the number of lines, as in
+    get_total_tag_counts.get_total_tag_counts. Chromosomes are in the order
+    they are first found; chromosome lengths are taken from chrom_lengths if
+    given, otherwise they are set to the largest read end.
+    """
+    chroms= []
+    reads= {}
+    nlines= 0
+    fin= open(filename)
+    for line in fin:
+        if line.startswith('track'):
+            continue
+        nlines += 1
+        sline= line.split()
+        if len(sline) < 6:
+            continue
+        if sline[0] not in reads:
+            chroms.append(sline[0])
+            reads[sline[0]]= (array.array('l'), array.array('l'), array.array('b'))
+        starts, ends, reverse= reads[sline[0]]
+        starts.append(int(sline[1]))
+        ends.append(int(sline[2]) - 1) ## BED end is reference_end + 1
+        reverse.append(sline[5] == '-')
+    fin.close()
+    if chrom_lengths is None:
+        chrom_lengths= dict([(x, max(reads[x][1]) + 1) for x in chroms])
+    lib= ReadLibrary(chroms, chrom_lengths, nlines)
+    for chrom in chroms:
+        lib.add(chrom, *reads[chrom])
+    return lib
+
+def tag_positions(lib, chrom, fragment_size):
+    """Positions of the tags on chrom shifted by half the fragment size. Same
+    as associate_tags_with_regions.tag_position applied to every read.
+    Returns an unsorted array.
+    """
+    shift= int(round(fragment_size/2))
+    starts, ends, reverse= lib.get(chrom)
+    return numpy.where(reverse, ends - shift, starts + shift)
+
+def count_tags_on_islands(positions, island_starts, island_ends):
+    """Count the tags falling on each island. Islands must be sorted and
+    non-overlapping, ends are inclusive. Same logic as
+    associate_tags_with_regions.find_readcount_on_islands.
+    Returns an array of counts, one per island.
+    """
+    island_starts= numpy.asarray(island_starts)
+    island_ends= numpy.asarray(island_ends)
+    right= numpy.searchsorted(island_starts, positions, side= 'right')
+    left= numpy.searchsorted(island_ends, positions, side= 'left')
+    index= right[(right - left) == 1] - 1
+    return numpy.bincount(index, minlength= len(island_starts))
+
+def graph_tag_positions(lib, chrom, fragment_size, sort= True):
+    """Sorted positions of the tags on chrom as used to make the summary
+    graph. Same as make_graph_file.get_bed_coords: reads ending at or beyond
+    the end of the chromosome are ignored and shifted positions are kept
+    within the chromosome. With sort= False positions are in the order of
+    the reads.
+    """
+    chrom_length= lib.chrom_lengths[chrom]
+    shift= int(round(fragment_size/2))
+    starts, ends, reverse= lib.get(chrom)
+    keep= (starts >= 0) & ((ends + 1) < chrom_length)
+    starts, ends, reverse= starts[keep], ends[keep], reverse[keep]
+    positions= numpy.where(reverse,
+        numpy.maximum(ends - shift, 0),
+        numpy.minimum(starts + shift, chrom_length - 1))
+    if sort:
+        positions.sort()
+    return positions
+
+def window_counts(positions, chrom_length, window_size):
+    """Count tags in windows of window_size. Same as
+    make_graph_file.Generate_windows_and_count_tags: windows are aligned to 0
+    and windows going beyond the end of the chromosome are discarded.
+    Return (window starts, tag counts) for the windows with at least one tag.
+    """
+    bins, counts= numpy.unique(numpy.asarray(positions) // window_size, return_counts= True)
+    keep= (bins + 1) * window_size <= chrom_length
+    return (bins[keep] * window_size, counts[keep])
+
+def rebin_window_counts(window_starts, counts, chrom_length, window_size):
+    """Sum counts from windows of finer resolution into windows of
+    window_size. window_size must be a multiple of the fine resolution.
+    The result is the same as window_counts() at window_size on the original
+    positions, provided the fine windows were not truncated at the end of the
+    chromosome.
+    """
+    window_starts= numpy.asarray(window_starts)
+    if len(window_starts) == 0:
+        return (window_starts, numpy.asarray(counts))
+    bins= window_starts // window_size
+    first= numpy.concatenate(([True], bins[1:] != bins[:-1]))
+    index= numpy.nonzero(first)[0]
+    bins= bins[index]
+    summed= numpy.add.reduceat(numpy.asarray(counts), index)
+    keep= (bins + 1) * window_size <= chrom_length
+    return (bins[keep] * window_size, summed[keep])
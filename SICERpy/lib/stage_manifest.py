@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Manifest of the stages completed in a persistent working directory.
+
+For each stage the manifest records the signature of the input files (see
+library_cache.file_signature), the parameters and the signature of the output
+files produced. A stage is up to date if its inputs and parameters are the
+same as recorded and its outputs are still there, unchanged. This is what
+allows SICER.py --resume to skip the stages already done by a previous run.
+
+The manifest is a single json file rewritten after each completed stage:
+
+    {"version": 1,
+     "stages": {"<stage name>": {"inputs": {...}, "params": {...},
+                                 "outputs": {...}, "completed": "..."}}}
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from library_cache import file_signature
+
+MANIFEST_VERSION= 1
+
+def signatures(files):
+    """Dict {file: signature} for the list of files. None for missing files.
+    """
+    sig= {}
+    for x in files:
+        if os.path.isfile(x):
+            sig[x]= file_signature(x)
+        else:
+            sig[x]= None
+    return sig
+
+class StageManifest:
+    """
+    Stages completed in workdir. Methods are thread safe so that samples
+    processed in parallel can share the same manifest.
+    """
+    def __init__(self, filename):
+        self.filename= filename
+        self.lock= threading.Lock()
+        self.stages= {}
+        if os.path.isfile(filename):
+            fin= open(filename)
+            try:
+                manifest= json.load(fin)
+            except ValueError:
+                manifest= {}
+            fin.close()
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.stages= manifest['stages']
+
+    def is_current(self, stage, inputs, params, outputs):
+        """True if stage was completed with the same inputs and params and
+        its outputs have not changed since.
+        """
+        with self.lock:
+            done= self.stages.get(stage)
+        if done is None:
+            return False
+        if done['params'] != params:
+            return False
+        if sorted(done['outputs'].keys()) != sorted(outputs):
+            return False
+        ## Signatures read back from json have unicode strings, compare
+        ## through json to be safe
+        current= json.loads(json.dumps({'inputs': signatures(inputs), 'outputs': signatures(outputs)}))
+        if None in current['outputs'].values():
+            return False
+        return current['inputs'] == done['inputs'] and current['outputs'] == done['outputs']
+
+    def discard(self, stage):
+        with self.lock:
+            if stage in self.stages:
+                del self.stages[stage]
+                self._write()
+
+    def record(self, stage, inputs, params, outputs):
+        """Mark stage as completed. Call after all the outputs are written.
+        """
+        entry= {'inputs': signatures(inputs),
+                'params': params,
+                'outputs': signatures(outputs),
+                'completed': time.strftime('%Y-%m-%d %H:%M:%S')}
+        entry= json.loads(json.dumps(entry))
+        with self.lock:
+            self.stages[stage]= entry
+            self._write()
+
+    def _write(self):
+        fd, tmp= tempfile.mkstemp(prefix= '.' + os.path.basename(self.filename) + '.', dir= os.path.dirname(os.path.abspath(self.filename)))
+        fout= os.fdopen(fd, 'w')
+        json.dump({'version': MANIFEST_VERSION, 'stages': self.stages}, fout, indent= 2, sort_keys= True)
+        fout.close()
+        os.rename(tmp, self.filename)
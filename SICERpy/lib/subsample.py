@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+Subsampling of reads in a single pass over the input.
+
+Two ways of choosing the reads:
+
+* count: reservoir sampling (algorithm R) keeps exactly n of the reads, all
+  the subsets of n reads being equally likely. The reservoir holds the n
+  items selected so far, so memory grows with n. The items are returned in
+  the order of the input, so a sorted bam file stays sorted. For bam files
+  the reservoir holds only the file offsets of the reads, 8 bytes per read,
+  and the selected reads are read back from these offsets at the end, in
+  file order, so the reads themselves are never kept in memory.
+
+* fraction: a read is kept if the hash of its name, together with the seed,
+  is below fraction of the hash range. Reads with the same name (mates,
+  secondary alignments) are kept or dropped together, and the same seed
+  selects the same reads in every run and in any file with the same read
+  names. About fraction of the reads are kept.
+
+subsample_bam() applies either to a bam file, with the same read filters as
+SeparateByChrom.separateByChromBamToBed, and returns the read library of the
+reads written (see read_library.py) so the pipeline does not need to read
+the new bam file again.
+"""
+
+import array
+import hashlib
+import random
+import struct
+import numpy
+import pysam
+
+import read_library
+
+HASH_RANGE= 2**32
+
+def name_hash(name, seed= 0):
+    """Hash of a read name in [0, HASH_RANGE), the same on every platform.
+    """
+    return struct.unpack('<I', hashlib.md5('%s\t%s' %(seed, name)).digest()[:4])[0]
+
+def hash_threshold(fraction):
+    return int(round(fraction * HASH_RANGE))
+
+def hash_sample(items, fraction, seed= 0, name= lambda x: x.query_name):
+    """Yield the items whose name, given by the function name, hashes below
+    fraction.
+    """
+    threshold= hash_threshold(fraction)
+    for x in items:
+        if name_hash(name(x), seed) < threshold:
+            yield x
+
+def reservoir_sample(items, n, rng= random):
+    """List of n items chosen at random, in the order of items. All the items
+    if there are no more than n. rng is a random.Random, or the random module.
+    """
+    reservoir= []
+    i= -1
+    for i, x in enumerate(items):
+        if i < n:
+            reservoir.append((i, x))
+            continue
+        j= rng.randint(0, i)
+        if j < n:
+            reservoir[j]= (i, x)
+    reservoir.sort(key= lambda x: x[0])
+    return [x[1] for x in reservoir]
+
+def passes_filters(aln, requiredFlag= 0, filterFlag= 0, mapq= 0):
+    if aln.mapping_quality < mapq:
+        return False
+    if (aln.flag & requiredFlag) != requiredFlag:
+        return False
+    if (aln.flag & filterFlag) != 0:
+        return False
+    return True
+
+def filtered_reads(inBam, requiredFlag= 0, filterFlag= 0, mapq= 0):
+    """Reads of the open bam file passing the filters.
+    """
+    for aln in inBam:
+        if passes_filters(aln, requiredFlag, filterFlag, mapq):
+            yield aln
+
+def reservoir_offsets(inBam, n, rng= random, requiredFlag= 0, filterFlag= 0, mapq= 0):
+    """Sorted array of the virtual file offsets of n reads of the open bam
+    file passing the filters, chosen as reservoir_sample does: the same rng
+    selects the same reads.
+    """
+    reservoir= array.array('l')
+    i= -1
+    offset= inBam.tell()
+    for aln in inBam:
+        start= offset
+        offset= inBam.tell()
+        if not passes_filters(aln, requiredFlag, filterFlag, mapq):
+            continue
+        i += 1
+        if i < n:
+            reservoir.append(start)
+            continue
+        j= rng.randint(0, i)
+        if j < n:
+            reservoir[j]= start
+    if len(reservoir) == 0:
+        return numpy.zeros(0, dtype= numpy.int64)
+    return numpy.sort(numpy.frombuffer(reservoir, dtype= 'l').astype(numpy.int64))
+
+def reads_at(inBam, offsets):
+    """Yield the reads of the open bam file at the sorted virtual offsets.
+    Reads in the block being read are reached by reading on, so that a block
+    is not decompressed again for each read selected in it.
+    """
+    for offset in offsets.tolist():
+        current= inBam.tell()
+        if not (offset >= current and (offset >> 16) == (current >> 16)):
+            inBam.seek(offset)
+        while inBam.tell() < offset:
+            next(inBam)
+        yield next(inBam)
+
+def subsample_bam(bam, out_bam, n= None, fraction= None, seed= None, requiredFlag= 0, filterFlag= 0, mapq= 0):
+    """Write to out_bam n reads of bam chosen with reservoir sampling, or the
+    reads selected by hash_sample with fraction. Return the ReadLibrary of the
+    reads written; its size is the number of reads written.
+    """
+    if (n is None) == (fraction is None):
+        raise ValueError('Exactly one of n and fraction must be given')
+    inBam= pysam.AlignmentFile(bam)
+    chroms= list(inBam.references)
+    lib= read_library.ReadLibrary(chroms, dict(zip(chroms, inBam.lengths)))
+    if n is not None:
+        offsets= reservoir_offsets(inBam, n, random.Random(seed), requiredFlag, filterFlag, mapq)
+        reads= reads_at(inBam, offsets)
+    else:
+        reads= hash_sample(filtered_reads(inBam, requiredFlag, filterFlag, mapq), fraction, seed if seed is not None else 0)
+    outBam= pysam.AlignmentFile(out_bam, 'wb', template= inBam)
+    tids= array.array('l')
+    starts= array.array('l')
+    ends= array.array('l')
+    reverse= array.array('b')
+    nreads= 0
+    for aln in reads:
+        outBam.write(aln)
+        nreads += 1
+        if aln.is_unmapped or aln.reference_end is None:
+            continue
+        tids.append(aln.reference_id)
+        starts.append(aln.reference_start)
+        ends.append(aln.reference_end)
+        reverse.append(aln.is_reverse)
+    outBam.close()
+    inBam.close()
+    tids= numpy.array(tids, dtype= numpy.int64)
+    order= numpy.argsort(tids, kind= 'mergesort')
+    tids= tids[order]
+    starts= numpy.array(starts, dtype= numpy.int64)[order]
+    ends= numpy.array(ends, dtype= numpy.int64)[order]
+    reverse= numpy.array(reverse, dtype= bool)[order]
+    for tid in numpy.unique(tids):
+        a, b= numpy.searchsorted(tids, [tid, tid + 1])
+        lib.add(chroms[tid], starts[a:b], ends[a:b], reverse[a:b])
+    lib.library_size= nreads
+    return lib
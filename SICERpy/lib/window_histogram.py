@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Histogram of the windows by read count.
+
+Entry i of the histogram is the number of windows with i reads, as built by
+get_windows_histogram.py from the summary graph: the read count of each
+window with reads is multiplied by the rescale factor and truncated to int;
+the windows without reads are the genome length divided by the window size
+(rounded) minus the windows with reads. Counts are binned with numpy.bincount
+so the histogram can be filled with the window counts of each chromosome as
+they are computed, e.g. by run-make-graph-file-by-chrom_bam.py, without
+reading the summary graph again.
+
+Chromosome lengths are taken from the header of a bam file or from a fasta
+index (.fai) or any tab separated file of chromosome name and length.
+"""
+
+import numpy
+import pysam
+
+class WindowHistogram:
+
+    def __init__(self, window_size, genome_length, rescale_factor= 1):
+        self.window_size= window_size
+        self.genome_length= genome_length
+        self.rescale_factor= rescale_factor
+        self.counts= numpy.zeros(1, dtype= numpy.int64)
+        self.occupied= 0
+
+    def add(self, counts):
+        """Add the read counts of some windows. Windows without reads are
+        ignored, so counts can be a dense vector of all the windows.
+        """
+        counts= numpy.asarray(counts)
+        counts= counts[counts > 0]
+        if len(counts) == 0:
+            return
+        bins= (self.rescale_factor * counts.astype(float)).astype(numpy.int64)
+        hist= numpy.bincount(bins)
+        if len(hist) > len(self.counts):
+            self.counts= numpy.concatenate([self.counts, numpy.zeros(len(hist) - len(self.counts), dtype= numpy.int64)])
+        self.counts[:len(hist)] += hist
+        self.occupied += len(counts)
+
+    def histogram(self):
+        """List with the number of windows by read count, windows without
+        reads included. As in get_windows_histogram, counts are floats and
+        the read counts not found are int 0.
+        """
+        hist= [float(x) if x > 0 else 0 for x in self.counts.tolist()]
+        hist[0]= float(self.counts[0]) + round(float(self.genome_length) / self.window_size) - self.occupied
+        return hist
+
+    def total_tags(self):
+        return float((numpy.arange(len(self.counts)) * self.counts).sum())
+
+    def write(self, filename):
+        """Write the histogram as get_windows_histogram.output_windows_histogram.
+        """
+        fout= open(filename, 'w')
+        fout.write("# read_cout" + "\t" + "Observed_histogram" + "\n")
+        for i, n in enumerate(self.histogram()):
+            fout.write(str(i) + "\t" + str(n) + "\n")
+        fout.close()
+        return filename
+
+def chrom_lengths(filename):
+    """Dict {chrom: length} from the header of a bam file or from a fasta index
+    (.fai), i.e. a tab separated file of chromosome name and length.
+    """
+    if filename.endswith('.bam'):
+        inBam= pysam.AlignmentFile(filename)
+        lengths= dict(zip(inBam.references, inBam.lengths))
+        inBam.close()
+        return lengths
+    lengths= {}
+    fin= open(filename)
+    for line in fin:
+        if line.strip() == '' or line.startswith('#'):
+            continue
+        sline= line.split('\t')
+        lengths[sline[0]]= int(sline[1])
+    fin.close()
+    return lengths
@@ -27,62 +27,46 @@ import associate_tags_with_regions
 import SeparateByChrom
 import get_total_tag_counts
 import Utility
+import read_library
+import candidate_islands
 import scipy
 import scipy.stats
 import pysam
 
-def main(argv):
-    parser = OptionParser()
-    # parser.add_option("-s", "--species", action="store", type="string", dest="species", help="species, mm8, hg18", metavar="<str>")
-    parser.add_option("-a", "--rawchipreadfile", action="store", type="string", dest="chipreadfile", metavar="<file>", help="raw read file from chip in bed format")
-    parser.add_option("-b", "--rawcontrolreadfile", action="store", type="string", dest="controlreadfile", metavar="<file>", help="raw read file from control in BAM format")
-    parser.add_option("-f", "--fragment_size", action="store", type="int", dest="fragment_size", metavar="<int>", help="average size of a fragment after CHIP experiment")
-    parser.add_option("-d", "--islandfile", action="store", type="string", dest="islandfile", metavar="<file>", help="island file in BED format")
-    parser.add_option("-o", "--outfile", action="store", type="string", dest="out_file", metavar="<file>", help="island read count summary file")
-    parser.add_option("-t", "--mappable_fraction_of_genome_size ", action="store", type="float", dest="fraction", help="mapable fraction of genome size", metavar="<float>")
+def load_reads(readfile, requiredFlag= 0, filterFlag= 0, mapq= 0):
+    """Read library from a .npz file written by remove_redundant_reads_bam.py
+    or from a bam file, whose reads are filtered as in read_library.read_bam.
+    """
+    if read_library.is_library_file(readfile):
+        return read_library.load(readfile)
+    return read_library.read_bam(readfile, requiredFlag, filterFlag, mapq)
 
-    (opt, args) = parser.parse_args(argv)
-    #if len(argv) < 14:
-    #    parser.print_help()
-    #    sys.exit(1)
-    #
-    #if opt.species in GenomeData.species_chroms.keys():
-    #    chroms = GenomeData.species_chroms[opt.species];
-    #    genomesize = sum (GenomeData.species_chrom_lengths[opt.species].values());
-    #    genomesize = opt.fraction * genomesize;
-    #else:
-    #    sys.stderr.write("This species is not recognized, exiting\n")
-    #    sys.exit(1)
-    chromsDict= SeparateByChrom.getChromsFromBam(opt.chipreadfile)
-    genomesize= sum(chromsDict.values()) * opt.fraction
-
-    chip_library_size=get_total_tag_counts.get_total_tag_counts_bam(opt.chipreadfile);
-    control_library_size=get_total_tag_counts.get_total_tag_counts_bam(opt.controlreadfile);
-    sys.stderr.write("chip library size  %s\n" %(chip_library_size))
-    sys.stderr.write("control library size %s\n" %(control_library_size))
-
-    totalchip = 0
-    totalcontrol = 0
+def fetch_regions(islandfile, chroms, candidates= None):
+    """Regions where reads are needed: the islands in islandfile or, if
+    given, the candidate islands, which include them. Return dict {chrom:
+    (sorted starts, ends)} for read_library.fetch_library.
+    """
+    regions= {}
+    if candidates:
+        for chrom, island_list in candidate_islands.read(candidates)[1].items():
+            island_list= sorted(island_list)
+            regions[chrom]= ([x[0] for x in island_list], [x[1] for x in island_list])
+        return regions
+    islands= BED.BED(chroms, islandfile, "BED3", 0)
+    for chrom in islands.keys():
+        island_list= sorted(islands[chrom], key= operator.attrgetter('start'))
+        regions[chrom]= ([x.start for x in island_list], [x.end for x in island_list])
+    return regions
 
-    islands = BED.BED(chromsDict.keys(), opt.islandfile, "BED3", 0)
-
-    # separate by chrom the chip library
-    if Utility.fileExists(opt.chipreadfile):
-        SeparateByChrom.separateByChromBamToBed(chromsDict.keys(), opt.chipreadfile, '.bed1');
-    else:
-        sys.stderr.write(opt.chipreadfile + " not found")
-        sys.exit(1)
-    # separate by chrom the control library
-    if Utility.fileExists(opt.controlreadfile):
-        SeparateByChrom.separateByChromBamToBed(chromsDict.keys(), opt.controlreadfile, '.bed2');
-    else:
-        sys.stderr.write(opt.controlreadfile + " not found")
-        sys.exit(1)    
-
-    island_chip_readcount = {};
-    island_control_readcount = {};
-
-    for chrom in chromsDict:
+def count_reads_on_islands(islands, chroms, library, fragment_size):
+    """
+    Count the reads of library on each island. The island lists are sorted
+    in place if necessary.
+    Return ({chrom: [read count on each island]}, total reads on islands)
+    """
+    total = 0
+    island_readcount = {};
+    for chrom in chroms:
         if chrom in islands.keys():
             if len(islands[chrom]) != 0:
                 island_list = islands[chrom];
@@ -95,53 +79,28 @@ def main(argv):
                     island_start_list.append(item.start)
                     island_end_list.append(item.end)
 
-                island_chip_readcount_list=[0]*len(island_list);
-                read_file = chrom + ".bed1";
-                f = open(read_file,'r')
-                for line in f:
-                    if not re.match("#", line):
-                        line = line.strip()
-                        sline = line.split()
-                        position = associate_tags_with_regions.tag_position(sline, opt.fragment_size)
-                        index =associate_tags_with_regions.find_readcount_on_islands(island_start_list, island_end_list, position);
-                        if index >= 0:
-                            island_chip_readcount_list[index] += 1;
-                            totalchip += 1;
-                f.close();
-                island_chip_readcount[chrom] = island_chip_readcount_list;
-
-                island_control_readcount_list=[0]*len(island_list);
-                read_file = chrom + ".bed2";
-                f = open(read_file,'r')
-                for line in f:
-                    if not re.match("#", line):
-                        line = line.strip()
-                        sline = line.split()
-                        position = associate_tags_with_regions.tag_position(sline, opt.fragment_size)
-                        index = associate_tags_with_regions.find_readcount_on_islands(island_start_list, island_end_list, position);
-                        if index >= 0:
-                            island_control_readcount_list[index] += 1;
-                            totalcontrol += 1;
-                f.close();
-
-                island_control_readcount[chrom] = island_control_readcount_list;            
-
-    chip_background_read = chip_library_size - totalchip;
-    control_background_read = control_library_size - totalcontrol;
-    #scaling_factor = chip_background_read*1.0/control_background_read;
-    scaling_factor = chip_library_size*1.0/control_library_size;
-
-
-    print "Total number of chip reads on islands is: ", totalchip; 
-    print "Total number of control reads on islands is: ", totalcontrol; 
+                positions= read_library.tag_positions(library, chrom, fragment_size)
+                island_readcount_list= read_library.count_tags_on_islands(positions, island_start_list, island_end_list)
+                total += int(island_readcount_list.sum())
+                island_readcount[chrom] = island_readcount_list.tolist();
+    return (island_readcount, total)
 
-    #print "chip_background_read   ", chip_background_read
-    #print "control_background_read   ", control_background_read
+def island_significance(islands, chroms, island_chip_readcount, island_control_readcount, chip_library_size, control_library_size, genomesize, scaling_factor= None):
+    """
+    Poisson p-value and fold change of the chip read count on each island
+    given the control read count. The control is scaled by scaling_factor,
+    by default the ratio of the library sizes.
+    Return (result_list, pvalue_list) sorted by chromosome.
+    """
+    #chip_background_read = chip_library_size - totalchip;
+    #control_background_read = control_library_size - totalcontrol;
+    #scaling_factor = chip_background_read*1.0/control_background_read;
+    if scaling_factor is None:
+        scaling_factor = chip_library_size*1.0/control_library_size;
 
-    out = open(opt.out_file, 'w');
     pvalue_list = [];
     result_list = [];
-    for chrom in sorted(chromsDict.keys()):
+    for chrom in sorted(chroms):
         if chrom in islands.keys():
             if len(islands[chrom]) != 0:
                 island_list = islands[chrom];
@@ -172,7 +131,39 @@ def main(argv):
                     item_dic['pvalue'] = pvalue
                     item_dic['fc'] = fc
                     result_list.append(item_dic)
+    return (result_list, pvalue_list)
+
+OUTPUT_BUFFER_SIZE= 1 << 20
 
+def bgzip_name(out_file):
+    """Name of the bgzip'd version of out_file.
+    """
+    if out_file.endswith('.gz'):
+        return out_file
+    return out_file + '.gz'
+
+def open_output(out_file):
+    """Buffered output to out_file or to stdout if out_file is '-'.
+    """
+    if out_file == '-':
+        return os.fdopen(os.dup(sys.stdout.fileno()), 'w', OUTPUT_BUFFER_SIZE)
+    return open(out_file, 'w', OUTPUT_BUFFER_SIZE)
+
+def write_island_summary(result_list, pvalue_list, out_file, bgzip= False, fdr_cutoff= None):
+    """
+    Write the islands with read counts, p-value, fold change and FDR (BH).
+    out_file can be '-' for stdout. With bgzip, out_file is compressed with
+    bgzip and indexed with tabix, see bgzip_name() for the name of the output.
+    If fdr_cutoff is given, only the islands with FDR <= fdr_cutoff are written.
+    Return the list of FDR values.
+    """
+    if bgzip:
+        if out_file == '-':
+            raise ValueError('Cannot bgzip and index the output sent to stdout')
+        final_file= bgzip_name(out_file)
+        out_file= final_file[:-len('.gz')]
+    out = open_output(out_file);
+    fdr_list = [];
     pvaluearray=scipy.array(pvalue_list);
     pvaluerankarray=scipy.stats.rankdata(pvaluearray);
     totalnumber = len(result_list);
@@ -181,6 +172,9 @@ def main(argv):
         alpha = pvalue_list[i] * totalnumber/pvaluerankarray[i];
         if alpha > 1:
             alpha = 1;
+        fdr_list.append(alpha);
+        if fdr_cutoff is not None and alpha > fdr_cutoff:
+            continue
         outline = item['chrom'] + "\t" + str(item['start']) + "\t" + str(item['end']) + "\t" + str(item['chip']) + "\t" + str(item['control']) + "\t" + str(item['pvalue']) + "\t" + str(item['fc']) + "\t" + str(alpha) + "\n";    
         out.write(outline);
 
@@ -193,11 +187,101 @@ def main(argv):
         #outline = item['chrom'] + "\t" + str(item['start']) + "\t" + str(item['end']) + "\t" + str(item['chip']) + "\t" + str(item['control']) + "\t" + str(item['pvalue']) + "\t" + str(item['fc']) + "\t" + str(alpha) + "\n";    
         #out.write(outline);        
     out.close();
+    if bgzip:
+        pysam.tabix_index(out_file, preset= 'bed', force= True)
+    return fdr_list;
+
+def main(argv):
+    parser = OptionParser()
+    # parser.add_option("-s", "--species", action="store", type="string", dest="species", help="species, mm8, hg18", metavar="<str>")
+    parser.add_option("-a", "--rawchipreadfile", action="store", type="string", dest="chipreadfile", metavar="<file>", help="raw read file from chip in BAM format or read library (.npz)")
+    parser.add_option("-b", "--rawcontrolreadfile", action="store", type="string", dest="controlreadfile", metavar="<file>", help="raw read file from control in BAM format or read library (.npz)")
+    parser.add_option("-f", "--fragment_size", action="store", type="int", dest="fragment_size", metavar="<int>", help="average size of a fragment after CHIP experiment")
+    parser.add_option("-d", "--islandfile", action="store", type="string", dest="islandfile", metavar="<file>", help="island file in BED format")
+    parser.add_option("-o", "--outfile", action="store", type="string", dest="out_file", metavar="<file>", help="island read count summary file. Use - for stdout")
+    parser.add_option("-q", "--fdr", action="store", type="float", dest="fdr", default= None, metavar="<float>", help="Optional: write only the islands with FDR up to this")
+    parser.add_option("-A", "--candidates", action="store", type="string", dest="candidates", default= None, metavar="<file>", help="Optional: candidate islands written by find_islands_in_pr.py -a. The chip and control reads are counted on them and the result written to --candidates_out")
+    parser.add_option("-c", "--candidates_out", action="store", type="string", dest="candidates_out", default= None, metavar="<file>", help="Output for the candidate islands with read counts, see rescore_islands.py")
+    parser.add_option("-x", "--fetch", action="store_true", dest="fetch", default= False, help="read only the reads around the islands (and the candidate islands) using the bam index. Chip and control must be coordinate sorted and indexed bam files. Reads are filtered with -R, -F, -Q as without -x. The library sizes are taken from the index: as without -x, they are the number of records in the bam files, filtered or not")
+    parser.add_option("-R", "--requiredFlag", action="store", type="int", dest="requiredFlag", default= 0, metavar="<int>", help="bam files: keep only reads with all these bits set in the flag. Default %default")
+    parser.add_option("-F", "--filterFlag", action="store", type="int", dest="filterFlag", default= 0, metavar="<int>", help="bam files: discard reads with any of these bits set in the flag. Default %default")
+    parser.add_option("-Q", "--mapq", action="store", type="int", dest="mapq", default= 0, metavar="<int>", help="bam files: discard reads with mapping quality below this. Default %default. Read libraries (.npz) are used as they are")
+    parser.add_option("-z", "--bgzip", action="store_true", dest="bgzip", default= False, help="compress the output with bgzip and index it with tabix. The output file gets the .gz suffix if it does not have it already")
+    parser.add_option("-t", "--mappable_fraction_of_genome_size ", action="store", type="float", dest="fraction", help="mapable fraction of genome size", metavar="<float>")
+
+    (opt, args) = parser.parse_args(argv)
+    #if len(argv) < 14:
+    #    parser.print_help()
+    #    sys.exit(1)
+    #
+    #if opt.species in GenomeData.species_chroms.keys():
+    #    chroms = GenomeData.species_chroms[opt.species];
+    #    genomesize = sum (GenomeData.species_chrom_lengths[opt.species].values());
+    #    genomesize = opt.fraction * genomesize;
+    #else:
+    #    sys.stderr.write("This species is not recognized, exiting\n")
+    #    sys.exit(1)
+    for readfile in [opt.chipreadfile, opt.controlreadfile]:
+        if not Utility.fileExists(readfile):
+            sys.stderr.write(readfile + " not found\n")
+            sys.exit(1)
+    if opt.bgzip and opt.out_file == '-':
+        sys.stderr.write("Output to stdout cannot be compressed and indexed\n")
+        sys.exit(1)
+
+    if opt.fetch:
+        regions= fetch_regions(opt.islandfile, SeparateByChrom.getChromsFromBam(opt.chipreadfile).keys(), opt.candidates)
+        chip_library= read_library.fetch_library(opt.chipreadfile, regions, opt.fragment_size, requiredFlag= opt.requiredFlag, filterFlag= opt.filterFlag, mapq= opt.mapq)
+        control_library= read_library.fetch_library(opt.controlreadfile, regions, opt.fragment_size, requiredFlag= opt.requiredFlag, filterFlag= opt.filterFlag, mapq= opt.mapq)
+    else:
+        chip_library= load_reads(opt.chipreadfile, opt.requiredFlag, opt.filterFlag, opt.mapq)
+        control_library= load_reads(opt.controlreadfile, opt.requiredFlag, opt.filterFlag, opt.mapq)
+
+    chromsDict= chip_library.chrom_lengths
+    genomesize= sum(chromsDict.values()) * opt.fraction
+
+    chip_library_size= chip_library.size()
+    control_library_size= control_library.size()
+    sys.stderr.write("chip library size  %s\n" %(chip_library_size))
+    sys.stderr.write("control library size %s\n" %(control_library_size))
+
+    islands = BED.BED(chromsDict.keys(), opt.islandfile, "BED3", 0)
+
+    (island_chip_readcount, totalchip) = count_reads_on_islands(islands, chromsDict.keys(), chip_library, opt.fragment_size)
+    (island_control_readcount, totalcontrol) = count_reads_on_islands(islands, chromsDict.keys(), control_library, opt.fragment_size)
+
+    ## To stderr since the output may go to stdout
+    sys.stderr.write("Total number of chip reads on islands is: %s\n" %(totalchip))
+    sys.stderr.write("Total number of control reads on islands is: %s\n" %(totalcontrol))
 
+    (result_list, pvalue_list) = island_significance(islands, chromsDict.keys(), island_chip_readcount, island_control_readcount, chip_library_size, control_library_size, genomesize)
+    write_island_summary(result_list, pvalue_list, opt.out_file, opt.bgzip, opt.fdr)
 
-    SeparateByChrom.cleanup(chromsDict.keys(), '.bed1');
-    SeparateByChrom.cleanup(chromsDict.keys(), '.bed2');
+    if opt.candidates:
+        write_candidates(opt.candidates, opt.candidates_out, chromsDict.keys(), chip_library, control_library, opt.fragment_size, genomesize)
 
+def write_candidates(candidates_in, candidates_out, chroms, chip_library, control_library, fragment_size, genomesize):
+    """
+    Count chip and control reads on the candidate islands and write them
+    with the library sizes, so that they can be re-scored by rescore_islands.py
+    """
+    (metadata, candidates)= candidate_islands.read(candidates_in)
+    metadata['chip_library_size']= chip_library.size()
+    metadata['control_library_size']= control_library.size()
+    metadata['genomesize']= genomesize
+    metadata['fragment_size']= fragment_size
+    rows= []
+    for chrom in sorted(candidates.keys()):
+        if chrom not in chroms:
+            continue
+        island_list= candidates[chrom]
+        starts= [x[0] for x in island_list]
+        ends= [x[1] for x in island_list]
+        chip= read_library.count_tags_on_islands(read_library.tag_positions(chip_library, chrom, fragment_size), starts, ends)
+        control= read_library.count_tags_on_islands(read_library.tag_positions(control_library, chrom, fragment_size), starts, ends)
+        for i in xrange(len(island_list)):
+            rows.append((chrom, starts[i], ends[i], island_list[i][2], int(chip[i]), int(control[i])))
+    candidate_islands.write(candidates_out, metadata, rows)
 
 
 if __name__ == "__main__":
@@ -22,12 +22,11 @@ from string import *
 from optparse import OptionParser
 import operator
 
-import BED
+import numpy
 import GenomeData;
-import associate_tags_with_regions
-import SeparateByChrom
-import get_total_tag_counts
 import Utility
+import island_overlap
+import count_matrix
 import scipy.stats
 
 def pvaule (chip_read_count, control_read_count, scaling_factor, pseudo_count):
@@ -64,27 +63,83 @@ def fdr(pvalue_list):
 			fdr_value = 1
 		fdr_list.append(fdr_value);
 	return fdr_list;
+
+def pvalues(chip_read_counts, control_read_counts, scaling_factor, pseudo_count):
+	"""
+	Same as pvaule for arrays of read counts, one per island.
+	Return (pvalues, not_enriched): not_enriched is True where the chip count is
+	not above the expected count and the p-value is set to 1.
+	"""
+	chip = numpy.asarray(chip_read_counts)
+	control = numpy.asarray(control_read_counts)
+	average = numpy.where(control > 0, control * scaling_factor, pseudo_count * scaling_factor)
+	not_enriched = ~(chip > average)
+	pvalue_array = numpy.ones(len(chip))
+	enriched = ~not_enriched
+	pvalue_array[enriched] = scipy.stats.poisson.sf(chip[enriched], average[enriched])
+	return (pvalue_array, not_enriched)
+
+def fdr_array(pvalue_array):
+	"""
+	Same as fdr for an array of p-values.
+	Return (fdr values, capped): capped is True where the FDR is set to 1.
+	"""
+	pvalue_array = numpy.asarray(pvalue_array, dtype= float)
+	fdr_values = pvalue_array * len(pvalue_array) / scipy.stats.rankdata(pvalue_array)
+	capped = fdr_values > 1
+	fdr_values[capped] = 1
+	return (fdr_values, capped)
+
+def differential_pvalues(A_counts, B_counts, library_scaling_factor, pseudo_count):
+	"""
+	p-values and BH FDR of the islands in both directions, A vs B and B vs A,
+	given the read counts of the two libraries on the islands.
+	library_scaling_factor is the ratio of the size of A to that of B.
+	Return dict of arrays with keys pvalue_A_vs_B, fdr_A_vs_B, pvalue_B_vs_A,
+	fdr_B_vs_A and, for each, a boolean array with suffix _is_one marking
+	values set to 1.
+	"""
+	result = {}
+	for name, chip, control, scaling_factor in [('A_vs_B', A_counts, B_counts, library_scaling_factor),
+		('B_vs_A', B_counts, A_counts, 1/library_scaling_factor)]:
+		(pvalue_array, not_enriched) = pvalues(chip, control, scaling_factor, pseudo_count)
+		(fdr_values, capped) = fdr_array(pvalue_array)
+		result['pvalue_' + name] = pvalue_array
+		result['pvalue_' + name + '_is_one'] = not_enriched
+		result['fdr_' + name] = fdr_values
+		result['fdr_' + name + '_is_one'] = capped
+	return result
+
+def format_column(values):
+	"""
+	Values as strings, as str() gives them for python numbers.
+	"""
+	return [str(x) for x in numpy.asarray(values).tolist()]
+
+def format_pvalues(values, is_one):
+	"""
+	p-values or FDR as strings, as str() gives them for the numpy floats
+	returned by pvaule and fdr. Where is_one is True the value is written as 1.
+	"""
+	column = [str(x) for x in numpy.asarray(values)]
+	for i in numpy.flatnonzero(is_one):
+		column[i] = '1'
+	return column
 		
 
 def main(argv):
 	parser = OptionParser()
-	parser.add_option("-s", "--species", action="store", type="string", dest="species", help="species, mm8, hg18, etc", metavar="<str>")
-	parser.add_option("-a", "--rawreadfileA", action="store", type="string", dest="readfileA", metavar="<file>", help="raw read file A in bed format")
-	parser.add_option("-b", "--rawreadfileB", action="store", type="string", dest="readfileB", metavar="<file>", help="raw read file B in bed format")
+	parser.add_option("-s", "--species", action="store", type="string", dest="species", help="Optional: species, mm8, hg18, etc, to order the output by the chromosomes of the species. Default: sorted by chromosome name", metavar="<str>")
+	parser.add_option("-a", "--rawreadfileA", action="store", type="string", dest="readfileA", metavar="<file>", help="raw read file A in bed or bam format or read library (.npz)")
+	parser.add_option("-b", "--rawreadfileB", action="store", type="string", dest="readfileB", metavar="<file>", help="raw read file B in bed or bam format or read library (.npz)")
 	parser.add_option("-f", "--fragment_size", action="store", type="int", dest="fragment_size", metavar="<int>", help="average size of a fragment after A experiment")
 	parser.add_option("-d", "--islandfile", action="store", type="string", dest="islandfile", metavar="<file>", help="island file in BED format")
 	parser.add_option("-o", "--outfile", action="store", type="string", dest="out_file", metavar="<file>", help="island read count summary file")
 	
 	(opt, args) = parser.parse_args(argv)
-	if len(argv) < 12:
+	if len(argv) < 10:
         	parser.print_help()
         	sys.exit(1)
-		
-	if opt.species in GenomeData.species_chroms.keys():
-		chroms = GenomeData.species_chroms[opt.species];
-	else:
-		print "This species is not recognized, exiting";
-		sys.exit(1);
 	
 	if not Utility.fileExists(opt.readfileA):
 		print opt.readfileA, " not found";
@@ -93,144 +148,57 @@ def main(argv):
 		print opt.readfileB, " not found";
 		sys.exit(1)	
 	
-	A_library_size = get_total_tag_counts.get_total_tag_counts(opt.readfileA);
-	B_library_size = get_total_tag_counts.get_total_tag_counts(opt.readfileB);
+	islands = island_overlap.read(opt.islandfile);
+	if opt.species in GenomeData.species_chroms.keys():
+		chroms = [x for x in GenomeData.species_chroms[opt.species] if x in islands.starts];
+	else:
+		chroms = islands.chroms();
+	regions = dict([(x, (islands.starts[x], islands.ends[x])) for x in chroms]);
+
+	# Find read counts on the islands
+	(A_library_size, A_counts) = count_matrix.count_reads(opt.readfileA, regions, opt.fragment_size);
+	(B_library_size, B_counts) = count_matrix.count_reads(opt.readfileB, regions, opt.fragment_size);
 	print "Library size of ", opt.readfileA, ":  ", A_library_size
 	print "Library size of ", opt.readfileB, ":  ", B_library_size
 	
-	totalA = 0;
-	totalB = 0;
-	
-	islands = BED.BED(opt.species, opt.islandfile, "BED3", 0);
-	
-	# separate by chrom the A library
-	SeparateByChrom.separateByChrom(chroms, opt.readfileA, '.bed1');
-	# separate by chrom the B library
-	SeparateByChrom.separateByChrom(chroms, opt.readfileB, '.bed2');
-	
-	
-	island_A_readcount = {};
-	island_B_readcount = {};
-	
-	#Find read counts on the islands
+	island_chroms = [];
 	for chrom in chroms:
-		if chrom in islands.keys():
-			if len(islands[chrom]) != 0:
-				island_list = islands[chrom];
-				if Utility.is_bed_sorted(island_list) == 0:
-					island_list.sort(key=operator.attrgetter('start'));
-					
-				island_start_list = []
-				island_end_list = []
-				for item in island_list:
-					island_start_list.append(item.start)
-					island_end_list.append(item.end)
-	
-				island_A_readcount_list=[0]*len(island_list);
-				read_file = chrom + ".bed1";
-				f = open(read_file,'r')
-				for line in f:
-					if not re.match("#", line):
-						line = line.strip()
-						sline = line.split()
-						position = associate_tags_with_regions.tag_position(sline, opt.fragment_size)
-						index =associate_tags_with_regions.find_readcount_on_islands(island_start_list, island_end_list, position);
-						if index >= 0:
-							island_A_readcount_list[index] += 1;
-							totalA += 1;
-				f.close();
-				island_A_readcount[chrom] = island_A_readcount_list;
-							
-				island_B_readcount_list=[0]*len(island_list);
-				read_file = chrom + ".bed2";
-				f = open(read_file,'r')
-				for line in f:
-					if not re.match("#", line):
-						line = line.strip()
-						sline = line.split()
-						position = associate_tags_with_regions.tag_position(sline, opt.fragment_size)
-						index = associate_tags_with_regions.find_readcount_on_islands(island_start_list, island_end_list, position);
-						if index >= 0:
-							island_B_readcount_list[index] += 1;
-							totalB += 1;
-				f.close();		
-				island_B_readcount[chrom] = island_B_readcount_list;			
-						
-	#A_background_read = A_library_size - totalA;
-	#B_background_read = B_library_size - totalB;
-	
-	print "Total number of A reads on islands is: ", totalA; 
-	print "Total number of B reads on islands is: ", totalB; 
+		island_chroms.extend([chrom] * len(regions[chrom][0]));
+	starts = numpy.concatenate([regions[x][0] for x in chroms]) if chroms else numpy.zeros(0, dtype= int);
+	ends = numpy.concatenate([regions[x][1] for x in chroms]) if chroms else numpy.zeros(0, dtype= int);
+	A_array = numpy.concatenate([A_counts[x] for x in chroms]) if chroms else numpy.zeros(0, dtype= int);
+	B_array = numpy.concatenate([B_counts[x] for x in chroms]) if chroms else numpy.zeros(0, dtype= int);
+	
+	print "Total number of A reads on islands is: ", A_array.sum(); 
+	print "Total number of B reads on islands is: ", B_array.sum(); 
 
-	# Calculate the p value.
+	# Calculate the p value and the FDR
 	library_scaling_factor = A_library_size*1.0/B_library_size; #A vs B
 	pseudo_count = 1; 
-	pvalue_A_vs_B_list = [];
-	pvalue_B_vs_A_list = [];
-	for chrom in chroms:
-		if chrom in islands.keys():
-			if len(islands[chrom]) != 0:
-				island_list = islands[chrom];
-				for index in xrange(len(island_list)):
-					item = island_list[index];
-					Acount = (island_A_readcount[chrom])[index]; 
-					Bcount = (island_B_readcount[chrom])[index];
-					pvalue_A_vs_B = pvaule (Acount, Bcount, library_scaling_factor, pseudo_count);
-					pvalue_A_vs_B_list.append(pvalue_A_vs_B);
-					pvalue_B_vs_A = pvaule (Bcount, Acount, 1/library_scaling_factor, pseudo_count);
-					pvalue_B_vs_A_list.append(pvalue_B_vs_A);
-	#Calculate the FDR
-	fdr_A_vs_B_list = fdr(pvalue_A_vs_B_list);
-	fdr_B_vs_A_list = fdr(pvalue_B_vs_A_list);
-
+	result = differential_pvalues(A_array, B_array, library_scaling_factor, pseudo_count);
 
 	#Output the islands read counts, normalized read counts, fc, pvalue both ways
 	scaling_factor = 1000000; 
-	out = open(opt.out_file, 'w');
+	normalized_A = A_array / float(A_library_size) * scaling_factor;
+	normalized_B = B_array / float(B_library_size) * scaling_factor;
+	fc_A_vs_B = ((A_array + pseudo_count)*1.0/(B_array + pseudo_count))/library_scaling_factor;
+	fc_B_vs_A = ((B_array + pseudo_count)*1.0/(A_array + pseudo_count)) * library_scaling_factor;
+	columns = [island_chroms, format_column(starts), format_column(ends), format_column(A_array), format_column(normalized_A),
+		format_column(B_array), format_column(normalized_B), format_column(fc_A_vs_B),
+		format_pvalues(result['pvalue_A_vs_B'], result['pvalue_A_vs_B_is_one']), format_pvalues(result['fdr_A_vs_B'], result['fdr_A_vs_B_is_one']),
+		format_column(fc_B_vs_A),
+		format_pvalues(result['pvalue_B_vs_A'], result['pvalue_B_vs_A_is_one']), format_pvalues(result['fdr_B_vs_A'], result['fdr_B_vs_A_is_one'])];
+	out = open(opt.out_file, 'w', 1 << 20);
 	outline = '#chrom' + "\t" + 'start' + "\t" + 'end' + "\t" + "Readcount_A" + "\t" + 'Normalized_Readcount_A' + "\t" + 'ReadcountB' + "\t" + 'Normalized_Readcount_B' + "\t" + "Fc_A_vs_B" + "\t" + "pvalue_A_vs_B" + "\t" + "FDR_A_vs_B" + "\t" + "Fc_B_vs_A" + "\t" + "pvalue_B_vs_A" + "\t" + "FDR_B_vs_A"  + "\n"; 	
 	out.write(outline);
-	ii=0;
-	for chrom in chroms:
-		if chrom in islands.keys():
-			if len(islands[chrom]) != 0:
-				island_list = islands[chrom];
-				for index in xrange(len(island_list)):
-					item = island_list[index];
-					Acount = (island_A_readcount[chrom])[index]; 
-					Bcount = (island_B_readcount[chrom])[index];
-					normalized_A = Acount/ float(A_library_size) * scaling_factor;
-					normalized_B = Bcount/ float(B_library_size) * scaling_factor;
-					fc_A_vs_B = ((Acount + pseudo_count)*1.0/(Bcount + pseudo_count))/library_scaling_factor;
-					fc_B_vs_A = ((Bcount + pseudo_count)*1.0/(Acount + pseudo_count)) * library_scaling_factor;
-					outline = item.chrom + "\t" + str(item.start) + "\t" + str(item.end) + "\t" + str(Acount) + "\t"  +  str(normalized_A) + "\t"  +  str(Bcount) + "\t" + str(normalized_B) + "\t" +  str(fc_A_vs_B) + "\t" + str(pvalue_A_vs_B_list[ii]) + "\t" + str(fdr_A_vs_B_list[ii]) + "\t" + str(fc_B_vs_A) + "\t" + str(pvalue_B_vs_A_list[ii]) + "\t" + str(fdr_B_vs_A_list[ii]) + "\n";	
-					out.write(outline);
-					ii += 1;		
+	out.writelines(['\t'.join(x) + '\n' for x in zip(*columns)]);
 	out.close();
 
-	SeparateByChrom.cleanup(chroms, '.bed1');
-	SeparateByChrom.cleanup(chroms, '.bed2');
-
-
 	# Calculate the correlations using normalized read counts
-	A_array=();
-	B_array=();
-	for chrom in chroms:
-		if chrom in islands.keys():
-			if len(islands[chrom]) != 0:
-				temp_array= scipy.array(island_A_readcount[chrom]);
-				A_array=scipy.concatenate((temp_array, A_array));
-				temp_array= scipy.array(island_B_readcount[chrom]);
-				B_array=scipy.concatenate((temp_array, B_array));
-	#Normalization to reads per million
-	A_array = A_array/float(A_library_size) * scaling_factor;
-	B_array = B_array/float(B_library_size) * scaling_factor;
-	pearson=scipy.stats.pearsonr(A_array, B_array);
+	pearson=scipy.stats.pearsonr(normalized_A, normalized_B);
 	print "Pearson's correlation is: ", pearson[0], " with p-value ",  pearson[1];
-	spearman = scipy.stats.spearmanr(A_array, B_array);
+	spearman = scipy.stats.spearmanr(normalized_A, normalized_B);
 	print "Spearman's correlation is: ", spearman[0], " with p-value ",  spearman[1];
-	
-	
-
 
 
 if __name__ == "__main__":
@@ -19,12 +19,21 @@ from math import *
 from string import *
 from optparse import OptionParser
 import operator
+import hashlib
+import json
+import tempfile
+import numpy
 
 import BED
 import SeparateByChrom # GenomeData
 import get_total_tag_counts
 import Background_island_probscore_statistics
 import Utility
+import dense_windows
+import candidate_islands
+import chrom_scheduler
+import island_chunks
+import island_statistics
 
 """ 
 Take in coords for bed_gaph type summary files and find 'islands' of modifications.
@@ -162,6 +171,164 @@ def find_region_above_threshold_from_file(Islands_file, chromList, islands_minim
 
 
 
+def read_summary_graph(summary_graph_file, chroms):
+    """
+    Read the summary graph into a dict {chrom: (window starts, read counts)}
+    of arrays, sorted by window start. Only the windows with reads are in the
+    summary graph so nothing is allocated for the empty stretches of the genome.
+    """
+    starts= {}
+    counts= {}
+    infile= open(summary_graph_file)
+    for line in infile:
+        if line.startswith('track'):
+            continue
+        sline= line.split()
+        if len(sline) < 4 or sline[0] not in chroms:
+            continue
+        if sline[0] not in starts:
+            starts[sline[0]]= []
+            counts[sline[0]]= []
+        starts[sline[0]].append(atoi(sline[1]))
+        counts[sline[0]].append(atof(sline[3]))
+    infile.close()
+    windows= {}
+    for chrom in starts:
+        window_starts= numpy.array(starts[chrom], dtype= numpy.int64)
+        window_counts= numpy.array(counts[chrom], dtype= float)
+        order= numpy.argsort(window_starts, kind= 'mergesort')
+        windows[chrom]= (window_starts[order], window_counts[order])
+    return windows
+
+def window_probscores(counts, average):
+    """
+    Probability score of each window of an array of read counts, -log of the
+    Poisson probability of the read count given the window average, 1000 if
+    the probability is below 1e-250. The score is computed once for each
+    distinct read count.
+    """
+    values, inverse= numpy.unique(numpy.asarray(counts, dtype= float), return_inverse= True)
+    value_scores= numpy.empty(len(values))
+    for i, read_count in enumerate(values.tolist()):
+        prob = poisson(read_count, average);
+        if prob < 1e-250:
+            value_scores[i]= 1000; #outside of the scale, take an arbitrary number.
+        else:
+            value_scores[i]= -log(prob);
+    return value_scores[inverse]
+
+def window_scores(counts, average, min_tags_in_window, probscores= None):
+    """
+    Scores of the windows, only care about enrichment: the probability score
+    (window_probscores) of the windows with at least min_tags_in_window
+    reads, -1 for the others. probscores, if given, are the probability
+    scores of counts already computed, e.g. shared by several gap sizes.
+    """
+    counts= numpy.asarray(counts, dtype= float)
+    if probscores is None:
+        probscores= window_probscores(counts, average)
+    return numpy.where(counts < min_tags_in_window, -1.0, probscores)
+
+def sparse_islands(window_starts, scores, window_size, gap, score_threshold, window_size_buffer= 2):
+    """
+    Island calling on the windows with reads of one chromosome, given as
+    sorted arrays of window starts and window scores (window_scores).
+    Eligible windows, those with score > 0, closer than gap +
+    window_size_buffer are joined using the distance between their
+    coordinates, so the empty windows in between are never looked at.
+    Return (island starts, island ends, island scores) of the islands with
+    score above score_threshold.
+    """
+    window_starts= numpy.asarray(window_starts, dtype= numpy.int64)
+    eligible= scores > 0
+    chunk= island_chunks.join_windows(None, 0, 0, window_starts[eligible], scores[eligible].tolist(), window_size, gap, window_size_buffer)
+    return chunk.islands(score_threshold)
+
+## Windows and settings of chunk_islands. Set before starting the workers so
+## they are shared with them.
+shared= {}
+
+def chunk_islands(region):
+    """
+    IslandChunk of the region (chrom, start, end) from the windows in shared,
+    see island_chunks.py. Run by the workers of chunked_islands.
+    """
+    chrom, start, end = region
+    window_starts, counts = shared['windows'][chrom]
+    a, b = numpy.searchsorted(window_starts, [start, end])
+    scores= window_scores(counts[a:b], shared['average'], shared['min_tags_in_window'])
+    eligible= scores > 0
+    return island_chunks.join_windows(chrom, start, end, window_starts[a:b][eligible], scores[eligible].tolist(), shared['window_size'], shared['gap'])
+
+def chunked_islands(windows, chrom_lengths, window_size, gap, average, min_tags_in_window, nproc):
+    """
+    Island calling on all the chromosomes in windows, {chrom: (window starts,
+    read counts)}, split in chunks processed by nproc processes. Chunks are
+    merged back so the islands are the same as those of sparse_islands on
+    whole chromosomes. Return {chrom: IslandChunk}.
+    """
+    shared.update({'windows': windows, 'average': average, 'min_tags_in_window': min_tags_in_window,
+        'window_size': window_size, 'gap': gap})
+    tasks= chrom_scheduler.make_tasks(windows.keys(), chrom_lengths, window_size, nproc)
+    results= chrom_scheduler.run_tasks(chunk_islands, tasks, nproc)
+    by_chrom= chrom_scheduler.results_by_chrom(tasks, results)
+    chunks= {}
+    for chrom in by_chrom:
+        chunks[chrom]= island_chunks.reduce_chunks([x[1] for x in by_chrom[chrom]], gap)
+    return chunks
+
+def write_sparse_islands(islands_by_chrom, out_island_file):
+    """
+    Write islands, given as dict {chrom: (starts, ends, scores)}, to file and
+    return the number of islands.
+    """
+    total_number_islands = 0;
+    outputfile = open(out_island_file, 'w');
+    for chrom in islands_by_chrom.keys():
+        island_starts, island_ends, island_scores = islands_by_chrom[chrom];
+        total_number_islands += len(island_scores);
+        if len(island_scores)>0:
+            for start, end, score in zip(island_starts.tolist(), island_ends.tolist(), island_scores):
+                outputfile.write(chrom + "\t" + str(start) + "\t" + str(end) + "\t" + str(score) + "\n");
+        else:
+            sys.stderr.write("\t" + chrom + " does not have any islands meeting the required significance\n");
+    outputfile.close();
+    return total_number_islands;
+
+def background_threshold(total_read_count, window_size, gap, window_pvalue, genome_length, bin_size, evalue, cache_dir= None):
+    """
+    Return (min_tags_in_window, score_threshold) from the random background model.
+    
+    The background model depends only on the arguments given here. If cache_dir
+    is set, the result is stored there and reused by other runs with the same
+    settings, e.g. several treatments with the same library size.
+    """
+    if cache_dir:
+        desc= json.dumps([total_read_count, window_size, gap, window_pvalue, genome_length, bin_size, evalue])
+        cache_file= os.path.join(cache_dir, hashlib.sha1(desc).hexdigest() + '.json')
+        if os.path.isfile(cache_file):
+            fin= open(cache_file)
+            cached= json.load(fin)
+            fin.close()
+            sys.stderr.write("Background model taken from %s\n" %(cache_file))
+            return (cached['min_tags_in_window'], cached['score_threshold'])
+    background = Background_island_probscore_statistics.Background_island_probscore_statistics(total_read_count, window_size, gap, window_pvalue, genome_length, bin_size);
+    min_tags_in_window = background.min_tags_in_window
+    score_threshold = background.find_island_threshold(evalue); 
+    if cache_dir:
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                pass
+        fd, tmp= tempfile.mkstemp(dir= cache_dir, suffix= '.tmp')
+        fout= os.fdopen(fd, 'w')
+        json.dump({'min_tags_in_window': min_tags_in_window, 'score_threshold': score_threshold}, fout)
+        fout.close()
+        os.rename(tmp, cache_file)
+    return (min_tags_in_window, score_threshold)
+
+
 def main(argv):
     """
     Probability scoring with random background model.
@@ -171,12 +338,16 @@ def main(argv):
     
     #parser.add_option("-s", "--species", action="store", type="string", dest="species", help="mm8, hg18, background, etc", metavar="<str>")
     parser.add_option("-B", "--bam", action="store", type="string", dest="bam", help="Any suitable bam file that can be used to extrcat chroms from header", metavar="<str>")
-    parser.add_option("-b", "--summarygraph", action="store",type="string", dest="summarygraph", help="summarygraph", metavar="<file>")
+    parser.add_option("-b", "--summarygraph", action="store",type="string", dest="summarygraph", help="summarygraph, as bed graph or as dense window counts (see dense_windows.py)", metavar="<file>")
     parser.add_option("-w", "--window_size(bp)", action="store", type="int", dest="window_size", help="window_size(in bps)", metavar="<int>")
     parser.add_option("-g", "--gap_size(bp)", action="store", type="int",  dest="gap", help="gap size (in bps)", metavar="<int>")
     parser.add_option("-t", "--mappable_fraction_of_genome_size ", action="store", type="float", dest="fraction", help="mapable fraction of genome size", metavar="<float>")
     parser.add_option("-e", "--evalue ", action="store", type="float", dest="evalue", help="evalue that determines score threshold for significant islands", metavar="<float>")
     parser.add_option("-f", "--out_island_file", action="store", type="string", dest="out_island_file", help="output island file name", metavar="<file>")
+    parser.add_option("-a", "--candidates", action="store", type="string", dest="candidates", default= None, help="Optional: write all the islands, before applying the score threshold, to this file together with the parameters of the background model. See candidate_islands.py", metavar="<file>")
+    parser.add_option("-p", "--nproc", action="store", type="int", dest="nproc", default= 1, help="Optional: number of processes. Chromosomes are split in chunks of similar size, see chrom_scheduler.py. Default %default", metavar="<int>")
+    parser.add_option("-S", "--statistics", action="store", type="string", dest="statistics", default= None, help="Optional: write the statistics of the islands (lengths, scores, genome coverage) to <prefix>.island_statistics.tsv, <prefix>.island_length_histogram.tsv and <prefix>.island_score_histogram.tsv. See island_statistics.py", metavar="<prefix>")
+    parser.add_option("-c", "--background_cache", action="store", type="string", dest="background_cache", default= None, help="Optional: directory where to cache the background model for reuse by other runs", metavar="<dir>")
     
     (opt, args) = parser.parse_args(argv)
     if len(argv) < 14:
@@ -191,79 +362,73 @@ def main(argv):
     sys.stderr.write("Gap size: %s\n" %(opt.gap))
     sys.stderr.write("E value is: %s\n" %(opt.evalue))
     
-    total_read_count = get_total_tag_counts.get_total_tag_counts_bed_graph(opt.summarygraph);
+    ## Only the windows with reads are kept: {chrom: (window starts, read counts)}
+    if dense_windows.is_dense_file(opt.summarygraph):
+        dense= dense_windows.DenseWindows(opt.summarygraph)
+        if dense.window_size != opt.window_size:
+            sys.stderr.write("Window size of %s is %s, expected %s\n" %(opt.summarygraph, dense.window_size, opt.window_size))
+            sys.exit(1)
+        windows= {}
+        for chrom in chromsDict.keys():
+            window_starts, counts= dense.nonzero(chrom)
+            if len(counts) > 0:
+                windows[chrom]= (window_starts, counts.astype(float))
+    else:
+        windows= read_summary_graph(opt.summarygraph, chromsDict)
+    total_read_count = 0.0;
+    occupied_windows = 0;
+    for chrom in windows:
+        total_read_count += float(windows[chrom][1].sum());
+        occupied_windows += len(windows[chrom][1]);
     sys.stderr.write("Total read count: %s\n" %(total_read_count))
     genome_length = sum(chromsDict.values()) ## sum (GenomeData.species_chrom_lengths[opt.species].values());
     sys.stderr.write("Genome Length: %s\n" %(genome_length));
+    full_genome_length = genome_length
     genome_length = int(opt.fraction * genome_length);
 
     average = float(total_read_count) * opt.window_size/genome_length; 
     sys.stderr.write("Effective genome Length: %s\n" %(genome_length));
     sys.stderr.write("Window average: %s\n" %(average));
+    sys.stderr.write("Windows with reads: %s; empty windows skipped: %s\n" %(occupied_windows, sum([x // opt.window_size for x in chromsDict.values()]) - occupied_windows));
     
     window_pvalue = 0.20;
     bin_size = 0.001;
     sys.stderr.write("Window pvalue: %s\n" %(window_pvalue))
-    background = Background_island_probscore_statistics.Background_island_probscore_statistics(total_read_count, opt.window_size, opt.gap, window_pvalue, genome_length, bin_size);
-    min_tags_in_window = background.min_tags_in_window
+    (min_tags_in_window, score_threshold) = background_threshold(total_read_count, opt.window_size, opt.gap, window_pvalue, genome_length, bin_size, opt.evalue, opt.background_cache)
     sys.stderr.write("Minimum num of tags in a qualified window: %s\n" %(min_tags_in_window))
     
-    sys.stderr.write("Generate the enriched probscore summary graph and filter the summary graph to get rid of ineligible windows\n"); 
-    #read in the summary graph file
-    bed_val = BED.BED(chromsDict.keys(), opt.summarygraph, "BED_GRAPH");
-    
-    #generate the probscore summary graph file, only care about enrichment
-    #filter the summary graph to get rid of windows whose scores are less than window_score_threshold
-    
-    filtered_bed_val = {};
-    
-    for chrom in bed_val.keys():
-        if len(bed_val[chrom])>0:
-            filtered_bed_val [chrom]= [];
-            for index in xrange(len(bed_val[chrom])):
-                read_count = bed_val[chrom][index].value;
-                if ( read_count < min_tags_in_window):
-                    score = -1;
-                    #score = 0;
-                else:
-                    prob = poisson(read_count, average);
-                    if prob <1e-250:
-                        score = 1000; #outside of the scale, take an arbitrary number.
-                    else:
-                        score = -log(prob);
-                bed_val[chrom][index].value = score;
-                if score > 0:
-                    filtered_bed_val[chrom].append( (bed_val[chrom])[index] );
-                #print chrom, start, read_count, score;
-    
-    #write the probscore summary graph file
-    #Background_simulation_pr.output_bedgraph(bed_val, opt.out_sgraph_file);
-    
-    #Background_simulation_pr.output_bedgraph(filtered_bed_val, opt.out_sgraph_file+".filtered");
-    
     sys.stderr.write("Determine the score threshold from random background\n"); 
     #determine threshold from random background
     hist_outfile="L" + str(genome_length) + "_W" +str(opt.window_size) + "_G" +str(opt.gap) +  "_s" +str(min_tags_in_window) + "_T"+ str(total_read_count) + "_B" + str(bin_size) +"_calculatedprobscoreisland.hist";
-    score_threshold = background.find_island_threshold(opt.evalue); 
     # background.output_distribution(hist_outfile);
     sys.stderr.write("The score threshold is: %s\n" %(score_threshold));
     
     
-    sys.stderr.write("Make and write islands\n");
-    total_number_islands = 0;
-    outputfile = open(opt.out_island_file, 'w');
-    for chrom in filtered_bed_val.keys():
-        if len(filtered_bed_val[chrom])>0:
-            islands = combine_proximal_islands(filtered_bed_val[chrom], opt.gap, 2);
-            islands = find_region_above_threshold(islands, score_threshold);
-            total_number_islands += len(islands);
-            if len(islands)>0:
-                for i in islands:
-                    outline = chrom + "\t" + str(i.start) + "\t" + str(i.end) + "\t" + str(i.value) + "\n";    
-                    outputfile.write(outline);
-            else:
-                sys.stderr.write("\t" + chrom + " does not have any islands meeting the required significance\n");
-    outputfile.close();    
+    sys.stderr.write("Score windows, make and write islands\n");
+    chunks= chunked_islands(windows, chromsDict, opt.window_size, opt.gap, average, min_tags_in_window, opt.nproc);
+    islands_by_chrom = {};
+    candidates_by_chrom = {};
+    for chrom in windows.keys():
+        window_starts, counts = windows[chrom];
+        if numpy.any(counts >= min_tags_in_window):
+            if opt.candidates:
+                candidates_by_chrom[chrom] = chunks[chrom].islands(float('-inf'));
+            islands_by_chrom[chrom] = chunks[chrom].islands(score_threshold);
+    total_number_islands = write_sparse_islands(islands_by_chrom, opt.out_island_file);
+    if opt.candidates:
+        metadata= {'total_read_count': total_read_count, 'window_size': opt.window_size, 'gap': opt.gap,
+                   'window_pvalue': window_pvalue, 'genome_length': genome_length, 'bin_size': bin_size,
+                   'evalue': opt.evalue, 'min_tags_in_window': min_tags_in_window, 'score_threshold': score_threshold}
+        rows= []
+        for chrom in sorted(candidates_by_chrom.keys()):
+            island_starts, island_ends, island_scores = candidates_by_chrom[chrom];
+            rows.extend(zip([chrom] * len(island_scores), island_starts.tolist(), island_ends.tolist(), island_scores))
+        candidate_islands.write(opt.candidates, metadata, rows)
+        sys.stderr.write("Candidate islands written to %s: %s\n" %(opt.candidates, len(rows)))
+    if opt.statistics:
+        statistics= island_statistics.from_islands(islands_by_chrom, full_genome_length)
+        statistics.write_files(opt.statistics)
+        sys.stderr.write("Islands cover %s of the genome\n" %(statistics.coverage))
     sys.stderr.write("Total number of islands: %s\n" %(total_number_islands))
         
     #else:
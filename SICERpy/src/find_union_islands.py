@@ -14,98 +14,87 @@
 #
 # Version 1.1  6/9/2010
 
+"""
+Union of the islands of any number of files: overlapping islands are joined
+in one region. With --min_samples k, only the regions with islands from at
+least k files are written (consensus). All the files are merged in a single
+sweep, see island_union.py. A file found not to be sorted is sorted in
+memory and the sweep started again.
+"""
 
 import re, os, sys, shutil
-from math import *   
-from string import *
 from optparse import OptionParser
-import operator
-import bisect
 
-import BED
-from GenomeData import *
-import SeparateByChrom
 import Utility
+import GenomeData
+import island_union
 
-plus = re.compile("\+");
-minus = re.compile("\-");
+def read_file_list(filename):
+	files = []
+	fin = open(filename)
+	for line in fin:
+		if line.strip() == '' or line.startswith('#'):
+			continue
+		files.append(line.strip().split('\t')[0])
+	fin.close()
+	return files
 
-Dir = os.getcwd();
 
-
-def write(item, out):
-	"""
-	write one line into outfile. The file openning and closing is handled by outside. 
-	item is a BED3 object
-	"""
-	#chrom, start, end, name, score, strand
-	outline = item.chrom + "\t" + str(item.start) + "\t" + str(item.end) + "\n";
-	out.write(outline);	
-
-
-def union_islands_to_file(islandlist, f):
-	islandlist.sort(key=operator.attrgetter('start'));
-	current = islandlist[0]
-	i = 1
-	while i < len(islandlist):
-		compare = islandlist[i]
-		assert current.start <= compare.start
-		if compare.start > current.end:
-			write(current, f)
-			current = compare
-			i += 1
-		else: 
-			current.end = max(current.end, compare.end)
-			i += 1
-	write(current, f)
+def write_regions(files, outfile, min_samples, counts, chroms, in_memory):
+	out = open(outfile, 'w')
+	nregions = 0
+	try:
+		for chrom, start, end, n in island_union.sweep(files, min_samples, chroms, in_memory):
+			outline = chrom + "\t" + str(start) + "\t" + str(end)
+			if counts:
+				outline += "\t" + str(n)
+			out.write(outline + "\n")
+			nregions += 1
+	finally:
+		out.close()
+	return nregions
 
 
 def main(argv):
-	parser = OptionParser()
+	parser = OptionParser(usage = "%prog [options] [islandfile3 islandfile4 ...]")
 	parser.add_option("-a", "--islandfile1", action="store", type="string", dest="islandfile1", metavar="<file>", help="file 1 with islands info to be unioned")
 	parser.add_option("-b", "--islandfile2", action="store", type="string", dest="islandfile2", metavar="<file>", help="file 2 with islands info to be unioned; if no, type in any word")
-	parser.add_option("-s", "--species", action="store", type="string", dest="species", help="species, mm8 or hg18", metavar="<str>")
+	parser.add_option("-l", "--islandfiles", action="store", type="string", dest="islandfiles", metavar="<file>", help="file listing more island files to be unioned, one per line. More files can also be given as arguments")
+	parser.add_option("-k", "--min_samples", action="store", type="int", dest="min_samples", default=1, metavar="<int>", help="write only the regions with islands in at least this many files. Default %default (union)")
+	parser.add_option("-c", "--counts", action="store_true", dest="counts", default=False, help="add a 4th column with the number of files with islands in the region")
+	parser.add_option("-s", "--species", action="store", type="string", dest="species", help="Optional: species, mm8, hg18, to keep only the islands on its chromosomes", metavar="<str>")
 	parser.add_option("-o", "--outputfile", action="store", type="string", dest="outfile", metavar="<file>", help="output file name")
 
 	(opt, args) = parser.parse_args(argv)
-	if len(argv) < 8:
-        	parser.print_help()
-        	sys.exit(1)
-	
-	if opt.species in species_chroms.keys():
-		chroms = species_chroms[opt.species];
-	else:
-		print "This species is not recognized, exiting";
-		sys.exit(1);
-	
-	
-	SeparateByChrom.separateByChrom(chroms, opt.islandfile1, '.island1')
-	
-	if Utility.fileExists(opt.islandfile2):
-		SeparateByChrom.separateByChrom(chroms, opt.islandfile2, '.island2')
-		
-		for chrom in chroms: 
-			f = open(chrom + '.output', 'w')
-			bed_vals_1 = BED.BED(opt.species, chrom+'.island1', "BED3", 0)
-			bed_vals_2 = BED.BED(opt.species, chrom+'.island2', "BED3", 0)
-			if len(bed_vals_1[chrom]) > 0 or len(bed_vals_2[chrom]) > 0:
-				islandlist = bed_vals_1[chrom] + bed_vals_2[chrom];
-				union_islands_to_file(islandlist, f)
-			f.close()
-		SeparateByChrom.cleanup(chroms, '.island2')
-	else:
-		for chrom in chroms: 
-			f = open(chrom + '.output', 'w')
-			bed_vals_1 = BED.BED(opt.species, chrom+'.island1', "BED3", 0)
-			if len(bed_vals_1[chrom]) > 0:
-				islandlist = bed_vals_1[chrom]
-				union_islands_to_file(islandlist, f)
-			f.close()
+	files = []
+	if opt.islandfile1:
+		files.append(opt.islandfile1)
+	if opt.islandfile2 and Utility.fileExists(opt.islandfile2):
+		files.append(opt.islandfile2)
+	if opt.islandfiles:
+		files.extend(read_file_list(opt.islandfiles))
+	files.extend(args[1:])
+	if len(files) == 0 or not opt.outfile:
+		parser.print_help()
+		sys.exit(1)
+
+	chroms = None
+	if opt.species is not None:
+		if opt.species in GenomeData.species_chroms.keys():
+			chroms = set(GenomeData.species_chroms[opt.species])
+		else:
+			print "This species is not recognized, exiting";
+			sys.exit(1);
 
-	SeparateByChrom.combineAllGraphFiles(chroms, '.output', opt.outfile);
-	
-	SeparateByChrom.cleanup(chroms, '.output')
-	SeparateByChrom.cleanup(chroms, '.island1')
+	in_memory = set()
+	while True:
+		try:
+			nregions = write_regions(files, opt.outfile, opt.min_samples, opt.counts, chroms, in_memory)
+			break
+		except island_union.UnsortedError, e:
+			sys.stderr.write("%s: sorting it in memory and starting again\n" %(e))
+			in_memory.add(e.sample)
+	sys.stderr.write("%s regions from %s files written to %s\n" %(nregions, len(files), opt.outfile))
 
 if __name__ == "__main__":
-	main(sys.argv)       
\ No newline at end of file
+	main(sys.argv)
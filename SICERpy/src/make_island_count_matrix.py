@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+Count the reads of any number of libraries on a shared set of islands, e.g.
+the union of the islands of all the samples (find_union_islands.py), and
+write the samples x islands count matrix, see count_matrix.py.
+
+This extends compare_two_libraries_on_islands.py from two bed libraries to
+N bam files or read libraries (.npz). Libraries are counted in parallel.
+Reads of bam files are filtered with the same defaults as SICER.py and the
+library size is the number of reads passing the filters. With -x indexed bam
+files are read only around the islands and the library size of every bam
+file is its number of records, as with -x in the significance stage.
+"""
+
+import sys
+import multiprocessing
+from optparse import OptionParser
+
+import island_overlap
+import count_matrix
+
+## Islands and settings of count_library. Set before starting the workers so
+## they are shared with them.
+shared= {}
+
+def count_library(readfile):
+    sys.stderr.write("Counting reads of %s\n" %(readfile))
+    return count_matrix.count_reads(readfile, shared['regions'], shared['fragment_size'],
+        shared['requiredFlag'], shared['filterFlag'], shared['mapq'], shared['fetch'])
+
+def read_file_list(filename):
+    files= []
+    fin= open(filename)
+    for line in fin:
+        if line.strip() == '' or line.startswith('#'):
+            continue
+        files.append(line.strip().split('\t')[0])
+    fin.close()
+    return files
+
+def main(argv):
+    parser = OptionParser(usage= "%prog [options] readfile1 readfile2 ...")
+    parser.add_option("-d", "--islandfile", action="store", type="string", dest="islandfile", metavar="<file>", help="island file in BED format, islands must not overlap")
+    parser.add_option("-l", "--readfiles", action="store", type="string", dest="readfiles", default= None, metavar="<file>", help="file listing the libraries (bam or .npz), one per line. Libraries can also be given as arguments")
+    parser.add_option("-f", "--fragment_size", action="store", type="int", dest="fragment_size", metavar="<int>", help="average size of a fragment")
+    parser.add_option("-o", "--outfile", action="store", type="string", dest="out_file", metavar="<file>", help="output count matrix (.npz)")
+    parser.add_option("-t", "--table", action="store", type="string", dest="table", default= None, metavar="<file>", help="Optional: write the count matrix also as tab separated table, one line per island")
+    parser.add_option("-R", "--requiredFlag", action="store", type="int", dest="requiredFlag", default= 0, metavar="<int>", help="bam files: keep only reads with all these bits set in the flag. Default %default")
+    parser.add_option("-F", "--filterFlag", action="store", type="int", dest="filterFlag", default= 4, metavar="<int>", help="bam files: discard reads with any of these bits set in the flag. Default %default")
+    parser.add_option("-Q", "--mapq", action="store", type="int", dest="mapq", default= 5, metavar="<int>", help="bam files: discard reads with mapping quality below this. Default %default. Read libraries (.npz) are used as they are")
+    parser.add_option("-x", "--fetch", action="store_true", dest="fetch", default= False, help="read indexed bam files only around the islands. The library size of all the bam files, indexed or not, is then the number of records, mapped and unmapped, as with -x in associate_tags_with_chip_and_control_w_fc_q_bam.py. This is the number of reads passing the filters only if the bam files are filtered already")
+    parser.add_option("-p", "--nproc", action="store", type="int", dest="nproc", default= 1, metavar="<int>", help="number of libraries counted in parallel. Default %default")
+
+    (opt, args) = parser.parse_args(argv)
+    readfiles= args[1:]
+    if opt.readfiles:
+        readfiles= read_file_list(opt.readfiles) + readfiles
+    if not opt.islandfile or not opt.out_file or opt.fragment_size is None or len(readfiles) == 0:
+        parser.print_help()
+        sys.exit(1)
+
+    islands= island_overlap.read(opt.islandfile)
+    regions= dict([(x, (islands.starts[x], islands.ends[x])) for x in islands.chroms()])
+    sys.stderr.write("%s islands, %s libraries\n" %(len(islands), len(readfiles)))
+    shared.update({'regions': regions, 'fragment_size': opt.fragment_size, 'requiredFlag': opt.requiredFlag,
+        'filterFlag': opt.filterFlag, 'mapq': opt.mapq, 'fetch': opt.fetch})
+    if opt.nproc > 1 and len(readfiles) > 1:
+        pool= multiprocessing.Pool(min(opt.nproc, len(readfiles)))
+        try:
+            results= pool.map(count_library, readfiles, chunksize= 1)
+        finally:
+            pool.terminate()
+    else:
+        results= [count_library(x) for x in readfiles]
+
+    matrix= count_matrix.make_matrix(readfiles, regions, results, fetch= opt.fetch)
+    matrix.save(opt.out_file)
+    if opt.table:
+        matrix.write_table(opt.table)
+    for sample, size, total in zip(matrix.samples, matrix.library_sizes, matrix.counts.sum(axis= 1)):
+        sys.stderr.write("%s: library size %s, reads on islands %s\n" %(sample, size, total))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -19,14 +19,23 @@ from math import *
 from string import *
 from optparse import OptionParser
 import operator
+import pysam
 
 import GenomeData
 import SeparateByChrom
 import Utility
+import read_library
+import external_dedup
+import copy_histogram
 
+## Memory budget (MB) used to count the copies of the reads when the histogram
+## of copies is requested without removing redundant reads.
+DEFAULT_MAX_MEMORY= 1024
 
-def remove_redundant_1chrom_single_strand_sorted(infile, outfile, cutoff):
-    '''infile can only contain reads from one chromosome and only one kind of strands (+/-). file must be pre-sorted by column2, then by column3.'''
+
+def remove_redundant_1chrom_single_strand_sorted(infile, outfile, cutoff, copies= None):
+    '''infile can only contain reads from one chromosome and only one kind of strands (+/-). file must be pre-sorted by column2, then by column3.
+    If copies is a list, the number of copies of each position is appended to it.'''
     f = open(infile,'r')
     o = open(outfile, 'w')
     current_start = 0
@@ -41,6 +50,8 @@ def remove_redundant_1chrom_single_strand_sorted(infile, outfile, cutoff):
             sline = line.split()
             start = atoi(sline[1])
             end = atoi(sline[2])
+            if copies is not None and total > 1 and (start != current_start or end != current_end):
+                copies.append(current_count)
             if start != current_start:
                 o.write('\t'.join(sline)+'\n')
                 retained += 1
@@ -60,26 +71,34 @@ def remove_redundant_1chrom_single_strand_sorted(infile, outfile, cutoff):
                 if current_count <= cutoff:
                     o.write('\t'.join(sline)+'\n')
                     retained += 1
+    if copies is not None and total > 0:
+        copies.append(current_count)
     f.close()
     o.close()
     return (total, retained)
 
 
-def strand_broken_remove(chrom, cutoff):
-    '''infile can only contain reads from one chromosome'''
+def strand_broken_remove(chrom, cutoff, histogram= None):
+    '''infile can only contain reads from one chromosome. The copies of the reads are added
+    to histogram, a copy_histogram.CopyHistogram, if given'''
     infile = chrom + ".bed1";
     outfile = chrom + ".bed2"
     try:
         if os.system('grep [[:space:]]+ %s | sort -g -k 2,3 > plus.bed1' % (infile)):
             raise
     except: sys.stderr.write("+ reads do not exist in " + str(infile) + "\n");
-    (p_total, p_retained) = remove_redundant_1chrom_single_strand_sorted('plus.bed1', 'plus_removed.bed1', cutoff)
+    p_copies= []
+    (p_total, p_retained) = remove_redundant_1chrom_single_strand_sorted('plus.bed1', 'plus_removed.bed1', cutoff, p_copies)
     
     try:
         if os.system('grep [[:space:]]- %s | sort -g -k 2,3 > minus.bed1' % (infile)):
             raise
     except: sys.stderr.write("- reads do not exist in " + str(infile) + "\n");
-    (m_total, m_retained) = remove_redundant_1chrom_single_strand_sorted('minus.bed1', 'minus_removed.bed1', cutoff)
+    m_copies= []
+    (m_total, m_retained) = remove_redundant_1chrom_single_strand_sorted('minus.bed1', 'minus_removed.bed1', cutoff, m_copies)
+    if histogram is not None:
+        histogram.add_array(chrom, False, p_copies)
+        histogram.add_array(chrom, True, m_copies)
     
     print chrom, "\tPlus reads:",p_total, "\tRetained plus reads:", p_retained,     ";\tMinus reads:", m_total, "\tRetained minus reads:", m_retained;
     
@@ -103,7 +122,13 @@ def main(argv):
     parser.add_option("-f", "--requiredFlag", type= 'int', help="Required bit in sam flag. Same as samtools view -f")
     parser.add_option("-F", "--filterFlag", type= 'int', help="Filter out bit in sam flag, Same as samtools view -F")
     parser.add_option("-q", "--mapq", type= 'int', help="minimum mapq for a read to be kept")
-    
+    parser.add_option("-n", "--library_file", action="store", type="string",
+                      dest="library_file", default= None, help="Optional: also write the retained reads as a read library (.npz)", metavar="<file>")
+    parser.add_option("-m", "--max_memory", action="store", type="int",
+                      dest="max_memory", default= None, help="Optional: remove redundant reads with an external sort using about this much memory (MB) instead of per chromosome files and sort", metavar="<int>")
+    parser.add_option("-H", "--copy_histogram", action="store", type="string",
+                      dest="copy_histogram", default= None, help="Optional: write the histogram of read copies per chromosome and strand to this file, as json if the name ends in .json, tab separated otherwise", metavar="<file>")
+
     (opt, args) = parser.parse_args(argv)
     if len(argv) < 8:
             parser.print_help()
@@ -115,16 +140,56 @@ def main(argv):
     #    sys.stderr.write("\nThis species is not recognized, exiting\n");
     #    sys.exit(1);
     chroms= SeparateByChrom.getChromsFromBam(opt.bam_file)
+
+    histogram= None
+    if opt.copy_histogram:
+        histogram= copy_histogram.CopyHistogram()
+
+    count_copies= opt.threshold > 0 or histogram is not None
+    if count_copies:
+        inBam= pysam.AlignmentFile(opt.bam_file)
+        sorted_bam= external_dedup.is_coordinate_sorted(inBam)
+        inBam.close()
+        if opt.threshold <= 0 and not sorted_bam and not opt.max_memory:
+            ## No reads to remove but copies must be counted for the histogram
+            opt.max_memory= DEFAULT_MAX_MEMORY
+    if count_copies and (sorted_bam or opt.max_memory):
+        if opt.threshold > 0:
+            cutoff= opt.threshold
+        else:
+            cutoff= sys.maxint
+        if sorted_bam:
+            sys.stderr.write("Bam file sorted by coordinate: removing redundant reads in one pass\n")
+            stats= external_dedup.stream_dedup_bam(opt.bam_file, opt.out_file, cutoff,
+                requiredFlag= opt.requiredFlag, filterFlag= opt.filterFlag, mapq= opt.mapq, library_file= opt.library_file, histogram= histogram)
+        else:
+            stats= external_dedup.dedup_bam(opt.bam_file, opt.out_file, cutoff, opt.max_memory * 1024 * 1024, tmpdir= os.getcwd(),
+                requiredFlag= opt.requiredFlag, filterFlag= opt.filterFlag, mapq= opt.mapq, library_file= opt.library_file, histogram= histogram)
+        if opt.threshold > 0:
+            for chrom in read_library.header_chroms(opt.bam_file):
+                p_total, p_retained= stats.get((chrom, False), (0, 0))
+                m_total, m_retained= stats.get((chrom, True), (0, 0))
+                if p_total + m_total > 0:
+                    print chrom, "\tPlus reads:",p_total, "\tRetained plus reads:", p_retained,     ";\tMinus reads:", m_total, "\tRetained minus reads:", m_retained;
+        if histogram is not None:
+            histogram.write(opt.copy_histogram, read_library.header_chroms(opt.bam_file))
+        return
     
     SeparateByChrom.separateByChromBamToBed(chroms, opt.bam_file, '.bed1', requiredFlag= opt.requiredFlag, filterFlag= opt.filterFlag, mapq= opt.mapq)
     
     if opt.threshold > 0:
         for chrom in chroms:
             if (Utility.fileExists(chrom + ".bed1")):
-                strand_broken_remove(chrom, opt.threshold)
-        SeparateByChrom.combineAllGraphFilesBedToBam(chroms, '.bed2', opt.bam_file, opt.out_file)
+                strand_broken_remove(chrom, opt.threshold, histogram)
+        retained= '.bed2'
     else:
-        SeparateByChrom.combineAllGraphFilesBedToBam(chroms, '.bed1', opt.bam_file, opt.out_file)
+        retained= '.bed1'
+    SeparateByChrom.combineAllGraphFilesBedToBam(chroms, retained, opt.bam_file, opt.out_file)
+    if opt.library_file:
+        lib= read_library.read_bed_files(read_library.header_chroms(opt.bam_file), retained, chroms)
+        lib.save(opt.library_file)
+    if histogram is not None:
+        histogram.write(opt.copy_histogram, read_library.header_chroms(opt.bam_file))
     SeparateByChrom.cleanup(chroms, '.bed1')
     SeparateByChrom.cleanup(chroms, '.bed2')
 
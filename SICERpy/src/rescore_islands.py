@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""
+Apply a new E-value, FDR cutoff or scaling factor to the candidate islands
+of a previous run, without reading the bam files again.
+
+The candidate islands are written by SICER.py --candidates (or by
+associate_tags_with_chip_and_control_w_fc_q_bam.py -A -c). They hold all the
+islands made from the eligible windows with their score and chip and
+control read counts, so:
+
+* The E-value gives a new score threshold from the background model, and
+  the islands above it are kept.
+* p-values, fold changes and FDR are computed on the kept islands as in
+  associate_tags_with_chip_and_control_w_fc_q_bam.py.
+
+Output is the same table as SICER.py.
+"""
+
+import sys
+from optparse import OptionParser
+
+import BED
+import candidate_islands
+import find_islands_in_pr
+import associate_tags_with_chip_and_control_w_fc_q_bam as associate
+
+def rescore(candidates_file, evalue, scaling_factor= None, background_cache= None):
+    """
+    Return (result_list, pvalue_list) for the candidate islands with score
+    above the threshold given by evalue.
+    """
+    (metadata, candidates)= candidate_islands.read(candidates_file)
+    for x in ['chip_library_size', 'control_library_size', 'genomesize']:
+        if x not in metadata:
+            raise ValueError('%s has no read counts: write it with the significance stage' %(candidates_file))
+    (min_tags_in_window, score_threshold)= find_islands_in_pr.background_threshold(metadata['total_read_count'],
+        metadata['window_size'], metadata['gap'], metadata['window_pvalue'], metadata['genome_length'],
+        metadata['bin_size'], evalue, background_cache)
+    sys.stderr.write("E-value %s: score threshold %s\n" %(evalue, score_threshold))
+
+    islands= {}
+    chip_counts= {}
+    control_counts= {}
+    for chrom in candidates:
+        kept= [x for x in candidates[chrom] if x[2] >= (score_threshold-.0000000001)]
+        if len(kept) > 0:
+            islands[chrom]= [BED.BED_GRAPH(chrom, x[0], x[1], x[2]) for x in kept]
+            chip_counts[chrom]= [x[3] for x in kept]
+            control_counts[chrom]= [x[4] for x in kept]
+    sys.stderr.write("Islands above threshold: %s\n" %(sum([len(x) for x in islands.values()])))
+    return associate.island_significance(islands, islands.keys(), chip_counts, control_counts,
+        metadata['chip_library_size'], metadata['control_library_size'], metadata['genomesize'], scaling_factor)
+
+def main(argv):
+    parser = OptionParser()
+    parser.add_option("-i", "--candidates", action="store", type="string", dest="candidates", metavar="<file>", help="candidate islands with read counts")
+    parser.add_option("-e", "--evalue", action="store", type="float", dest="evalue", default= 1000, metavar="<float>", help="evalue that determines the score threshold of the islands. Default %default, as SICER.py")
+    parser.add_option("-q", "--fdr", action="store", type="float", dest="fdr", default= None, metavar="<float>", help="Optional: write only the islands with FDR up to this")
+    parser.add_option("-s", "--scaling_factor", action="store", type="float", dest="scaling_factor", default= None, metavar="<float>", help="Optional: factor to scale the control reads. Default is the ratio of chip to control library size")
+    parser.add_option("-o", "--outfile", action="store", type="string", dest="out_file", default= '-', metavar="<file>", help="island summary file. Default stdout")
+    parser.add_option("-z", "--bgzip", action="store_true", dest="bgzip", default= False, help="compress the output with bgzip and index it with tabix")
+
+    (opt, args) = parser.parse_args(argv)
+    if not opt.candidates:
+        parser.print_help()
+        sys.exit(1)
+    if opt.bgzip and opt.out_file == '-':
+        sys.stderr.write("Output to stdout cannot be compressed and indexed\n")
+        sys.exit(1)
+
+    (result_list, pvalue_list)= rescore(opt.candidates, opt.evalue, opt.scaling_factor)
+    associate.write_island_summary(result_list, pvalue_list, opt.out_file, opt.bgzip, opt.fdr)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -9,6 +9,7 @@
 
 
 import re, os, sys, shutil
+import numpy
 from math import *   
 from string import *
 from optparse import OptionParser
@@ -18,6 +19,10 @@ import BED
 # import GenomeData
 import make_graph_file
 import SeparateByChrom
+import read_library
+import dense_windows
+import chrom_scheduler
+import window_histogram
 
 def makeGraphFile(chroms, chrom_lengths, window, fragment_size):
     for chrom in chroms:
@@ -30,6 +35,54 @@ def makeGraphFile(chroms, chrom_lengths, window, fragment_size):
         graph_file = chrom + ".graph";
         make_graph_file.make_graph_file(bed_file, chrom, chrom_length, window, fragment_size, graph_file)		
  
+## Tag positions by chromosome and settings of count_region. Set before
+## starting the workers so they are shared with them.
+shared= {}
+
+def count_region(region):
+    chrom, start, end = region
+    return dense_windows.count_windows_in_region(shared['positions'][chrom], shared['chrom_lengths'][chrom], shared['window_size'], start, end)
+
+def makeGraphFileFromLibrary(library, chroms, window, fragment_size, nproc, outfile, dense_file, histogram_file= None):
+    """
+    Count the tags of the read library in windows using nproc processes and
+    write the summary graph to outfile and/or the dense window counts to
+    dense_file. Output is the same as makeGraphFile. The histogram of windows
+    by read count (see window_histogram.py) is collected from the same counts
+    and written to histogram_file, if given.
+    """
+    shared['positions']= dict([(x, read_library.graph_tag_positions(library, x, fragment_size, sort= False)) for x in chroms])
+    shared['chrom_lengths']= library.chrom_lengths
+    shared['window_size']= window
+    tasks= chrom_scheduler.make_tasks(chroms, library.chrom_lengths, window, nproc)
+    results= chrom_scheduler.run_tasks(count_region, tasks, nproc)
+    regions= chrom_scheduler.results_by_chrom(tasks, results)
+    def get_counts(chrom):
+        if chrom not in regions:
+            return numpy.zeros(0, dtype= dense_windows.COUNT_DTYPE)
+        return numpy.concatenate([x[1] for x in regions[chrom]])
+    if dense_file:
+        dense_windows.write(dense_file, window, library.chroms, library.chrom_lengths, get_counts)
+    histogram= None
+    if histogram_file:
+        histogram= window_histogram.WindowHistogram(window, sum(library.chrom_lengths.values()))
+    if outfile:
+        fout= open(outfile, 'w', 1 << 20)
+    if outfile or histogram:
+        for chrom in chroms:
+            counts= get_counts(chrom)
+            if histogram:
+                histogram.add(counts)
+            if not outfile:
+                continue
+            index= numpy.flatnonzero(counts)
+            for i, c in zip(index.tolist(), counts[index].tolist()):
+                fout.write(chrom + "\t" + str(i * window) + "\t" + str(i * window + window - 1) + "\t" + str(c) + "\n")
+    if outfile:
+        fout.close()
+    if histogram:
+        histogram.write(histogram_file)
+
 def main(argv):
     """
     Note the window_size and the fragment_size are both input as strings, as they are used in
@@ -50,6 +103,18 @@ def main(argv):
     parser.add_option("-o", "--outfile", action="store", type="string",
                       dest="outfile", help="output bed summary file name",
                       metavar="<file>")
+    parser.add_option("-n", "--library", action="store", type="string",
+                      dest="library", help="read library (.npz) of the bed file: count tags from the library, using --nproc processes, instead of splitting the bed file by chromosome",
+                      metavar="<file>")
+    parser.add_option("-p", "--nproc", action="store", type="int",
+                      dest="nproc", default= 1, help="number of processes used with --library. Chromosomes are split and batched in tasks of similar size, see chrom_scheduler.py. Default %default",
+                      metavar="<int>")
+    parser.add_option("-d", "--dense_file", action="store", type="string",
+                      dest="dense_file", help="write also the tag counts of all the windows to this file in the memory-mappable format of dense_windows.py. If --outfile is not given only this file is written",
+                      metavar="<file>")
+    parser.add_option("-H", "--histogram", action="store", type="string",
+                      dest="histogram", help="Optional: write also the histogram of windows by read count to this file, as get_windows_histogram.py does from the summary graph. Chromosome lengths are from the bam header",
+                      metavar="<file>")
 
     (opt, args) = parser.parse_args(argv)
     #if len(argv) < 10:
@@ -63,14 +128,26 @@ def main(argv):
 	#chrom_lengths = GenomeData.species_chrom_lengths[opt.species];
     chromsDict= SeparateByChrom.getChromsFromBam(opt.bamfile)
 
+    if opt.library:
+        library= read_library.load(opt.library)
+        makeGraphFileFromLibrary(library, chromsDict.keys(), opt.window_size, opt.fragment_size, opt.nproc, opt.outfile, opt.dense_file, opt.histogram)
+        return
+
     SeparateByChrom.separateByChromBamToBed(chromsDict.keys(), opt.bamfile, '.bed');
 
-    makeGraphFile(chromsDict.keys(), chromsDict, opt.window_size, opt.fragment_size);
-    final_output_file = opt.outfile;
-    final_output_file = SeparateByChrom.combineAllGraphFiles(chromsDict.keys(), ".graph", final_output_file);
-    SeparateByChrom.cleanup(chromsDict.keys(), ".bed");
+    if opt.dense_file or opt.histogram:
+        library= read_library.read_bed_files(read_library.header_chroms(opt.bamfile), '.bed', chromsDict)
+        if opt.dense_file:
+            dense_windows.write_from_library(opt.dense_file, library, opt.fragment_size, opt.window_size)
+        if opt.histogram:
+            makeGraphFileFromLibrary(library, chromsDict.keys(), opt.window_size, opt.fragment_size, 1, None, None, opt.histogram)
 
-    SeparateByChrom.cleanup(chromsDict.keys(), ".graph");
+    if opt.outfile:
+        makeGraphFile(chromsDict.keys(), chromsDict, opt.window_size, opt.fragment_size);
+        final_output_file = opt.outfile;
+        final_output_file = SeparateByChrom.combineAllGraphFiles(chromsDict.keys(), ".graph", final_output_file);
+        SeparateByChrom.cleanup(chromsDict.keys(), ".graph");
+    SeparateByChrom.cleanup(chromsDict.keys(), ".bed");
     #else:
     #    sys.stderr.write(opt.species + " is not in the species list \n");
 
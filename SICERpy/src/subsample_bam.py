@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+"""
+Subsample the reads of a bam file in a single pass, either to an exact number
+of reads (reservoir sampling) or to a fraction of the reads chosen by the hash
+of the read name, so that mates stay together and the same reads are chosen
+in every run with the same seed. See subsample.py.
+
+Optionally write also the read library (.npz) of the subsampled reads, so
+that it can be used by the pipeline in place of the library of the input.
+"""
+
+import sys
+from optparse import OptionParser
+
+import subsample
+
+def main(argv):
+    parser = OptionParser()
+    parser.add_option("-b", "--bam", action="store", type="string", dest="bam", metavar="<file>", help="input bam file")
+    parser.add_option("-o", "--out_bam", action="store", type="string", dest="out_bam", metavar="<file>", help="output bam file of the subsampled reads")
+    parser.add_option("-l", "--library", action="store", type="string", dest="library", default= None, metavar="<file>", help="Optional: write also the read library (.npz) of the subsampled reads")
+    parser.add_option("-n", "--number", action="store", type="int", dest="number", default= None, metavar="<int>", help="keep exactly this number of reads, or all the reads if there are fewer")
+    parser.add_option("-x", "--fraction", action="store", type="float", dest="fraction", default= None, metavar="<float>", help="keep the reads whose name hashes below this fraction")
+    parser.add_option("-s", "--seed", action="store", type="int", dest="seed", default= None, metavar="<int>", help="seed of the random choice. Default: random for --number, 0 for --fraction")
+    parser.add_option("-f", "--requiredFlag", action="store", type="int", dest="requiredFlag", default= 0, metavar="<int>", help="keep only reads with all these bits set in the flag. Default %default")
+    parser.add_option("-F", "--filterFlag", action="store", type="int", dest="filterFlag", default= 0, metavar="<int>", help="discard reads with any of these bits set in the flag. Default %default")
+    parser.add_option("-q", "--mapq", action="store", type="int", dest="mapq", default= 0, metavar="<int>", help="discard reads with mapping quality below this. Default %default")
+
+    (opt, args) = parser.parse_args(argv)
+    if not opt.bam or not opt.out_bam or (opt.number is None) == (opt.fraction is None):
+        parser.print_help()
+        sys.exit(1)
+
+    lib= subsample.subsample_bam(opt.bam, opt.out_bam, opt.number, opt.fraction, opt.seed, opt.requiredFlag, opt.filterFlag, opt.mapq)
+    if opt.library:
+        lib.save(opt.library)
+    sys.stderr.write("%s reads of %s written to %s\n" %(lib.size(), opt.bam, opt.out_bam))
+
+if __name__ == "__main__":
+    main(sys.argv)
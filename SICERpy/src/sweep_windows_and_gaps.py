@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+Run island calling and significance for several window and gap sizes
+reading the libraries only once.
+
+The tag positions of the chip library are binned once at the finest
+resolution (the greatest common divisor of the window sizes) and the
+window counts for each window size are obtained by summing the fine
+windows. Islands are called on the windows with reads only, see
+find_islands_in_pr.sparse_islands. The probability scores of the windows
+are computed once per window size and shared by all the gap sizes.
+
+For each combination, the island summary is written to
+<outdir>/W<window>_G<gap>.island-summary.bed, same format as the output of
+SICER.py. A table summarising all the combinations is written to
+<outdir>/sweep-summary.txt.
+"""
+
+import os
+import sys
+from optparse import OptionParser
+from fractions import gcd
+
+import BED
+import read_library
+import find_islands_in_pr
+import associate_tags_with_chip_and_control_w_fc_q_bam as associate
+
+def int_list(x):
+    return [int(v) for v in x.split(',') if v.strip() != '']
+
+def fine_window_counts(chip_library, fragment_size, resolution):
+    """Return {chrom: (window starts, counts)} at the given resolution.
+    """
+    fine= {}
+    for chrom in chip_library.chroms:
+        positions= read_library.graph_tag_positions(chip_library, chrom, fragment_size)
+        if len(positions) > 0:
+            fine[chrom]= read_library.window_counts(positions, chip_library.chrom_lengths[chrom], resolution)
+    return fine
+
+def summary_graph(fine, chrom_lengths, resolution, window_size):
+    """Window counts at window_size as a dict {chrom: (window starts, counts)},
+    like the summary graph read by find_islands_in_pr.read_summary_graph.
+    """
+    windows= {}
+    for chrom in fine:
+        window_starts, counts= fine[chrom]
+        if window_size != resolution:
+            window_starts, counts= read_library.rebin_window_counts(window_starts, counts, chrom_lengths[chrom], window_size)
+        if len(counts) > 0:
+            windows[chrom]= (window_starts, counts.astype(float))
+    return windows
+
+def call_islands(windows, probscores, window_size, gap, min_tags_in_window, score_threshold):
+    """Islands as dict {chrom: [BED_GRAPH]}. probscores: {chrom: probability
+    scores of the windows}, see find_islands_in_pr.window_probscores.
+    """
+    islands= {}
+    for chrom in windows:
+        window_starts, counts= windows[chrom]
+        window_scores= find_islands_in_pr.window_scores(counts, None, min_tags_in_window, probscores[chrom])
+        starts, ends, scores= find_islands_in_pr.sparse_islands(window_starts, window_scores, window_size, gap, score_threshold)
+        if len(scores) > 0:
+            islands[chrom]= [BED.BED_GRAPH(chrom, s, e, v) for s, e, v in zip(starts.tolist(), ends.tolist(), scores)]
+    return islands
+
+def main(argv):
+    parser = OptionParser()
+    parser.add_option("-a", "--rawchipreadfile", action="store", type="string", dest="chipreadfile", metavar="<file>", help="raw read file from chip in BAM format or read library (.npz)")
+    parser.add_option("-b", "--rawcontrolreadfile", action="store", type="string", dest="controlreadfile", metavar="<file>", help="raw read file from control in BAM format or read library (.npz)")
+    parser.add_option("-w", "--window_sizes", action="store", type="string", dest="window_sizes", metavar="<int,int,...>", help="comma separated list of window sizes (bp)")
+    parser.add_option("-g", "--gap_sizes", action="store", type="string", dest="gap_sizes", metavar="<int,int,...>", help="comma separated list of gap sizes as multiples of the window size")
+    parser.add_option("-f", "--fragment_size", action="store", type="int", dest="fragment_size", metavar="<int>", help="average size of a fragment after CHIP experiment")
+    parser.add_option("-t", "--mappable_fraction_of_genome_size", action="store", type="float", dest="fraction", help="mapable fraction of genome size", metavar="<float>")
+    parser.add_option("-e", "--evalue", action="store", type="float", dest="evalue", default= 1000, help="evalue that determines score threshold for candidate islands. Default %default", metavar="<float>")
+    parser.add_option("-q", "--fdr", action="store", type="float", dest="fdr", default= 0.01, help="FDR used to count significant islands in the summary table. Default %default", metavar="<float>")
+    parser.add_option("-o", "--outdir", action="store", type="string", dest="outdir", metavar="<dir>", help="output directory")
+
+    (opt, args) = parser.parse_args(argv)
+    if len(argv) < 14:
+        parser.print_help()
+        sys.exit(1)
+
+    window_sizes= int_list(opt.window_sizes)
+    gap_sizes= int_list(opt.gap_sizes)
+    if not os.path.isdir(opt.outdir):
+        os.makedirs(opt.outdir)
+
+    chip_library= associate.load_reads(opt.chipreadfile)
+    control_library= associate.load_reads(opt.controlreadfile)
+    chromsDict= chip_library.chrom_lengths
+    genomesize= sum(chromsDict.values()) * opt.fraction
+    genome_length= int(opt.fraction * sum(chromsDict.values()))
+    chip_library_size= chip_library.size()
+    control_library_size= control_library.size()
+    sys.stderr.write("chip library size  %s\n" %(chip_library_size))
+    sys.stderr.write("control library size %s\n" %(control_library_size))
+
+    resolution= reduce(gcd, window_sizes)
+    sys.stderr.write("Binning tags at resolution %s\n" %(resolution))
+    fine= fine_window_counts(chip_library, opt.fragment_size, resolution)
+
+    window_pvalue = 0.20;
+    bin_size = 0.001;
+
+    summary= open(os.path.join(opt.outdir, 'sweep-summary.txt'), 'w')
+    summary.write('\t'.join(['#window_size', 'gap_size', 'gap_bp', 'min_tags_in_window', 'score_threshold',
+        'islands', 'islands_length', 'chip_reads_on_islands', 'control_reads_on_islands', 'islands_fdr_' + str(opt.fdr)]) + '\n')
+    for window_size in window_sizes:
+        windows= summary_graph(fine, chromsDict, resolution, window_size)
+        total_read_count= 0.0
+        for chrom in windows:
+            total_read_count += float(windows[chrom][1].sum())
+        average = float(total_read_count) * window_size/genome_length;
+        sys.stderr.write("\nWindow_size: %s; Total read count: %s; Window average: %s\n" %(window_size, total_read_count, average))
+        probscores= dict([(chrom, find_islands_in_pr.window_probscores(windows[chrom][1], average)) for chrom in windows])
+
+        for gap_size in gap_sizes:
+            gap= gap_size * window_size
+            (min_tags_in_window, score_threshold) = find_islands_in_pr.background_threshold(total_read_count, window_size, gap, window_pvalue, genome_length, bin_size, opt.evalue)
+            islands= call_islands(windows, probscores, window_size, gap, min_tags_in_window, score_threshold)
+
+            (island_chip_readcount, totalchip) = associate.count_reads_on_islands(islands, chromsDict.keys(), chip_library, opt.fragment_size)
+            (island_control_readcount, totalcontrol) = associate.count_reads_on_islands(islands, chromsDict.keys(), control_library, opt.fragment_size)
+            (result_list, pvalue_list) = associate.island_significance(islands, chromsDict.keys(), island_chip_readcount, island_control_readcount, chip_library_size, control_library_size, genomesize)
+            outfile= os.path.join(opt.outdir, 'W%s_G%s.island-summary.bed' %(window_size, gap_size))
+            fdr_list= associate.write_island_summary(result_list, pvalue_list, outfile)
+
+            islands_length= sum([x['end'] - x['start'] + 1 for x in result_list])
+            n_significant= len([x for x in fdr_list if x <= opt.fdr])
+            summary.write('\t'.join([str(x) for x in [window_size, gap_size, gap, min_tags_in_window, score_threshold,
+                len(result_list), islands_length, totalchip, totalcontrol, n_significant]]) + '\n')
+            sys.stderr.write("Window %s, gap %s: %s islands written to %s\n" %(window_size, gap_size, len(result_list), outfile))
+    summary.close()
+
+if __name__ == "__main__":
+    main(sys.argv)
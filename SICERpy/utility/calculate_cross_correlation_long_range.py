@@ -1,10 +1,10 @@
 #!/usr/bin/env python
-# 
+#
 # Authors: Chongzhi Zang, Weiqun Peng
 #
-# 
+#
 # Disclaimer
-# 
+#
 # This software is distributed in the hope that it will be useful, but
 # WITHOUT ANY WARRANTY; without even the implied warranty of
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
@@ -17,104 +17,157 @@
 
 
 import re, os, sys, shutil
-from math import *   
+from math import *
 from string import *
 from optparse import OptionParser
 import operator
-import bisect
+import numpy
 
 ## get BED module
 import BED
 from GenomeData import *
-import SeparateByChrom
-
-Dir = os.getcwd();
-grep = "/bin/grep";
-cat = "/bin/cat";
-
-plus = re.compile("\+");
-minus = re.compile("\-");
-
-
-def make_summary_graph_dic(chrom, file):
-	dic = {}
+import dense_windows
+import chrom_scheduler
+
+MAX_DISTANCE = 400;
+
+
+def read_summary_graphs(file, chroms):
+	"""
+	Read the summary graph into a dict {chrom: (window starts, values)} of
+	arrays, in one pass over the file. Dense window counts
+	(dense_windows.py) are also accepted.
+	"""
+	graphs = {};
+	if dense_windows.is_dense_file(file):
+		dense = dense_windows.DenseWindows(file);
+		for chrom in dense.chroms:
+			if chrom in chroms:
+				window_starts, counts = dense.nonzero(chrom);
+				graphs[chrom] = (window_starts, counts.astype(float));
+		return graphs;
+	starts = {};
+	values = {};
 	f = open(file,'r')
 	for line in f:
 		if not re.match("#", line):
-			line = line.strip()
 			sline = line.split()
-			if sline[0] == chrom:
-				dic[atoi(sline[1])] = atof(sline[3])
-	return dic
-
-
-def window_tag_density(dic, chrom_length, window_size):
-	total_tag = 0.0
-	for position in dic.keys():
-		total_tag += dic[position]
-	return total_tag / float(chrom_length) * window_size
-
-
-def correlation2(dic1, dic2, chrom_length, dx, r):
-	average1 = window_tag_density(dic1, chrom_length, dx)
-	average2 = window_tag_density(dic2, chrom_length, dx)
-	keylist1 = dic1.keys()
-	keylist1.sort()
-	keylist2 = dic2.keys()
-	keylist2.sort()
-	x = 0
-	i = 0
-	j = min(len(keylist2)-1, bisect.bisect_left(keylist2,int(r)))
-	total = 0.0
-	while x < (chrom_length-r):
-		if x == keylist1[i]:
-			Tx = dic1[x]
-			if i < (len(keylist1)-1):
-				i += 1
-		elif x < keylist1[i]:
-			Tx = 0
-		elif x > keylist1[i]:
-			Tx = 0
-			if i < (len(keylist1)-1):
-				i += 1
-		y = int(x + r)
-		if y == keylist2[j]:
-			Tr = dic2[y]
-			if j < (len(keylist2)-1):
-				j += 1
-		elif y < keylist2[j]:
-			Tr = 0
-		elif y > keylist2[j]:
-			Tr = 0
-			if j < len(keylist2)-1:
-				j += 1
-		total += (float(Tx) - average1)*(float(Tr) - average2)
-		x += dx
-	return total/chrom_length*dx
-
-
-def correlation_function2(dic1, dic2, chrom_length, step, dx):
-	result = {}
-	r = 0
-	while r < min(chrom_length, 400):
-		result[r] = correlation2(dic1, dic2, chrom_length, dx, r)
-		r += step
-	return result
-
-
-def generate_all_functions_2(extension1, extension2, chroms, dx, dr, file_name, chrom_lengths):
-	for chrom in chroms:
-		dic1 = make_summary_graph_dic(chrom, chrom+extension1)
-		dic2 = make_summary_graph_dic(chrom, chrom+extension2)
-		chrom_length = chrom_lengths[chrom]
-		if len(dic1.keys()) > 0 and len(dic2.keys()) > 0:
-			result_dic = correlation_function2(dic1, dic2, chrom_length, dr, dx)
-			keylist = result_dic.keys()
-			keylist.sort()
-			f = open(file_name, 'w')
-			for i in keylist:
-				f.write(str(i)+'\t'+str(result_dic[i])+'\n')
-			f.close()
+			if sline[0] in chroms:
+				if sline[0] not in starts:
+					starts[sline[0]] = [];
+					values[sline[0]] = [];
+				starts[sline[0]].append(atoi(sline[1]));
+				values[sline[0]].append(atof(sline[3]));
+	f.close()
+	for chrom in starts:
+		graphs[chrom] = (numpy.array(starts[chrom], dtype= numpy.int64), numpy.array(values[chrom], dtype= float));
+	return graphs;
+
+
+def dense_vector(window_starts, values, chrom_length, dx):
+	"""
+	Values at positions 0, dx, 2*dx, ... below chrom_length. Windows not
+	starting at a multiple of dx are left out, as they never match a position
+	in correlation2.
+	"""
+	vector = numpy.zeros((chrom_length + dx - 1) // dx);
+	keep = (window_starts % dx == 0) & (window_starts >= 0) & (window_starts < chrom_length);
+	vector[window_starts[keep] // dx] = values[keep];
+	return vector;
+
+
+def fft_size(n):
+	"""
+	Smallest power of 2 not less than n
+	"""
+	size = 1;
+	while size < n:
+		size *= 2;
+	return size;
+
+
+def lagged_products(a, b, max_lag):
+	"""
+	Sum of a[k] * b[k + l] over k, for all the lags l = 0 ... max_lag at
+	once by FFT. Integer values, i.e. read counts, give exact integer sums
+	once the FFT error is rounded off.
+	"""
+	n = len(a);
+	size = fft_size(n + max_lag);
+	products = numpy.fft.irfft(numpy.conj(numpy.fft.rfft(a, size)) * numpy.fft.rfft(b, size), size)[:max_lag + 1];
+	if numpy.all(a == numpy.rint(a)) and numpy.all(b == numpy.rint(b)):
+		products = numpy.rint(products);
+	return products;
+
+
+def correlation_function2(graph1, graph2, chrom_length, step, dx):
+	"""
+	Same as the loop of correlation2 over r = 0, step, ... below
+	min(chrom_length, 400), i.e. for each r
+
+		sum over x = 0, dx, ... below chrom_length - r of
+		(T1(x) - average1) * (T2(x + r) - average2)
+
+	divided by chrom_length / dx, with T(x) the value of the window starting
+	at x, 0 if none, and average the tag density per window. The sum is
+	expanded as sum T1(x)T2(x + r) - average2 * sum T1(x) - average1 * sum
+	T2(x + r) + K * average1 * average2 over the K positions x, so all the r
+	come from one FFT of the dense vectors and two cumulative sums.
+
+	Return (list of r, list of totals), the totals not yet divided.
+	"""
+	average1 = graph1[1].sum() / float(chrom_length) * dx;
+	average2 = graph2[1].sum() / float(chrom_length) * dx;
+	a = dense_vector(graph1[0], graph1[1], chrom_length, dx);
+	b = dense_vector(graph2[0], graph2[1], chrom_length, dx);
+	n = len(a);
+	distances = range(0, min(chrom_length, MAX_DISTANCE), step);
+	products = lagged_products(a, b, max(distances) // dx);
+	cumsum_a = numpy.concatenate(([0.0], numpy.cumsum(a)));
+	cumsum_b = numpy.concatenate(([0.0], numpy.cumsum(b)));
+	totals = [];
+	for r in distances:
+		K = (chrom_length - r + dx - 1) // dx;
+		total = K * average1 * average2 - average2 * cumsum_a[K];
+		## T2(x + r) is 0 everywhere if r is not a multiple of dx
+		if r % dx == 0:
+			l = r // dx;
+			total += products[l] - average1 * (cumsum_b[l + K] - cumsum_b[l]);
+		totals.append(float(total));
+	return (distances, totals);
+
+
+## Summary graphs and settings of correlate_chrom. Set before starting the
+## workers so they are shared with them.
+shared = {};
+
+def correlate_chrom(region):
+	chrom = region[0];
+	return correlation_function2(shared['graphs1'][chrom], shared['graphs2'][chrom], shared['chrom_lengths'][chrom], shared['step'], shared['dx']);
+
+
+def generate_all_functions_2(graphs1, graphs2, chroms, dx, dr, chrom_lengths, nproc):
+	"""
+	Correlation function of the chromosomes with windows in both summary
+	graphs: the totals of all these chromosomes divided by their total
+	length / dx. For one chromosome this is the correlation function of
+	that chromosome. Chromosomes are processed in parallel.
+	"""
+	chroms = [chrom for chrom in chroms if chrom in graphs1 and chrom in graphs2 and len(graphs1[chrom][0]) > 0 and len(graphs2[chrom][0]) > 0];
+	shared.update({'graphs1': graphs1, 'graphs2': graphs2, 'chrom_lengths': chrom_lengths, 'step': dr, 'dx': dx});
+	tasks = chrom_scheduler.make_tasks(chroms, chrom_lengths, dx, nproc, split= False);
+	results = chrom_scheduler.run_tasks(correlate_chrom, tasks, nproc);
+	totals = {};
+	length = 0;
+	for task, task_results in zip(tasks, results):
+		for region, (distances, chrom_totals) in zip(task, task_results):
+			length += chrom_lengths[region[0]];
+			for r, total in zip(distances, chrom_totals):
+				totals[r] = totals.get(r, 0.0) + total;
+	result_dic = {};
+	for r in totals:
+		result_dic[r] = totals[r]/length*dx;
+	return result_dic;
 
 
 def main(argv):
@@ -125,24 +178,34 @@ def main(argv):
 	parser.add_option("-i", "--windows_size", action="store", type="int", dest="window_size", metavar="<int>", help="window size in summary graph file")
 	parser.add_option("-d", "--data_resolution", action="store", type="int", dest="step", metavar="<int>", help="distance between data points, must be integer times of window size")
 	parser.add_option("-o", "--outfile", action="store", type="string", dest="out_file", metavar="<file>", help="output file extension")
-	
+	parser.add_option("-c", "--chroms", action="store", type="string", dest="chroms", default= 'chr1', metavar="<str>", help="comma separated chromosomes to compute the correlation on, or 'all' for all the chromosomes of the species. Default %default")
+	parser.add_option("-p", "--nproc", action="store", type="int", dest="nproc", default= 1, metavar="<int>", help="number of chromosomes processed in parallel. Default %default")
+
 	(opt, args) = parser.parse_args(argv)
 	if len(argv) < 8:
         	parser.print_help()
         	sys.exit(1)
-	
+
 	if opt.species in species_chroms.keys():
 		chroms = species_chroms[opt.species];
 		chrom_lengths = species_chrom_lengths[opt.species];
 	else:
 		print "This species is not recognized, exiting";
 		sys.exit(1);
-	
-	SeparateByChrom.separateByChrom(['chr1'], opt.bedfile1, '.bed1')
-	SeparateByChrom.separateByChrom(['chr1'], opt.bedfile2, '.bed2')
-	generate_all_functions_2('.bed1', '.bed2', ['chr1'], opt.window_size, opt.step, opt.out_file, chrom_lengths)
-	SeparateByChrom.cleanup(['chr1'], '.bed1')
-	SeparateByChrom.cleanup(['chr1'], '.bed2')
+
+	if opt.chroms != 'all':
+		chroms = [chrom for chrom in opt.chroms.split(',') if chrom in chrom_lengths];
+
+	graphs1 = read_summary_graphs(opt.bedfile1, chroms);
+	graphs2 = read_summary_graphs(opt.bedfile2, chroms);
+	result_dic = generate_all_functions_2(graphs1, graphs2, chroms, opt.window_size, opt.step, chrom_lengths, opt.nproc);
+	if len(result_dic) > 0:
+		keylist = result_dic.keys()
+		keylist.sort()
+		f = open(opt.out_file, 'w')
+		for i in keylist:
+			f.write(str(i)+'\t'+str(result_dic[i])+'\n')
+		f.close()
 
 
 if __name__ == "__main__":
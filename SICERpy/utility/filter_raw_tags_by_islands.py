@@ -21,59 +21,21 @@ from math import *
 from string import *
 from optparse import OptionParser
 import operator
-import bisect
 
-## get BED module
-import BED
-from GenomeData import *
-import SeparateByChrom
+import GenomeData
+import island_overlap
+import island_tags
 
-plus = re.compile("\+");
-minus = re.compile("\-");
-
-def tag_position(sline, fragment_size):
-	shift = int(round(fragment_size/2))
-	if plus.match(sline[5]):
-		return atoi(sline[1]) + shift
-	elif minus.match(sline[5]):
-		return atoi(sline[2]) - 1 - shift
-
-
-def filter_tags_by_islands(chroms, islands, fragment_size):
-	for chrom in chroms:
-		if chrom in islands.keys():
-			island_start_list = []
-			island_end_list = []
-			for item in islands[chrom]:
-				island_start_list.append(item.start)
-				island_end_list.append(item.end)
-			island_start_list.sort()
-			island_end_list.sort()
-			bed_file = chrom + ".bed1"
-			filtered_file = chrom +"_filtered.bed1"
-			f = open(bed_file,'r')
-			o = open(filtered_file, 'w')
-			
-			for line in f:
-				if not re.match("#", line):
-					line = line.strip()
-					sline = line.split()
-					position = tag_position(sline, fragment_size)
-					if bisect.bisect_right(island_start_list, position) - bisect.bisect_left(island_end_list, position) == 1:
-						o.write('\t'.join(sline)+'\n')
-				
-			f.close()
-			o.close()
 
 def main(argv):
 	parser = OptionParser()
 	parser.add_option("-s", "--species", action="store",
 			  type="string", dest="species",
-			  help="species, mm8, hg18", metavar="<str>")
+			  help="Optional: species, mm8, hg18, to keep only the tags on its chromosomes", metavar="<str>")
 	parser.add_option("-a", "--rawbedfile", action="store",
 			  type="string", dest="bedfile",
 			  metavar="<file>",
-			  help="raw data file in bed format")
+			  help="raw data file in bed or bam format")
 	parser.add_option("-i", "--fragment_size", action="store",
 			  type="int", dest="fragment_size",
 			  metavar="<int>",
@@ -83,28 +45,36 @@ def main(argv):
 			  help="island file")
 	parser.add_option("-o", "--outfile", action="store", type="string",
 			  dest="out_file", metavar="<file>",
-			  help="filtered raw bed file")
+			  help="filtered raw bed file, or bam file if the input is bam")
+	parser.add_option("-f", "--requiredFlag", action="store", type="int",
+			  dest="requiredFlag", default=0, metavar="<int>",
+			  help="bam input: keep only reads with all these bits set in the flag. Default %default")
+	parser.add_option("-F", "--filterFlag", action="store", type="int",
+			  dest="filterFlag", default=4, metavar="<int>",
+			  help="bam input: discard reads with any of these bits set in the flag. Default %default, as SICER.py")
+	parser.add_option("-q", "--mapq", action="store", type="int",
+			  dest="mapq", default=5, metavar="<int>",
+			  help="bam input: discard reads with mapping quality below this. Default %default, as SICER.py. The fraction of reads on islands is over the reads passing the filters")
 	
 	(opt, args) = parser.parse_args(argv)
-	if len(argv) < 10:
+	if not opt.bedfile or not opt.islandbedfile or not opt.out_file or opt.fragment_size is None:
         	parser.print_help()
         	sys.exit(1)
 	
-	if opt.species in species_chroms.keys():
-		chroms = species_chroms[opt.species];
-	else:
-		print "This species is not recognized, exiting";
-		sys.exit(1);
+	chroms = None;
+	if opt.species is not None:
+		if opt.species in GenomeData.species_chroms.keys():
+			chroms = set(GenomeData.species_chroms[opt.species]);
+		else:
+			print "This species is not recognized, exiting";
+			sys.exit(1);
 	
-	islands = BED.BED(opt.species, opt.islandbedfile, "BED3", 0);
-	SeparateByChrom.separateByChrom(chroms, opt.bedfile, '.bed1')
-	filter_tags_by_islands(chroms, islands, opt.fragment_size)
-	final_output_file = opt.out_file;
-	final_output_file = SeparateByChrom.combineAllGraphFiles(chroms,
-								   '_filtered.bed1',
-								   final_output_file);
-	SeparateByChrom.cleanup(chroms,'.bed1');
-	SeparateByChrom.cleanup(chroms,'_filtered.bed1');
+	islands = island_overlap.read(opt.islandbedfile);
+	if opt.bedfile.endswith('.bam'):
+		(total, kept) = island_tags.filter_bam(opt.bedfile, opt.out_file, islands, opt.fragment_size, chroms, opt.requiredFlag, opt.filterFlag, opt.mapq);
+	else:
+		(total, kept) = island_tags.filter_bed(opt.bedfile, opt.out_file, islands, opt.fragment_size, chroms);
+	print "Reads on islands: ", kept, " of ", total, "; fraction of reads on islands: ", kept*1.0/total if total > 0 else 0;
 
 
 if __name__ == "__main__":
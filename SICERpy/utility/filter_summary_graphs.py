@@ -19,144 +19,190 @@ from math import *
 from string import *
 from optparse import OptionParser
 import operator
-import bisect
+import numpy
 
-import BED
-import UCSC
-import SeparateByChrom
-import Utility
-from GenomeData import *
+import GenomeData
+import dense_windows
+import island_overlap
 
-plus = re.compile("\+");
-minus = re.compile("\-");
-Dir = os.getcwd();
+def isle_window_starts(island_starts, island_ends, window_size):
+	"""
+	Starts of all the windows on the islands: island [start, end] (end
+	inclusive) has windows start, start + window_size, ... as long as the
+	window ends within the island.
+	"""
+	island_starts = numpy.asarray(island_starts, dtype= numpy.int64);
+	island_ends = numpy.asarray(island_ends, dtype= numpy.int64);
+	nwindows = numpy.maximum((island_ends - island_starts + 1) // window_size, 0);
+	first = numpy.cumsum(nwindows) - nwindows;
+	index = numpy.arange(nwindows.sum()) - numpy.repeat(first, nwindows);
+	return numpy.repeat(island_starts, nwindows) + index * window_size;
+	
+
+def filter_out_uncovered_windows(island_starts, island_ends, window_starts, window_values, window_size):
+	"""
+	Use the islands to filter the windows of the summary graph, so that only
+	the windows on islands are recorded. Windows in the gaps of the islands
+	are also counted in, with value 0.
+	
+	window_starts must be sorted, which comes naturally out of the graph.
+	The islands MUST BE MADE out of the corresponding summary graph, so that
+	their boundaries are commensurate with the windows.
+	
+	Return (starts, values, found) of the windows on the islands, found is
+	True for the windows in the summary graph.
+	"""
+	starts = isle_window_starts(island_starts, island_ends, window_size);
+	window_starts = numpy.asarray(window_starts);
+	left = numpy.searchsorted(window_starts, starts, side= 'left');
+	found = numpy.searchsorted(window_starts, starts, side= 'right') - left == 1;
+	values = numpy.zeros(len(starts));
+	values[found] = numpy.asarray(window_values, dtype= float)[left[found]];
+	return (starts, values, found);
 
 
-def window_on_island(island, window):
+def graph_by_chrom(summary_graph_file):
 	"""
-	decide if a window is on an island 
+	Yield (chrom, window starts, values) of the summary graph one chromosome
+	at a time, sorted by start. A bed graph is read as a stream if each
+	chromosome is in one block of lines, as written by SICER; otherwise it is
+	read in memory.
 	"""
-	if (window.start >= island.start and window.end <= island.end):
-		return 1;
-	else:
-		return 0;
+	if dense_windows.is_dense_file(summary_graph_file):
+		dense = dense_windows.DenseWindows(summary_graph_file);
+		for chrom in dense.chroms:
+			window_starts, counts = dense.nonzero(chrom);
+			yield (chrom, window_starts, counts.astype(float));
+		return;
+	if is_grouped_by_chrom(summary_graph_file):
+		for block in graph_blocks(summary_graph_file):
+			yield sorted_block(*block);
+		return;
+	sys.stderr.write("%s is not grouped by chromosome: reading it in memory\n" %(summary_graph_file));
+	graph = {};
+	for chrom, starts, values in graph_blocks(summary_graph_file):
+		if chrom not in graph:
+			graph[chrom] = ([], []);
+		graph[chrom][0].append(starts);
+		graph[chrom][1].append(values);
+	for chrom in sorted(graph.keys()):
+		yield sorted_block(chrom, numpy.concatenate(graph[chrom][0]), numpy.concatenate(graph[chrom][1]));
 
 
-def find_isle_windows(islands_list, window_size):
+def is_grouped_by_chrom(summary_graph_file):
 	"""
-	Use islands to get all the windows on islands, with all tag numbers set to be zero.
+	True if the lines of each chromosome are in a single block.
 	"""
-	window_list = [];
-	for island in islands_list:
-		start = island.start;
-		end = start + window_size -1;
-		while end <= island.end:
-			window_list.append(BED.BED_GRAPH(island.chrom, start, end, 0));
-			start += window_size;
-			end = start + window_size -1;
-	return window_list;
-	
+	seen = set();
+	chrom = None;
+	infile = open(summary_graph_file);
+	for line in infile:
+		if line.startswith('track') or line.strip() == '':
+			continue;
+		line_chrom = line.split(None, 1)[0];
+		if line_chrom != chrom:
+			if line_chrom in seen:
+				infile.close();
+				return False;
+			seen.add(line_chrom);
+			chrom = line_chrom;
+	infile.close();
+	return True;
 
-def filter_out_uncovered_windows(islands_list, all_windows_list, window_size):
+
+def graph_blocks(summary_graph_file):
 	"""
-	This module uses islands list to filter the windows list, so that only 
-	those windows on islands are recorded 
-	
-	Both input lists are lists of BED_GRAPH objects, each of BED GRAPH 
-	object has tributes of start, end, and value. The islands MUST BE MADE 
-	out of the corresponding summary graph file !!
-	
-	Windows that are in the gaps are also counted in.
-	
-	Both lists need to be sorted, which comes natually out of graphs and 
-	islands.   They are with commensuate boundaries, as the islands are built out of the summary graphs. 
-	
+	Yield (chrom, window starts, values) for each block of consecutive lines
+	of the same chromosome in a bed graph file.
 	"""
-	assert( Utility.is_bed_sorted(islands_list) == 1 );
-	assert( Utility.is_bed_sorted(all_windows_list) == 1 ); 
-	
-	isle_windows_list = find_isle_windows(islands_list, window_size);
-	isle_windows_start_list=[];
-	for window in isle_windows_list:
-		isle_windows_start_list.append(window.start)
-		
-	all_windows_start_list = [];
-	for window in all_windows_list:
-		all_windows_start_list.append(window.start)
-	
-	# start position should be in the all_windows_start_list
-	for index in xrange(len(isle_windows_start_list)):
-		item = isle_windows_start_list[index];
-		position = bisect.bisect_left(all_windows_start_list, item);
-		if bisect.bisect_right(all_windows_start_list, item) - position == 1:
-			isle_windows_list[index].value = all_windows_list[position].value;
-	return isle_windows_list
+	chrom = None;
+	starts = [];
+	values = [];
+	infile = open(summary_graph_file);
+	for line in infile:
+		if line.startswith('track'):
+			continue;
+		sline = line.split();
+		if len(sline) < 4:
+			continue;
+		if sline[0] != chrom:
+			if chrom is not None:
+				yield (chrom, numpy.array(starts, dtype= numpy.int64), numpy.array(values, dtype= float));
+			chrom = sline[0];
+			starts = [];
+			values = [];
+		starts.append(int(sline[1]));
+		values.append(float(sline[3]));
+	infile.close();
+	if chrom is not None:
+		yield (chrom, numpy.array(starts, dtype= numpy.int64), numpy.array(values, dtype= float));
+
+
+def sorted_block(chrom, starts, values):
+	order = numpy.argsort(starts, kind= 'mergesort');
+	return (chrom, starts[order], values[order]);
+
+
+def write_windows(f, chrom, starts, values, found, window_size):
+	"""
+	Write the windows as bed graph lines. Values of the windows not in the
+	summary graph are written as 0, the others as floats.
+	"""
+	value_strings = [str(x) for x in values.tolist()];
+	for i in numpy.flatnonzero(~found):
+		value_strings[i] = '0';
+	ends = (starts + window_size - 1).tolist();
+	f.writelines([chrom + '\t' + str(s) + '\t' + str(e) + '\t' + v + '\n' for s, e, v in zip(starts.tolist(), ends, value_strings)]);
+
 
-	
 def find_windows_on_islands(species, summary_graph_file, islands_file, window_size, out_file, window_read_count_threshold=0):
-	summary_graph_extension=".summarygraph"
-	island_extension=".islands"
-	chroms = species_chroms[species];
-	SeparateByChrom.separateByChrom(chroms, summary_graph_file, summary_graph_extension)
-	SeparateByChrom.separateByChrom(chroms, islands_file, island_extension)
+	"""
+	Windows of the summary graph on the islands, one chromosome at a time in
+	the order of the summary graph. Chromosomes not in species are skipped if
+	species is known. Windows with value >= window_read_count_threshold are
+	written to out_file, unless out_file is "".
+	Return {chrom: (window starts, values)} of all the windows on the islands.
+	"""
+	islands = island_overlap.read(islands_file);
+	if species in GenomeData.species_chroms.keys():
+		chroms = set(GenomeData.species_chroms[species]);
+	else:
+		chroms = None;
 	
 	windows_on_island={};
-	for chrom in chroms:
-		if Utility.fileExists(chrom+summary_graph_extension) and Utility.fileExists(chrom+island_extension):
-			summary = BED.BED(species, chrom+summary_graph_extension, "BED_GRAPH", 0);
-			islands = BED.BED(species, chrom+island_extension, "BED_GRAPH", 0);
-			windows_on_island[chrom] = filter_out_uncovered_windows(islands[chrom], summary[chrom], window_size)
-			
 	if out_file !="":
-		f = open(out_file, 'w')
-		for chrom in chroms:
-			if chrom in windows_on_island.keys():
-				for item in windows_on_island[chrom]:
-					if (item.value >= window_read_count_threshold):
-						f.write(item.chrom + '\t' + str(item.start) +'\t'+ str(item.end) +'\t'+ str(item.value) + '\n')
+		f = open(out_file, 'w', 1 << 20)
+	for chrom, window_starts, window_values in graph_by_chrom(summary_graph_file):
+		if chrom not in islands.starts or (chroms is not None and chrom not in chroms):
+			continue;
+		starts, values, found = filter_out_uncovered_windows(islands.starts[chrom], islands.ends[chrom], window_starts, window_values, window_size);
+		windows_on_island[chrom] = (starts, values);
+		if out_file !="":
+			keep = values >= window_read_count_threshold;
+			write_windows(f, chrom, starts[keep], values[keep], found[keep], window_size);
+	if out_file !="":
 		f.close()
-
-	SeparateByChrom.cleanup(chroms, summary_graph_extension);
-	SeparateByChrom.cleanup(chroms, island_extension);	
 	return windows_on_island;
 
 def main(argv):
 	parser = OptionParser()
-	parser.add_option("-s", "--species", action="store", type="string", dest="species", help="species, mm8, hg18", metavar="<str>")
-	parser.add_option("-a", "--summarygraphfile", action="store", type="string", dest="bedfile", metavar="<file>", help="summary graph file")
+	parser.add_option("-s", "--species", action="store", type="string", dest="species", help="Optional: species, mm8, hg18, to keep only its chromosomes", metavar="<str>")
+	parser.add_option("-a", "--summarygraphfile", action="store", type="string", dest="bedfile", metavar="<file>", help="summary graph file, as bed graph or as dense window counts (see dense_windows.py)")
 	parser.add_option("-b", "--islandfile", action="store", type="string", dest="islandbedfile", metavar="<file>", help="island file")
 	parser.add_option("-o", "--outfile", action="store", type="string", dest="out_file", metavar="<file>", help="filtered summary graph file")
 	parser.add_option("-w", "--window_size", action="store", type="int",  dest="window_size", help="window size of summary graph", metavar="<int>")
 	
 	
 	(opt, args) = parser.parse_args(argv)
-	if len(argv) < 10:
+	if not opt.bedfile or not opt.islandbedfile or not opt.out_file or not opt.window_size:
         	parser.print_help()
         	sys.exit(1)
 	
-	if opt.species in species_chroms.keys():
-		chroms = species_chroms[opt.species];
-	else:
+	if opt.species is not None and opt.species not in GenomeData.species_chroms.keys():
 		print "This species is not recognized, exiting";
 		sys.exit(1);
 	
-	summary_graph_extension=".summarygraph"
-	island_extension=".islands"
-	SeparateByChrom.separateByChrom(chroms, opt.bedfile, summary_graph_extension)
-	SeparateByChrom.separateByChrom(chroms, opt.islandbedfile, island_extension)
-	
-	f = open(opt.out_file, 'w')
-	for chrom in chroms:
-		if Utility.fileExists(chrom+summary_graph_extension) and Utility.fileExists(chrom+island_extension):
-			summary = BED.BED(opt.species, chrom+summary_graph_extension, "BED_GRAPH", 0);
-			islands = BED.BED(opt.species, chrom+island_extension, "BED_GRAPH", 0);
-			result = filter_out_uncovered_windows(islands[chrom], summary[chrom], opt.window_size)
-			for item in result:
-				f.write(item.chrom + '\t' + str(item.start) +'\t'+ str(item.end) +'\t'+ str(item.value) + '\n')
-	f.close()
-
-	SeparateByChrom.cleanup(chroms, summary_graph_extension);
-	SeparateByChrom.cleanup(chroms, island_extension);
+	find_windows_on_islands(opt.species, opt.bedfile, opt.islandbedfile, opt.window_size, opt.out_file);
 
 if __name__ == "__main__":
 	main(sys.argv)
@@ -28,67 +28,40 @@ from math import *
 from string import *
 from optparse import OptionParser
 import operator
-import bisect
 
-import BED
-import Utility
 from GenomeData import *
-import SeparateByChrom
+import island_overlap
 
-plus = re.compile("\+");
-minus = re.compile("\-");
 
-Dir = os.getcwd();
-
-
-def are_islands_sorted(island_list):
-	"""
-	Check if sorted in ascending order.
-	input is a list of BED with chrom, start, end and value.
-	output: sorted =1 or 0
-	"""
-	sorted = 1;
-	for index in range(0, len(island_list)-1):
-		if island_list[index].start> island_list[index+1].start:
-			sorted = 0;
-	return sorted;
-
-
-def union_islands(islandlist):
+def read_islands_by_chrom(islandfile, chroms):
 	"""
-	The islandlist MUST be pre-sorted according to start!!!
+	Read the islands of the chromosomes in chroms into a dict {chrom: (lines,
+	starts, ends)}, the lines split on white space and in the order of the
+	file, starts and ends as arrays.
 	"""
-	start_list =[]
-	end_list = []
-	current = islandlist[0]
-	i = 1
-	while i < len(islandlist):
-		compare = islandlist[i]
-		assert current.start <= compare.start
-		if compare.start > current.end:
-			start_list.append(current.start)
-			end_list.append(current.end)
-			current = compare
-			i += 1
-		else: 
-			current.end = max(current.end, compare.end)
-			i += 1
-	start_list.append(current.start)
-	end_list.append(current.end)
-	return start_list, end_list
-
-
-def region_overlap(start, end, start_list, end_list):
-	"""
-	Assuming non overlapping islands.
-	"""
-	assert (start <= end);
-	start_position = bisect.bisect_right(end_list, start);
-	end_position = bisect.bisect_left(start_list, end); 
-	if (start_position < end_position): 
-		return 1;
-	else:
-		return 0;
+	islands = {};
+	f = island_overlap.open_islands(islandfile);
+	for line in f:
+		if not re.match("#", line):
+			sline = line.split()
+			if len(sline) > 0 and sline[0] in chroms:
+				if sline[0] not in islands:
+					islands[sline[0]] = ([], [], []);
+				islands[sline[0]][0].append(sline);
+				islands[sline[0]][1].append(atoi(sline[1]));
+				islands[sline[0]][2].append(atoi(sline[2]));
+	f.close()
+	return islands;
+
+
+def read_file_list(filename):
+	files = [];
+	f = open(filename, 'r')
+	for line in f:
+		if line.strip() != '' and not re.match("#", line):
+			files.append(line.strip().split('\t')[0]);
+	f.close()
+	return files;
 
 
 def main(argv):
@@ -98,9 +71,10 @@ def main(argv):
 	parser.add_option("-s", "--species", action="store", type="string", dest="species", help="species, mm8 or hg18", metavar="<str>")
 	parser.add_option("-p", "--overlapin1", action="store", type="string", dest="overlapin1", metavar="<file>", help="file for islands in 1 overlapping with islands in 2")
 	parser.add_option("-q", "--nonoverlapin1", action="store", type="string", dest="nonoverlapin1", help="file for islands in 1 not overlapping with islands in 2 ", metavar="<file>")
+	parser.add_option("-m", "--batch", action="store", type="string", dest="batch", default= None, metavar="<file>", help="instead of -a, -b, -q: compare all the island files listed in this file, one per line, and write to -p the matrix of the number of islands in file i overlapping with islands in file j")
 
 	(opt, args) = parser.parse_args(argv)
-	if len(argv) < 10:
+	if (opt.batch is None and len(argv) < 10) or (opt.batch is not None and (opt.overlapin1 is None or opt.species is None)):
         	parser.print_help()
         	sys.exit(1)
 	
@@ -110,56 +84,49 @@ def main(argv):
 		print "This species is not recognized, exiting";
 		sys.exit(1);
 	
+	if opt.batch is not None:
+		files = read_file_list(opt.batch);
+		island_sets = [];
+		for file in files:
+			islands = read_islands_by_chrom(file, chroms);
+			island_sets.append(island_overlap.IslandSet(dict([(chrom, islands[chrom][1:]) for chrom in islands])));
+		matrix = island_overlap.overlap_matrix(island_sets);
+		f = open(opt.overlapin1, 'w')
+		f.write('\t'.join(['file', 'islands'] + files) + '\n');
+		for i in range(len(files)):
+			f.write('\t'.join([files[i], str(len(island_sets[i]))] + [str(x) for x in matrix[i]]) + '\n');
+		f.close()
+		return;
 	
 	total_overlap_number_1 = 0
 	total_islands_1 = 0
 	
-	SeparateByChrom.separateByChrom(chroms, opt.islandfile1, '.island1')
-	SeparateByChrom.separateByChrom(chroms, opt.islandfile2, '.island2')
+	## Islands of file 2 are unioned so that overlapping islands in file 2 are
+	## not a problem; islands of file 1 are compared with them all at once for
+	## each chromosome, see island_overlap.py.
+	islands1 = read_islands_by_chrom(opt.islandfile1, chroms);
+	islands2 = read_islands_by_chrom(opt.islandfile2, chroms);
+	union2 = island_overlap.IslandSet(dict([(chrom, islands2[chrom][1:]) for chrom in islands2])).union();
 	
-	for chrom in chroms: 
-		f = open(chrom + '.1in2', 'w')
-		g = open(chrom + '.1notin2', 'w')
-		bed_vals_2 = BED.BED(opt.species, chrom+'.island2', "BED3", 0)
-		if Utility.fileExists(chrom+'.island1') and len(bed_vals_2[chrom])>0:
-			islandlist2 = bed_vals_2[chrom];
-			if (are_islands_sorted(islandlist2) != 1):
-				islandlist2.sort(key=operator.attrgetter('start'));
-			(island2_start_list, island2_end_list) = union_islands(islandlist2)
-			islands1 = open(chrom+'.island1', 'r')
-			for line in islands1:
-				if not re.match("#", line):
-					total_islands_1 += 1
-					line = line.strip()
-					sline = line.split()
-					start = int(sline[1])
-					end = int(sline[2])
-					if (region_overlap(start, end, island2_start_list, island2_end_list) == 1):
-						f.write('\t'.join(sline) + '\n')
-						total_overlap_number_1 += 1;
-					else:
-						g.write('\t'.join(sline) + '\n');
-		elif Utility.fileExists(chrom+'.island1') and (len(bed_vals_2[chrom])==0):
-			islands1 = open(chrom+'.island1', 'r')
-			for line in islands1:
-				if not re.match("#", line):
-					total_islands_1 += 1
-					line = line.strip()
-					sline = line.split()
+	f = open(opt.overlapin1, 'w')
+	g = open(opt.nonoverlapin1, 'w')
+	for chrom in chroms:
+		if chrom in islands1:
+			(lines, starts, ends) = islands1[chrom];
+			assert all([start <= end for start, end in zip(starts, ends)]);
+			overlapped = union2.count_overlapping(chrom, starts, ends) > 0;
+			total_islands_1 += len(lines);
+			total_overlap_number_1 += int(overlapped.sum());
+			for sline, is_overlapped in zip(lines, overlapped.tolist()):
+				if is_overlapped:
+					f.write('\t'.join(sline) + '\n')
+				else:
 					g.write('\t'.join(sline) + '\n');
-		f.close()
-		g.close()
+	f.close()
+	g.close()
 	
 	print "total number of island in "+opt.islandfile1+":     ", total_islands_1;
 	print "total number of island in "+opt.overlapin1+":     ", total_overlap_number_1;
-	
-	SeparateByChrom.combineAllGraphFiles(chroms, '.1in2', opt.overlapin1);
-	SeparateByChrom.combineAllGraphFiles(chroms, '.1notin2', opt.nonoverlapin1);
-	
-	SeparateByChrom.cleanup(chroms, '.1in2')
-	SeparateByChrom.cleanup(chroms, '.1notin2')
-	SeparateByChrom.cleanup(chroms, '.island1')
-	SeparateByChrom.cleanup(chroms, '.island2')
 
 if __name__ == "__main__":
-	main(sys.argv)       
+	main(sys.argv)
@@ -20,10 +20,15 @@ from math import *
 from string import *
 from optparse import OptionParser
 
+import numpy
+
 import GenomeData
 import get_total_tag_counts
+import dense_windows
+import window_histogram
 
 Dir = os.getcwd();
+BLOCK_SIZE = 1000000;
 
 def get_total_num_windows (bed_graph_file, threshold = 0):
 	"""
@@ -96,48 +101,49 @@ def output_windows_histogram(windows_hist, output_filename):
 			outfile.write(outline);
 		outfile.close();
 
-def get_windows_histogram(species, summary_graph_file, window_size, rescale_factor=1):
+def get_windows_histogram(species, summary_graph_file, window_size, rescale_factor=1, chrom_lengths=None):
 
 	"""
 	The rescale factor is used to rescale the total tag count.
 	Build the histogram for the windows according to the tag-count in each window. 
-	It uses the summary.graph type file  that includes all the chromosomes. 
+	It uses the summary.graph type file  that includes all the chromosomes,
+	or dense window counts (see dense_windows.py). 
 	Each line of the file should look like:
 	chrom start end tag_count
+	The genome length is the sum of chrom_lengths, {chrom: length}, if given,
+	otherwise of the chromosome lengths of the species or of the dense file.
+	Read counts are binned in blocks of lines with window_histogram.WindowHistogram.
 	"""
-	totalbp = 0.0;
-	value_list = GenomeData.species_chrom_lengths[species].values();
-	for values in value_list: totalbp += values;
-	totalnumber_windows = round(totalbp/window_size);
-	totalnumber_occupied_windows = 0.0;
-	#print "Total number of windows is " + str(totalnumber_windows);
-		
-	current_max = 0;
-	windows_hist = [0];
-
-	infile = open(summary_graph_file, 'r');
-		
-        for line in infile:
-        	""" check to make sure not a header line """
-		if not re.match("track", line):
-			line = line.strip();
-			sline = line.split();
-			assert (len(sline) == 4);
-			tags_in_window = atof(sline[3]);
-			tags_in_window = int(rescale_factor*tags_in_window)
-			if tags_in_window > current_max:
-				windows_hist += [0]*(tags_in_window-current_max);
-				current_max = tags_in_window;
-			windows_hist[tags_in_window] += 1.0;
-			totalnumber_occupied_windows += 1.0;
-	# The summary graph might or might not register those windows with zero tags.		
-	windows_hist[0] += totalnumber_windows - totalnumber_occupied_windows;
+	dense = None;
+	if dense_windows.is_dense_file(summary_graph_file):
+		dense = dense_windows.DenseWindows(summary_graph_file);
+	if chrom_lengths is None:
+		if species in GenomeData.species_chrom_lengths.keys():
+			chrom_lengths = GenomeData.species_chrom_lengths[species];
+		else:
+			chrom_lengths = dense.chrom_lengths;
+	histogram = window_histogram.WindowHistogram(window_size, sum(chrom_lengths.values()), rescale_factor);
+
+	if dense is not None:
+		for chrom in dense.chroms:
+			histogram.add(dense.get(chrom));
+	else:
+		infile = open(summary_graph_file, 'r');
+		values = [];
+		for line in infile:
+			""" check to make sure not a header line """
+			if not line.startswith("track"):
+				values.append(line.split()[3]);
+				if len(values) == BLOCK_SIZE:
+					histogram.add(numpy.array(values, dtype= float));
+					values = [];
+		histogram.add(numpy.array(values, dtype= float));
+		infile.close();
+
+	windows_hist = histogram.histogram();
 
 	#Get total number of tags
-	total_number_tags = 0;
-	for i in range (0, len(windows_hist)):
-		total_number_tags += i*windows_hist[i];
-	print "Total number of tags is " + str(total_number_tags);
+	print "Total number of tags is " + str(histogram.total_tags());
 
 	return windows_hist;
 	
@@ -154,15 +160,22 @@ def main(argv):
                       dest="window_size", help="window size", metavar="<int>")
 	parser.add_option("-o", "--output_filename", action="store", type="string",
                       dest="output_filename", help="output_filename", metavar="<file>")
+	parser.add_option("-g", "--genome", action="store", type="string",
+                      dest="genome", help="Optional: bam file or fasta index (.fai) giving the chromosome lengths, instead of the species", metavar="<file>")
+	parser.add_option("-r", "--rescale_factor", action="store", type="float", default=1,
+                      dest="rescale_factor", help="Optional: factor to rescale the read counts. Default %default", metavar="<float>")
 
 	(opt, args) = parser.parse_args(argv)
-	if len(argv) < 8:
+	if not opt.summary_graph_file or not opt.window_size or not opt.output_filename:
         	parser.print_help()
         	sys.exit(1)
-  	if opt.species not in GenomeData.species_chroms.keys():
+	chrom_lengths = None;
+	if opt.genome:
+		chrom_lengths = window_histogram.chrom_lengths(opt.genome);
+	if chrom_lengths is None and opt.species not in GenomeData.species_chroms.keys() and not dense_windows.is_dense_file(opt.summary_graph_file):
 		print "The species is not recognized!!";
 	else:
-		hist = get_windows_histogram(opt.species, opt.summary_graph_file, opt.window_size);
+		hist = get_windows_histogram(opt.species, opt.summary_graph_file, opt.window_size, opt.rescale_factor, chrom_lengths);
 		output_windows_histogram(hist, opt.output_filename);
     
 
@@ -21,10 +21,14 @@ from string import *
 from optparse import OptionParser
 import operator
 
+import numpy
+
 import get_total_tag_counts
 import GenomeData
 import filter_summary_graphs
 import BED
+import island_statistics
+import window_histogram
 
 def output_histogram(bins, histogram, filename):
 	outfile = open(filename, 'w');
@@ -36,58 +40,30 @@ def output_histogram(bins, histogram, filename):
 	outfile.close();
 	
 	
-def find_islands_length_histogram(bed_vals, islands_file, outfilename):
+def island_arrays(bed_vals, islands_file):
 	"""
-	For use of obtaining the length histogram of islands. 
+	(starts, ends, scores) arrays of the islands, given either as bed_vals a
+	BED object or as a file.
 	"""
-	current_max = 0;
-	total_number_islands = 0.0;
-	total_length = 0;
-	histogram = [0];
-
 	if ( bed_vals != {} and islands_file == ""):
-		for chrom in bed_vals.keys():
-			for bed_item in bed_vals[chrom]:
-				length = bed_item.end - bed_item.start + 1;
-				assert (length >= 0);
-				total_length += length;
-				if length > current_max:
-					histogram += [0]*(length-current_max + 1);
-					current_max = len(histogram);
-				histogram[length] += 1.0;
-				total_number_islands += 1.0;
+		items = [item for chrom in bed_vals.keys() for item in bed_vals[chrom]];
+		return (numpy.array([x.start for x in items], dtype= numpy.int64), numpy.array([x.end for x in items], dtype= numpy.int64),
+			numpy.array([x.value for x in items], dtype= float));
 	elif ( bed_vals == {} and islands_file != ""):
-		infile = open(islands_file, 'r');
-		for line in infile:
-			if not re.match("track", line):
-				line = line.strip();
-				sline = line.split();
-				assert (len(sline) == 4);
-				length = atoi(sline[2]) - atoi(sline[1]) + 1;
-				assert (length >= 0);
-				total_length += length;
-				if length > current_max:
-					histogram += [0]*(length-current_max + 1);
-					current_max = len(histogram);
-				histogram[length] += 1.0;
-				total_number_islands += 1.0;
-		infile.close();
+		return island_statistics.read_islands(islands_file);
 	else:
-		print "wrong input!";	
-	
-	outfile = open(outfilename, 'w');
-	outline = "# The totoal length of the islands is: " + str(total_length) + "\n";
-	outfile.write(outline);
-	
-	normalization =0.0;
-	for i in range(0, len(histogram)):
-		if histogram[i]>0:
-			normalization += (float(histogram[i])/total_number_islands);
-			outline = str(i) + "\t " + str(histogram[i]) + "\n";
-			outfile.write(outline);
-	outfile.close();
-	if (total_number_islands >0): assert (fabs(normalization-1)<.00000000001);
-	return total_length;
+		print "wrong input!";
+		return ([], [], []);
+
+
+def find_islands_length_histogram(bed_vals, islands_file, outfilename):
+	"""
+	For use of obtaining the length histogram of islands. 
+	"""
+	starts, ends, scores = island_arrays(bed_vals, islands_file);
+	statistics = island_statistics.IslandStatistics(starts, ends, scores, 0);
+	statistics.write_length_histogram(outfilename);
+	return statistics.total_length;
 
 	
 def find_islands_score_histogram(bed_vals, islands_file, bin_size, outfile):
@@ -95,47 +71,11 @@ def find_islands_score_histogram(bed_vals, islands_file, bin_size, outfile):
 	No normalization is applied
 	The input can be either bed_vals a BED object or a file.
 	"""	
-	total_number_islands = 0.0;
-	total_score = 0.0; 
-	histogram = [0];
-	
-	if ( bed_vals != {} and islands_file == ""):
-		for chrom in bed_vals.keys():
-			for item in bed_vals[chrom]:
-				index = int(item.value/bin_size);
-				if index >= len(histogram):
-					histogram += [0] * (index-len(histogram)+1)
-				histogram[index] +=1.0;
-				total_score += item.value;
-				total_number_islands += 1.0;
-	elif ( bed_vals == {} and islands_file != ""):
-		infile = open(islands_file, 'r');
-		for line in infile:
-			""" check to make sure not a header line """
-			if not re.match("track", line):
-				line = line.strip();
-				sline = line.split();
-				assert (len(sline) == 4);
-				score = atof(sline[3]);
-				index = int(score/bin_size);
-				if index >= len(histogram):
-					histogram += [0]*(index-len(histogram)+1);
-				histogram[index] += 1.0;
-				total_score += score;
-				total_number_islands += 1.0;
-		infile.close();
-	else:
-		print "wrong input!!!!!!!!!!!!!!!!!!!!!";	
-	# print "Total number of islands is :",  total_number_islands;
-	
-	bins=[];
-	for index in xrange(len(histogram)):
-		# [0, bin_size) in first bin, [bin_size, 2*bin_size) in second bin, etc
-		bins.append(bin_size*index);
+	starts, ends, scores = island_arrays(bed_vals, islands_file);
+	statistics = island_statistics.IslandStatistics(starts, ends, scores, 0, bin_size);
 	if outfile != "":
-		output_histogram(bins, histogram, outfile);
-		
-	return total_score;
+		statistics.write_score_histogram(outfile);
+	return statistics.total_score;
 
 def  get_island_read_counts (species, summary_graph_file, islands_file,  window_size, out_file, window_read_count_threshold=0):
 	"""
@@ -146,7 +86,9 @@ def  get_island_read_counts (species, summary_graph_file, islands_file,  window_
 	assert (species in GenomeData.species_chroms.keys())
 	windows_on_islands = filter_summary_graphs.find_windows_on_islands(species, summary_graph_file, islands_file,  window_size, out_file, window_read_count_threshold);
 	
-	total_read_count = get_total_tag_counts.get_total_tag_counts_bed_graph("", windows_on_islands, window_read_count_threshold);
+	for chrom in windows_on_islands.keys():
+		values = windows_on_islands[chrom][1];
+		total_read_count += float(values[values >= window_read_count_threshold].sum());
 	return total_read_count;
 	
 	
@@ -209,31 +151,40 @@ def main(argv):
                       dest="islands_length_histogram_file", help="islands length histogram file", metavar="<file>")
 	parser.add_option("-r", "--island_filtered_summary_graph", action="store", type="string",
                       dest="island_filtered_summary_graph", default = "", help=" Optional. The default is not to do it. ", metavar="<file>")	   	   
+	parser.add_option("-t", "--statistics_file", action="store", type="string",
+                      dest="statistics_file", default = "", help="Optional: write the summary of the islands, with coverage and quantiles of lengths and scores, to this file", metavar="<file>")
+	parser.add_option("-G", "--genome", action="store", type="string",
+                      dest="genome", default = None, help="Optional: bam file or fasta index (.fai) giving the chromosome lengths, instead of the species", metavar="<file>")
 
 	(opt, args) = parser.parse_args(argv)
 	if len(argv) < 12:
         	parser.print_help()
         	sys.exit(1)
-	if opt.species in GenomeData.species_chroms.keys():
+	if opt.genome:
+		genome_length = sum(window_histogram.chrom_lengths(opt.genome).values());
+	elif opt.species in GenomeData.species_chroms.keys():
 		genome_length = sum ( GenomeData.species_chrom_lengths[opt.species].values());
-		chroms = GenomeData.species_chroms[opt.species];
-		
-		total_tag_counts = get_total_tag_counts.get_total_tag_counts_bed_graph(opt.summary_graph_file);
-		print "Total read count is:" , total_tag_counts;
-		
-		total_length = find_islands_length_histogram({}, opt.islands_file, opt.islands_length_histogram_file);
-		print "Total islands length is: ", total_length, ";      Length coverage = total_length_of_islands/genome_length is: ", total_length*1.0/genome_length;
-		
-		bin_size=0.1;
-		total_score = find_islands_score_histogram({}, opt.islands_file, bin_size, opt.islands_score_histogram_file);
-		print "Total islands score is: ", total_score;
-		
-		if (opt.island_filtered_summary_graph != ""):
-			read_count_on_islands = get_island_read_counts (opt.species, opt.summary_graph_file, opt.islands_file,  opt.window_size, opt.island_filtered_summary_graph, 0)
-			print "Total read count on island is: ", read_count_on_islands, " Read count coverage=read_count_on_islands/Total-read-count: ", read_count_on_islands/float(total_tag_counts); 
-		
-    	else: 
+	else:
 		print "This species is not in my list!"; 
+		sys.exit(1);
+		
+	total_tag_counts = get_total_tag_counts.get_total_tag_counts_bed_graph(opt.summary_graph_file);
+	print "Total read count is:" , total_tag_counts;
+	
+	bin_size=0.1;
+	starts, ends, scores = island_statistics.read_islands(opt.islands_file);
+	statistics = island_statistics.IslandStatistics(starts, ends, scores, genome_length, bin_size);
+	statistics.write_length_histogram(opt.islands_length_histogram_file);
+	print "Total islands length is: ", statistics.total_length, ";      Length coverage = total_length_of_islands/genome_length is: ", statistics.coverage;
+	
+	statistics.write_score_histogram(opt.islands_score_histogram_file);
+	print "Total islands score is: ", statistics.total_score;
+	if opt.statistics_file != "":
+		statistics.write(opt.statistics_file);
+	
+	if (opt.island_filtered_summary_graph != ""):
+		read_count_on_islands = get_island_read_counts (opt.species, opt.summary_graph_file, opt.islands_file,  opt.window_size, opt.island_filtered_summary_graph, 0)
+		print "Total read count on island is: ", read_count_on_islands, " Read count coverage=read_count_on_islands/Total-read-count: ", read_count_on_islands/float(total_tag_counts); 
 
 if __name__ == "__main__":
 	main(sys.argv)
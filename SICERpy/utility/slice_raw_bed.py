@@ -23,6 +23,7 @@ import operator
 import random
 import shutil
 import get_total_tag_counts
+import subsample
 
 
 def slice(desired_number_tags, raw_bed_file, out_file_name):
@@ -47,53 +48,70 @@ def slice(desired_number_tags, raw_bed_file, out_file_name):
 		infile.close();
 
 		
-def random_sample (desired_number_tags, raw_bed_file, out_file_name):
+def random_sample (desired_number_tags, raw_bed_file, out_file_name, seed=None):
 	"""
-	Read a raw bed file and take the desired number of lines
+	Read a raw bed file and take the desired number of lines, in one pass
+	with reservoir sampling (see subsample.py). All the lines are taken if
+	there are no more than desired.
 	
-	If reproduceable result is needed, one needs to set seed of the random function outside.
+	If reproduceable result is needed, set the seed.
 	
 	"""
-	current_total = int(get_total_tag_counts.get_total_tag_counts(raw_bed_file));
-	assert  (current_total >= desired_number_tags);
-	sample_list = random.sample(xrange(current_total), desired_number_tags);
-	sample_list.sort();
-	#print sample_list;
-	count = 0;
-	index = 0; 
 	infile = open(raw_bed_file,'r');
+	lines = subsample.reservoir_sample((line for line in infile if not line.startswith("track")), desired_number_tags, random.Random(seed));
+	infile.close()
 	outfile = open(out_file_name, 'w');
-	for line in infile:
-		if count == sample_list[index]:	
-			outfile.write(line);
-			if index == desired_number_tags-1:
-				break;
-			else:
-				index += 1;
-		count +=1;
+	outfile.writelines(lines);
+	outfile.close();
+	return len(lines);
+
+
+def hash_sample (fraction, raw_bed_file, out_file_name, seed=0):
+	"""
+	Read a raw bed file and take the lines whose read name (4th column)
+	hashes below fraction, see subsample.py. Reads with the same name are
+	taken together and the choice is the same in every run with the same seed.
+	"""
+	infile = open(raw_bed_file,'r');
+	outfile = open(out_file_name, 'w');
+	count = 0;
+	for line in subsample.hash_sample((line for line in infile if not line.startswith("track")), fraction, seed, lambda x: x.split()[3]):
+		outfile.write(line);
+		count += 1;
 	outfile.close();
-	infile.close()		
+	infile.close()
+	return count;
 
 
 def main(argv):
 	parser = OptionParser();
 	parser.add_option("-f", "--rawtagfile", action="store", type="string",
-			  dest="raw_bed_file", help="raw bed file",
+			  dest="raw_bed_file", help="raw bed file, or bam file",
 			  metavar="<file>");
 	parser.add_option("-n", "--desirednumberoftags", action="store", type="int",
-			  dest="desired_number_tags", help="desired number of tags",
+			  dest="desired_number_tags", default=None, help="desired number of tags",
+			  metavar="<int>");
+	parser.add_option("-x", "--fraction", action="store", type="float",
+			  dest="fraction", default=None, help="instead of --desirednumberoftags: keep the tags whose read name hashes below this fraction, so that mates are kept together",
+			  metavar="<float>");
+	parser.add_option("-s", "--seed", action="store", type="int",
+			  dest="seed", default=None, help="Optional: seed of the random choice, for reproducible results",
 			  metavar="<int>");
-    	parser.add_option("-o", "--slicedrawtagfile", action="store", type="string",
-			  dest="out_file_name", help="sliced raw bed file",
+	parser.add_option("-o", "--slicedrawtagfile", action="store", type="string",
+			  dest="out_file_name", help="sliced raw bed file, or bam file if the input is bam",
 			  metavar="<file>");
 	(opt, args) = parser.parse_args(argv);
-	if len(argv) < 6:
+	if not opt.raw_bed_file or not opt.out_file_name or (opt.desired_number_tags is None) == (opt.fraction is None):
 		parser.print_help()
 		sys.exit(1)
-	random_sample(opt.desired_number_tags, opt.raw_bed_file, opt.out_file_name);
-	total = get_total_tag_counts.get_total_tag_counts(opt.out_file_name);
+	if opt.raw_bed_file.endswith('.bam'):
+		total = subsample.subsample_bam(opt.raw_bed_file, opt.out_file_name, opt.desired_number_tags, opt.fraction, opt.seed).size();
+	elif opt.fraction is not None:
+		total = hash_sample(opt.fraction, opt.raw_bed_file, opt.out_file_name, opt.seed if opt.seed is not None else 0);
+	else:
+		total = random_sample(opt.desired_number_tags, opt.raw_bed_file, opt.out_file_name, opt.seed);
 	print "The number of tags in " + opt.out_file_name + ' is ' + str(total);
 	
 
 if __name__ == "__main__":
-	main(sys.argv)
\ No newline at end of file
+	main(sys.argv)